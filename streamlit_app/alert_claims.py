@@ -0,0 +1,132 @@
+# Общий для всех сессий процесса индекс "кто отправляет алерт": одна отправка на (chat_id, TxID)
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+MAX_CLAIMS = 100000 # Сколько пар (chat_id, TxID) помнить; старые удаляются первыми
+RECLAIMABLE_STATUSES = ('pending', 'error') # После неудачи алерт может забрать любая сессия
+SCHEDULED_RETRY_GRACE = 60 # Сек; запланированный пулом повтор нельзя забрать, пока он не просрочен на столько
+UNSUBMITTED_CLAIM_TIMEOUT = 30 # Сек; захват, не переданный пулу отправки за это время, можно забрать снова
+INTERNAL_FIELDS = ('claimed_at', 'previous') # Служебные поля записи, не попадают в истории сессий
+
+
+class AlertClaimIndex:
+    """
+    Индекс захватов алертов. Сессия, первой захватившая (chat_id, TxID), формирует и отправляет сообщение,
+    остальные сессии с тем же чатом лишь отражают его статус в своей истории. Захват атомарен
+    (одна блокировка на индекс), статусы обновляет пул отправки.
+    """
+
+    def __init__(self, max_claims: int = MAX_CLAIMS):
+        self._lock = threading.Lock()
+        self._claims: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._max_claims = max_claims
+
+    def claim_many(
+        self, chat_id: str, tx_hashes: Iterable[str],
+        attempt_numbers: Optional[Dict[str, int]] = None, max_attempts: Optional[int] = None
+    ) -> Dict[str, int]:
+        """
+        Захватывает свободные алерты: нет записи, статус pending/error с неисчерпанными попытками (max_attempts)
+        или захват, который так и не был передан пулу отправки за UNSUBMITTED_CLAIM_TIMEOUT.
+        Возвращает {TxID: номер попытки}; номер не меньше следующего после уже известной индексу попытки.
+        """
+        chat_id = str(chat_id)
+        now = time.time()
+        won: Dict[str, int] = {}
+        with self._lock:
+            for tx_hash in tx_hashes:
+                key = (chat_id, str(tx_hash))
+                entry = self._claims.get(key)
+                if entry is not None and entry.get('claimed_at') is not None:
+                    if now - entry['claimed_at'] < UNSUBMITTED_CLAIM_TIMEOUT:
+                        continue
+                    entry = entry['previous'] # Захват не дошел до пула (сессия упала до отправки) — как будто его не было
+                if entry is not None:
+                    if entry['status'] not in RECLAIMABLE_STATUSES:
+                        continue
+                    if entry.get('next_attempt_at') and now < entry['next_attempt_at'] + SCHEDULED_RETRY_GRACE:
+                        continue # Повтор уже запланирован пулом отправки
+                    if max_attempts is not None and (entry.get('attempt') or 0) >= max_attempts:
+                        continue # Попытки исчерпаны
+                attempt = (attempt_numbers or {}).get(str(tx_hash), 1)
+                if entry is not None:
+                    attempt = max(attempt, (entry.get('attempt') or 0) + 1)
+                self._claims[key] = {
+                    'status': 'queued',
+                    'attempt': attempt,
+                    'last_attempt_time': now,
+                    'sent_time': entry.get('sent_time') if entry else None,
+                    'claimed_at': now, # Сбрасывается, когда пул отправки принимает задачу (set_status)
+                    'previous': entry
+                }
+                self._claims.move_to_end(key)
+                won[str(tx_hash)] = attempt
+            self._evict()
+        return won
+
+    def release(self, chat_id: str, tx_hashes: Iterable[str]) -> None:
+        """Отменяет захваты, задачи которых не удалось передать пулу отправки: запись возвращается к прежней."""
+        chat_id = str(chat_id)
+        with self._lock:
+            for tx_hash in tx_hashes:
+                key = (chat_id, str(tx_hash))
+                entry = self._claims.get(key)
+                if entry is None or entry.get('claimed_at') is None:
+                    continue
+                if entry['previous'] is None:
+                    del self._claims[key]
+                else:
+                    self._claims[key] = entry['previous']
+
+    def set_status(
+        self, chat_id: str, tx_hash: str, status: str,
+        attempt: Optional[int] = None, next_attempt_at: Optional[float] = None
+    ) -> None:
+        """
+        Обновляет статус алерта (вызывается пулом отправки и при ошибках формирования).
+        next_attempt_at — время запланированного пулом повтора для статуса pending.
+        """
+        key = (str(chat_id), str(tx_hash))
+        now = time.time()
+        with self._lock:
+            entry = self._claims.get(key) or {'attempt': 1, 'sent_time': None}
+            entry = dict(entry, status=status, last_attempt_time=now, next_attempt_at=next_attempt_at)
+            entry.pop('claimed_at', None)
+            entry.pop('previous', None)
+            if attempt is not None:
+                entry['attempt'] = attempt
+            if status == 'success':
+                entry['sent_time'] = now
+            self._claims[key] = entry
+            self._claims.move_to_end(key)
+            self._evict()
+
+    def get_entries(self, chat_id: str, tx_hashes: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Известные индексу записи (status, attempt, last_attempt_time, sent_time, next_attempt_at)
+        для набора TxID одного чата.
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            return {
+                str(tx): {k: v for k, v in self._claims[(chat_id, str(tx))].items() if k not in INTERNAL_FIELDS}
+                for tx in tx_hashes if (chat_id, str(tx)) in self._claims
+            }
+
+    def _evict(self) -> None:
+        while len(self._claims) > self._max_claims:
+            self._claims.popitem(last=False)
+
+
+_index: Optional[AlertClaimIndex] = None
+_index_lock = threading.Lock()
+
+def get_claim_index() -> AlertClaimIndex:
+    """Возвращает единственный на процесс индекс захватов алертов."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = AlertClaimIndex()
+        return _index
@@ -0,0 +1,454 @@
+# Пул потоков для отправки алертов Telegram, не зависящий от перезапусков Streamlit
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import alert_claims
+import alert_metrics
+import alert_outbox
+import telegram_async
+import telegram_service
+
+DEFAULT_MAX_WORKERS = 4
+MAX_RATE_LIMIT_REQUEUES = 20 # Сколько раз подряд задача может быть отложена из-за 429, не тратя попытку
+MAX_DIGEST_ITEMS = 100 # Сколько задач чата максимум забирается в одну пачку сводок
+DEFAULT_MAX_ATTEMPTS = 5 # Для задач без max_attempts (например, восстановленных из outbox)
+RECOVERED_RESULTS_LOG_SIZE = 1000 # Сколько последних итогов восстановленных задач помнить для сверки историй сессий
+RETRY_BASE_DELAY = telegram_service.env_number("ALERT_RETRY_BASE_DELAY", 30.0) # Сек; задержка перед второй попыткой
+RETRY_MAX_DELAY = telegram_service.env_number("ALERT_RETRY_MAX_DELAY", 900.0) # Сек; потолок экспоненциальной задержки
+
+
+def retry_delay(attempt_number: int) -> float:
+    """
+    Задержка перед попыткой attempt_number + 1: экспонента от RETRY_BASE_DELAY с потолком RETRY_MAX_DELAY
+    и случайной половиной ("equal jitter"), чтобы повторы многих алертов не приходили в Telegram одной волной.
+    """
+    delay = min(RETRY_BASE_DELAY * 2 ** max(attempt_number - 1, 0), RETRY_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class AlertDispatcher:
+    """
+    Ограниченный пул потоков, разбирающий очередь алертов параллельно.
+    У каждого чата своя FIFO-очередь, и в любой момент ее обслуживает не больше одного потока,
+    поэтому порядок сообщений внутри чата сохраняется, а разные чаты отправляются параллельно.
+    Если передан outbox, каждая задача сначала фиксируется на диске, а переходы статусов пишутся в него.
+    С asyncio-бэкендом потоки не ждут ответа Telegram: в полете могут быть сообщения сотен чатов одновременно.
+    Неудачные отправки повторяет сам пул: уже сформированное сообщение ждет в куче, упорядоченной
+    по времени следующей попытки, и возвращается в очередь чата, когда оно наступит.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        outbox: Optional[alert_outbox.AlertOutbox] = None,
+        backend: Optional[telegram_async.AsyncTelegramBackend] = None
+    ):
+        self._outbox = outbox
+        self._backend = backend
+        self._completions: Deque[Tuple[Dict[str, Any], Tuple[bool, Optional[float]]]] = deque() # Результаты асинхронных отправок
+        self._condition = threading.Condition()
+        self._chat_queues: Dict[str, Deque[Dict[str, Any]]] = {}
+        self._ready_chats: Deque[str] = deque() # Чаты с задачами, которые сейчас никто не обслуживает
+        self._active_chats: Set[str] = set()
+        self._chat_not_before: Dict[str, float] = {} # Чат нельзя обслуживать раньше этого времени (лимиты Telegram)
+        self._retry_heap: List[Tuple[float, int, Dict[str, Any]]] = [] # (время попытки по monotonic, порядок, задача)
+        self._retry_sequence = itertools.count()
+        self._awaiting_token: Dict[str, List[Tuple[Dict[str, Any], Optional[float]]]] = {} # Ссылка на токен -> (задача, время повтора)
+        self._recovered_results: Deque[Tuple[int, str, str]] = deque(maxlen=RECOVERED_RESULTS_LOG_SIZE) # (номер, chat_id, TxID)
+        self._recovered_sequence = 0
+        self._stopped = False
+        self._workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"alert-dispatcher-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(
+        self,
+        task: Dict[str, Any],
+        on_complete: Callable[[Dict[str, Any], bool], None],
+        on_start: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> bool:
+        """
+        Ставит задачу в очередь ее чата. task должен содержать bot_token, chat_id, message_html и tx_hash.
+        Необязательный task['digest'] = {'threshold': N, 'window': сек} включает режим сводок:
+        сообщения копятся до N штук или window секунд и отправляются упакованными в минимум сообщений.
+        Если есть task['timestamps'] (отметки этапов для alert_metrics), пул дописывает в них dispatched
+        и после доставки записывает задержки (о неудачной попытке — только факт неудачи).
+        on_start вызывается перед отправкой, on_complete(task, success) — после, оба из рабочего потока;
+        в задаче, переданной on_complete, next_attempt_at — время запланированного повтора или None.
+        Возвращает False, если outbox отклонил задачу: алерт уже в очереди, отправляется или отправлен.
+        """
+        if self._outbox is not None:
+            try:
+                if not self._outbox.enqueue(task):
+                    # Алерт уже в outbox (например, досылается после перезапуска): публикуем его статус
+                    entry = self._outbox.get_entries(task['chat_id'], [task['tx_hash']]).get(str(task['tx_hash']))
+                    if entry is not None:
+                        alert_claims.get_claim_index().set_status(task['chat_id'], task['tx_hash'], entry['status'], entry['attempt'])
+                    return False
+            except Exception as e:
+                print(f"Error writing alert {task.get('tx_hash')} to outbox: {e}")
+        # Задача принята пулом: захват сессии больше не может истечь
+        alert_claims.get_claim_index().set_status(task['chat_id'], task['tx_hash'], alert_outbox.STATUS_QUEUED, task.get('attempt_number', 1))
+        self._enqueue(task, on_complete, on_start)
+        return True
+
+    def recover(self) -> int:
+        """
+        Возвращает в очередь задачи, не доставленные до перезапуска процесса, а запланированные повторы —
+        в расписание. Задачи бота, токен которого еще не зарегистрирован в процессе, ждут release_awaiting.
+        Возвращает количество восстановленных задач.
+        """
+        if self._outbox is None:
+            return 0
+        try:
+            tasks = self._outbox.recover()
+        except Exception as e:
+            print(f"Error recovering alerts from outbox: {e}")
+            return 0
+        for task in tasks:
+            next_attempt_at = task.pop('next_attempt_at', None)
+            if task.get('bot_token') is None:
+                with self._condition:
+                    self._awaiting_token.setdefault(task['bot_ref'], []).append((task, next_attempt_at))
+                continue
+            self._resume_recovered(task, next_attempt_at)
+        if tasks:
+            print(f"Recovered {len(tasks)} undelivered alerts from outbox")
+        return len(tasks)
+
+    def release_awaiting(self, bot_ref: str, bot_token: str) -> int:
+        """Запускает восстановленные задачи, ждавшие токена бота. Возвращает их количество."""
+        with self._condition:
+            parked = self._awaiting_token.pop(bot_ref, [])
+        for task, next_attempt_at in parked:
+            task['bot_token'] = bot_token
+            self._resume_recovered(task, next_attempt_at)
+        return len(parked)
+
+    def awaiting_token_count(self) -> int:
+        """Количество восстановленных задач, ожидающих регистрации токена бота."""
+        with self._condition:
+            return sum(len(parked) for parked in self._awaiting_token.values())
+
+    def _resume_recovered(self, task: Dict[str, Any], next_attempt_at: Optional[float]) -> None:
+        # Сессии, поставившие эти задачи, уже не существуют: итог публикуется в индексе захватов и outbox,
+        # а номер итога — в журнале recovered_results_since, по которому сессии сверяют свои истории
+        if next_attempt_at is not None:
+            alert_claims.get_claim_index().set_status(
+                task['chat_id'], task['tx_hash'], alert_outbox.STATUS_PENDING, task['attempt_number'] - 1, next_attempt_at
+            )
+            item = {'task': task, 'on_complete': self._record_recovered_result, 'on_start': None}
+            self._schedule_retry(item, max(next_attempt_at - time.time(), 0.0))
+            return
+        alert_claims.get_claim_index().set_status(task['chat_id'], task['tx_hash'], alert_outbox.STATUS_QUEUED, task.get('attempt_number', 1))
+        self._enqueue(task, on_complete=self._record_recovered_result)
+
+    def _record_recovered_result(self, task: Dict[str, Any], success: bool) -> None:
+        with self._condition:
+            self._recovered_sequence += 1
+            self._recovered_results.append((self._recovered_sequence, str(task['chat_id']), str(task['tx_hash'])))
+
+    def recovered_results_sequence(self) -> int:
+        """Номер последнего итога восстановленной задачи (растет с каждым итогом)."""
+        with self._condition:
+            return self._recovered_sequence
+
+    def recovered_results_since(self, sequence: int) -> Tuple[int, List[Tuple[str, str]]]:
+        """
+        Итоги восстановленных задач после номера sequence: (последний номер, [(chat_id, TxID), ...]).
+        Сами статусы берутся из индекса захватов или outbox.
+        """
+        with self._condition:
+            return self._recovered_sequence, [(chat_id, tx) for seq, chat_id, tx in self._recovered_results if seq > sequence]
+
+    def _enqueue(
+        self,
+        task: Dict[str, Any],
+        on_complete: Callable[[Dict[str, Any], bool], None],
+        on_start: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> None:
+        chat_id = str(task.get('chat_id'))
+        with self._condition:
+            chat_queue = self._chat_queues.setdefault(chat_id, deque())
+            chat_queue.append({'task': task, 'on_complete': on_complete, 'on_start': on_start, 'enqueued_at': time.monotonic()})
+            if chat_id not in self._active_chats and len(chat_queue) == 1:
+                self._ready_chats.append(chat_id)
+            self._condition.notify_all() # Порог сводки мог быть достигнут
+
+    def pending_count(self, chat_id: Optional[str] = None) -> int:
+        """Количество задач, ожидающих отправки (по чату или всего)."""
+        with self._condition:
+            if chat_id is not None:
+                return len(self._chat_queues.get(str(chat_id), ()))
+            return sum(len(q) for q in self._chat_queues.values())
+
+    def scheduled_retry_count(self) -> int:
+        """Количество неудачных отправок, ожидающих повтора по расписанию."""
+        with self._condition:
+            return len(self._retry_heap)
+
+    def _schedule_retry(self, item: Dict[str, Any], delay: float) -> None:
+        """Кладет задачу в расписание повторов; поток, ждущий работу, проснется к ее времени."""
+        with self._condition:
+            heapq.heappush(self._retry_heap, (time.monotonic() + delay, next(self._retry_sequence), item))
+            self._condition.notify()
+
+    def _resubmit(self, item: Dict[str, Any]) -> None:
+        """Возвращает задачу повтора в очередь чата (через outbox, чтобы не задвоить отправку)."""
+        task = item['task']
+        if self._outbox is not None:
+            try:
+                if not self._outbox.enqueue(task):
+                    return # Алерт уже забрала другая сессия или он отправлен
+            except Exception as e:
+                print(f"Error writing alert {task.get('tx_hash')} to outbox: {e}")
+        alert_claims.get_claim_index().set_status(task['chat_id'], task['tx_hash'], alert_outbox.STATUS_QUEUED, task['attempt_number'])
+        self._enqueue(task, item['on_complete'], item['on_start'])
+
+    def _chat_ready_at(self, chat_id: str) -> float:
+        """Момент, начиная с которого чат можно обслуживать: лимиты Telegram и накопление сводки."""
+        ready_at = self._chat_not_before.get(chat_id, 0.0)
+        chat_queue = self._chat_queues[chat_id]
+        digest = chat_queue[0]['task'].get('digest')
+        if digest and len(chat_queue) < digest.get('threshold', 1):
+            ready_at = max(ready_at, chat_queue[0]['enqueued_at'] + digest.get('window', 0))
+        return ready_at
+
+    def shutdown(self, timeout: float = 5.0) -> bool:
+        """
+        Останавливает рабочие потоки и расписание повторов. Текущие отправки завершаются, новые задачи
+        из очередей и повторы не берутся: с outbox они остаются в нем и восстанавливаются recover()
+        при следующем запуске. Возвращает True, если все потоки завершились за timeout секунд.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0.0))
+        return not any(worker.is_alive() for worker in self._workers)
+
+    def _take_work(self) -> Tuple[str, Any]:
+        """
+        Ждет работу: результат асинхронной отправки (приоритетно), наступивший повтор или чат, который можно
+        обслуживать сейчас (не занят, не ограничен лимитом, сводка накоплена). Возвращает ('retry', задача),
+        ('job', (job, результат или None)) или ('stop', None) после shutdown. Вызывается под _condition.
+        """
+        while True:
+            if self._stopped:
+                return 'stop', None
+            if self._completions:
+                return 'job', self._completions.popleft()
+            now = time.monotonic()
+            if self._retry_heap and self._retry_heap[0][0] <= now:
+                return 'retry', heapq.heappop(self._retry_heap)[2]
+            earliest = self._retry_heap[0][0] if self._retry_heap else None
+            for chat_id in self._ready_chats:
+                ready_at = self._chat_ready_at(chat_id)
+                if ready_at <= now:
+                    self._ready_chats.remove(chat_id)
+                    self._active_chats.add(chat_id)
+                    return 'job', ({'chat_id': chat_id, 'items': self._take_items(chat_id)}, None)
+                earliest = ready_at if earliest is None else min(earliest, ready_at)
+            self._condition.wait(timeout=None if earliest is None else earliest - now)
+
+    def _take_items(self, chat_id: str) -> List[Dict[str, Any]]:
+        """Забирает из очереди чата одну задачу или, в режиме сводок, все подряд идущие задачи сводки. Вызывается под _condition."""
+        chat_queue = self._chat_queues[chat_id]
+        items = [chat_queue.popleft()]
+        if items[0]['task'].get('digest'):
+            while chat_queue and chat_queue[0]['task'].get('digest') and len(items) < MAX_DIGEST_ITEMS:
+                items.append(chat_queue.popleft())
+        return items
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._condition:
+                kind, work = self._take_work()
+            if kind == 'stop':
+                return
+            if kind == 'retry':
+                self._resubmit(work)
+                continue
+            job, result = work
+            if result is None:
+                self._start_job(job)
+            self._run_job(job, result)
+
+    def _start_job(self, job: Dict[str, Any]) -> None:
+        """Вызывает on_start, отмечает задачи в outbox и упаковывает их в сообщения (несколько задач — в сводки)."""
+        items = job['items']
+        for item in items:
+            if 'timestamps' in item['task']:
+                item['task']['timestamps']['dispatched'] = time.time()
+            if item['on_start'] is not None and not item.get('rate_limited_times'):
+                try:
+                    item['on_start'](item['task'])
+                except Exception as e:
+                    print(f"Error in alert start handler for {item['task'].get('tx_hash')}: {e}")
+            self._mark_status(item['task'], alert_outbox.STATUS_SENDING)
+
+        if len(items) == 1:
+            job['groups'] = [(items[0]['task']['message_html'], [0])]
+        else:
+            job['groups'] = telegram_service.build_digest_messages([item['task']['message_html'] for item in items])
+        job['group_number'] = 0
+
+    def _run_job(self, job: Dict[str, Any], result: Optional[Tuple[bool, Optional[float]]]) -> None:
+        """
+        Продвигает задачу чата: обрабатывает результат отправки очередного сообщения и отправляет следующее.
+        При асинхронной доставке поток не ждет ответа — результат вернется через _completions.
+        """
+        while True:
+            if result is not None and not self._apply_result(job, *result):
+                return
+            result = self._send_group(job)
+            if result is None:
+                return
+
+    def _send_group(self, job: Dict[str, Any]) -> Optional[Tuple[bool, Optional[float]]]:
+        task = job['items'][0]['task']
+        message_html, _ = job['groups'][job['group_number']]
+        if self._backend is not None:
+            try:
+                future = self._backend.submit(task['bot_token'], task['chat_id'], message_html)
+                future.add_done_callback(lambda f: self._post_completion(job, f))
+                return None
+            except Exception as e:
+                print(f"Error sending alert {task.get('tx_hash')}: {e}")
+                return False, None
+        try:
+            return telegram_service.send_telegram_message(task['bot_token'], task['chat_id'], message_html)
+        except Exception as e:
+            print(f"Error sending alert {task.get('tx_hash')}: {e}")
+            return False, None
+
+    def _post_completion(self, job: Dict[str, Any], future: Future) -> None:
+        """Вызывается в потоке event loop: передает результат отправки рабочим потокам."""
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Error sending alert {job['items'][0]['task'].get('tx_hash')}: {e}")
+            result = (False, None)
+        with self._condition:
+            self._completions.append((job, result))
+            self._condition.notify()
+
+    def _apply_result(self, job: Dict[str, Any], success: bool, retry_after: Optional[float]) -> bool:
+        """
+        Фиксирует результат отправки сообщения job['group_number']. Возвращает True, если в задаче остались
+        неотправленные сообщения. Если Telegram попросил подождать (429), оставшиеся задачи возвращаются
+        в очередь чата без траты попытки, а неудачные — в расписание повторов.
+        """
+        items, groups, group_number = job['items'], job['groups'], job['group_number']
+        group_items = [items[i] for i in groups[group_number][1]]
+        if retry_after is not None and group_items[0].get('rate_limited_times', 0) < MAX_RATE_LIMIT_REQUEUES:
+            unsent_items = [items[i] for _, group_indices in groups[group_number:] for i in group_indices]
+            for item in unsent_items:
+                item['rate_limited_times'] = item.get('rate_limited_times', 0) + 1
+            self._finish_job(job, retry_after, unsent_items)
+            return False
+        for item in group_items:
+            status = self._result_status(item['task'], success)
+            next_attempt_at = None
+            if status == alert_outbox.STATUS_PENDING:
+                delay = retry_delay(item['task'].get('attempt_number', 1))
+                next_attempt_at = time.time() + delay
+                self._mark_status(item['task'], status, next_attempt_at)
+                retry_task = dict(item['task'], attempt_number=item['task'].get('attempt_number', 1) + 1)
+                self._schedule_retry({'task': retry_task, 'on_complete': item['on_complete'], 'on_start': item['on_start']}, delay)
+            else:
+                self._mark_status(item['task'], status)
+            if 'timestamps' in item['task']:
+                alert_metrics.get_latency_metrics().record(dict(item['task']['timestamps'], sent=time.time()), success)
+            try:
+                # next_attempt_at — время запланированного пулом повтора (None, если повтора не будет)
+                item['on_complete'](dict(item['task'], next_attempt_at=next_attempt_at), success)
+            except Exception as e:
+                print(f"Error in alert completion handler for {item['task'].get('tx_hash')}: {e}")
+        job['group_number'] += 1
+        if job['group_number'] < len(groups):
+            return True
+        self._finish_job(job, None, [])
+        return False
+
+    def _finish_job(self, job: Dict[str, Any], retry_after: Optional[float], unsent_items: List[Dict[str, Any]]) -> None:
+        """Освобождает чат и планирует его следующее обслуживание с учетом лимитов."""
+        chat_id = job['chat_id']
+        task = job['items'][0]['task']
+        with self._condition:
+            self._active_chats.discard(chat_id)
+            if retry_after is not None:
+                # 429: возвращаем неотправленные задачи в начало очереди чата, попытка не расходуется
+                self._chat_queues.setdefault(chat_id, deque()).extendleft(reversed(unsent_items))
+                self._chat_not_before[chat_id] = time.monotonic() + retry_after
+            else:
+                self._chat_not_before[chat_id] = time.monotonic() + \
+                    telegram_service.get_send_delay(task['bot_token'], task['chat_id'])
+            if self._chat_queues.get(chat_id):
+                self._ready_chats.append(chat_id)
+            else:
+                self._chat_queues.pop(chat_id, None)
+                self._chat_not_before.pop(chat_id, None)
+            self._condition.notify_all() # Ожидающие потоки пересчитают время ближайшего доступного чата
+
+    @staticmethod
+    def _result_status(task: Dict[str, Any], success: bool) -> str:
+        if success:
+            return alert_outbox.STATUS_SUCCESS
+        if task.get('attempt_number', 1) >= task.get('max_attempts', DEFAULT_MAX_ATTEMPTS):
+            return alert_outbox.STATUS_ERROR
+        return alert_outbox.STATUS_PENDING
+
+    def _mark_status(self, task: Dict[str, Any], status: str, next_attempt_at: Optional[float] = None) -> None:
+        """
+        Публикует статус алерта в индексе захватов (видят все сессии) и в outbox.
+        next_attempt_at — время (эпоха) запланированного повтора для статуса pending.
+        """
+        alert_claims.get_claim_index().set_status(task['chat_id'], task['tx_hash'], status, task.get('attempt_number', 1), next_attempt_at)
+        if self._outbox is None:
+            return
+        try:
+            if status == alert_outbox.STATUS_SENDING:
+                self._outbox.mark_sending(task['chat_id'], task['tx_hash'])
+            else:
+                self._outbox.mark_result(task['chat_id'], task['tx_hash'], status, task.get('attempt_number', 1), next_attempt_at)
+        except Exception as e:
+            print(f"Error updating outbox status of alert {task.get('tx_hash')}: {e}")
+
+
+_dispatcher: Optional[AlertDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+def get_existing_dispatcher() -> Optional[AlertDispatcher]:
+    """Пул отправки, если он уже создан (не запускает потоки и не открывает outbox)."""
+    with _dispatcher_lock:
+        return _dispatcher
+
+def register_bot_token(bot_token: str) -> None:
+    """Регистрирует токен бота в процессе и запускает восстановленные из outbox задачи этого бота."""
+    if not bot_token:
+        return
+    bot_ref = alert_outbox.register_bot_token(bot_token)
+    dispatcher = get_existing_dispatcher()
+    if dispatcher is not None:
+        dispatcher.release_awaiting(bot_ref, bot_token)
+
+def get_dispatcher() -> AlertDispatcher:
+    """Возвращает единственный на процесс пул отправки алертов; при создании дослает алерты из outbox."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            backend = telegram_async.get_async_backend() if telegram_async.is_enabled() else None
+            _dispatcher = AlertDispatcher(outbox=alert_outbox.get_outbox(), backend=backend)
+            _dispatcher.recover()
+        return _dispatcher
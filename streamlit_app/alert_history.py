@@ -0,0 +1,119 @@
+# Ограниченная по размеру история алертов с ротацией по приоритету без полной сортировки
+import heapq
+import itertools
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+PriorityKey = Callable[[Dict[str, Any]], Any]
+
+STATUS_COLUMNS = ['status', 'attempt', 'last_attempt_time', 'sent_time', 'next_attempt_at']
+
+
+class AlertHistoryStore(dict):
+    """
+    История алертов {TxID: запись}. Это обычный dict (поиск O(1), сериализуется json как есть),
+    дополненный кучей приоритетов ротации: изменение записи стоит O(log n), удаление k самых
+    "ненужных" записей — O(k log n) вместо сортировки всей истории при каждом сохранении.
+    Записи нужно заменять целиком (history[tx] = new_entry), а не менять на месте,
+    иначе куча не узнает о новом приоритете. revision растет при каждом изменении — по нему
+    дешево понять, что историю нужно сохранить заново.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, Dict[str, Any]]] = None, priority_key: Optional[PriorityKey] = None):
+        super().__init__()
+        self._priority_key = priority_key or (lambda entry: entry.get('last_attempt_time') or 0)
+        self._heap: List[Any] = [] # (приоритет, версия, TxID); устаревшие версии удаляются лениво
+        self._versions: Dict[str, int] = {}
+        self._counter = itertools.count()
+        self.revision = 0
+        self._frame_cache: Optional[Tuple[int, pd.DataFrame]] = None
+        if entries:
+            self.update(entries)
+
+    def __setitem__(self, key: str, value: Dict[str, Any]) -> None:
+        super().__setitem__(key, value)
+        self.revision += 1
+        version = next(self._counter)
+        self._versions[key] = version
+        heapq.heappush(self._heap, (self._priority_key(value), version, key))
+        if len(self._heap) > 2 * len(self) + 64:
+            self._compact()
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._versions.pop(key, None)
+        self.revision += 1
+
+    def pop(self, key: str, *default: Any) -> Any:
+        self._versions.pop(key, None)
+        self.revision += 1
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._versions.pop(key, None)
+        self.revision += 1
+        return key, value
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        super().clear()
+        self._heap.clear()
+        self._versions.clear()
+        self.revision += 1
+
+    def copy(self) -> 'AlertHistoryStore':
+        return AlertHistoryStore(self, self._priority_key)
+
+    def status_frame(self, tx_ids: pd.Series) -> pd.DataFrame:
+        """
+        Колоночное представление истории для набора TxID (индекс как у tx_ids):
+        status, attempt, last_attempt_time, sent_time, next_attempt_at; для TxID без записи status пустой (NA),
+        поэтому проверять новые записи нужно через pd.isna, а не "is None".
+        Таблица всей истории строится один раз на ревизию, выборка делается через reindex.
+        """
+        frame = self._history_frame().reindex(tx_ids.to_numpy())
+        frame.index = tx_ids.index
+        frame['attempt'] = frame['attempt'].fillna(0)
+        frame['last_attempt_time'] = frame['last_attempt_time'].fillna(0)
+        return frame
+
+    def _history_frame(self) -> pd.DataFrame:
+        """Таблица истории (индекс — TxID), закешированная до следующего изменения."""
+        cached = self._frame_cache
+        if cached is None or cached[0] != self.revision:
+            frame = pd.DataFrame.from_dict(self, orient='index') if self else pd.DataFrame()
+            frame = frame.reindex(columns=STATUS_COLUMNS).astype(object)
+            frame['attempt'] = pd.to_numeric(frame['attempt'], errors='coerce')
+            frame['last_attempt_time'] = pd.to_numeric(frame['last_attempt_time'], errors='coerce')
+            frame['next_attempt_at'] = pd.to_numeric(frame['next_attempt_at'], errors='coerce')
+            cached = (self.revision, frame)
+            self._frame_cache = cached
+        return cached[1]
+
+    def evict_to(self, max_size: int) -> List[str]:
+        """Удаляет записи с наименьшим приоритетом, пока размер больше max_size. Возвращает удаленные TxID."""
+        removed = []
+        while len(self) > max_size and self._heap:
+            _, version, key = heapq.heappop(self._heap)
+            if self._versions.get(key) == version:
+                super().__delitem__(key)
+                del self._versions[key]
+                removed.append(key)
+        if removed:
+            self.revision += 1
+        return removed
+
+    def _compact(self) -> None:
+        """Перестраивает кучу без устаревших версий (амортизированно O(1) на изменение)."""
+        self._heap = [(self._priority_key(value), self._versions[key], key) for key, value in self.items()]
+        heapq.heapify(self._heap)
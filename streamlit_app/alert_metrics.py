@@ -0,0 +1,112 @@
+# Задержки конвейера алертов: от времени транзакции до доставки в Telegram
+import bisect
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+import numpy as np
+
+MAX_SAMPLES = 10000 # Сколько последних замеров каждого интервала хранить для перцентилей
+HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600) # Верхние границы, сек
+PERCENTILES = (50, 90, 99)
+
+# Этапы: transaction — "Время" транзакции, fetched — получение выборки из API, queued — передача в пул отправки,
+# dispatched — начало последней попытки отправки, sent — успешная доставка
+INTERVALS = (
+    ('detection', 'transaction', 'fetched', 'Транзакция → получение'),
+    ('queueing', 'fetched', 'queued', 'Получение → очередь'),
+    ('dispatch', 'queued', 'dispatched', 'Очередь → отправка'),
+    ('delivery', 'dispatched', 'sent', 'Отправка → доставка'),
+    ('end_to_end', 'transaction', 'sent', 'Транзакция → доставка'),
+)
+
+
+class AlertLatencyMetrics:
+    """
+    Гистограммы и перцентили задержек между этапами доставленных алертов. Гистограммы считают
+    все замеры с запуска процесса, перцентили — по последним MAX_SAMPLES замерам интервала.
+    Неудачные попытки отправки задержек не дают (алерт еще не доставлен) и только подсчитываются.
+    """
+
+    def __init__(self, max_samples: int = MAX_SAMPLES):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {name: deque(maxlen=max_samples) for name, _, _, _ in INTERVALS}
+        self._bucket_counts: Dict[str, List[int]] = {name: [0] * (len(HISTOGRAM_BUCKETS) + 1) for name, _, _, _ in INTERVALS}
+        self._failures = 0
+        self._started_at = time.time()
+
+    def record(self, timestamps: Dict[str, Optional[float]], success: bool = True) -> None:
+        """
+        Записывает задержки доставленного алерта по отметкам этапов (отсутствующие этапы пропускаются);
+        неудачная попытка (success=False) лишь увеличивает счетчик неудач.
+        """
+        with self._lock:
+            if not success:
+                self._failures += 1
+                return
+            for name, start, end, _ in INTERVALS:
+                if timestamps.get(start) is None or timestamps.get(end) is None:
+                    continue
+                # "Время" транзакции и часы сервера могут немного расходиться — отрицательное считаем нулем
+                duration = max(float(timestamps[end]) - float(timestamps[start]), 0.0)
+                self._samples[name].append(duration)
+                self._bucket_counts[name][bisect.bisect_left(HISTOGRAM_BUCKETS, duration)] += 1
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Строка на интервал: количество замеров, среднее, перцентили и максимум (сек)."""
+        rows = []
+        with self._lock:
+            for name, _, _, label in INTERVALS:
+                samples = np.fromiter(self._samples[name], dtype=float)
+                row: Dict[str, Any] = {'interval': name, 'label': label, 'count': sum(self._bucket_counts[name])}
+                if samples.size:
+                    row['mean'] = float(samples.mean())
+                    for p, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+                        row[f'p{p}'] = float(value)
+                    row['max'] = float(samples.max())
+                rows.append(row)
+        return rows
+
+    def failure_count(self) -> int:
+        """Число неудачных попыток отправки алертов с отметками этапов с запуска процесса."""
+        with self._lock:
+            return self._failures
+
+    def histogram(self, interval: str) -> List[Dict[str, Any]]:
+        """
+        Гистограмма интервала: [{'bucket': "06. ≤ 5 сек", 'count': N}, ...] с последним ведром "> 3600 сек".
+        Номер в подписи сохраняет порядок ведер при сортировке подписей (например, в st.bar_chart).
+        """
+        with self._lock:
+            counts = list(self._bucket_counts[interval])
+        labels = [f"≤ {bound:g} сек" for bound in HISTOGRAM_BUCKETS] + [f"> {HISTOGRAM_BUCKETS[-1]:g} сек"]
+        labels = [f"{i + 1:02d}. {label}" for i, label in enumerate(labels)]
+        return [{'bucket': label, 'count': count} for label, count in zip(labels, counts)]
+
+    def export_json(self) -> str:
+        """Сводка, гистограммы и последние замеры в JSON для выгрузки."""
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+        return json.dumps({
+            'started_at': self._started_at,
+            'exported_at': time.time(),
+            'failed_attempts': self.failure_count(),
+            'histogram_buckets': list(HISTOGRAM_BUCKETS),
+            'summary': self.summary(),
+            'histograms': {name: self.histogram(name) for name, _, _, _ in INTERVALS},
+            'samples': samples
+        }, ensure_ascii=False)
+
+
+_metrics: Optional[AlertLatencyMetrics] = None
+_metrics_lock = threading.Lock()
+
+def get_latency_metrics() -> AlertLatencyMetrics:
+    """Возвращает общий для процесса сборщик задержек алертов."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = AlertLatencyMetrics()
+        return _metrics
@@ -0,0 +1,203 @@
+# Надежная очередь исходящих алертов (SQLite, WAL), переживающая перезапуск сервера
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+DEFAULT_OUTBOX_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'alert_outbox.sqlite3')
+OUTBOX_RETENTION_SECONDS = 7 * 86400 # Сколько хранить завершенные записи (success/error)
+OUTBOX_FILE_MODE = 0o600 # В файле chat_id и тексты алертов: доступ только владельцу процесса
+
+# Статусы совпадают со статусами alert_history в app.py
+STATUS_QUEUED = 'queued'
+STATUS_SENDING = 'sending'
+STATUS_PENDING = 'pending'
+STATUS_SUCCESS = 'success'
+STATUS_ERROR = 'error'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    chat_id TEXT NOT NULL,
+    tx_hash TEXT NOT NULL,
+    bot_ref TEXT NOT NULL,
+    message_html TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    original_timestamp TEXT,
+    digest_json TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    sent_time REAL,
+    next_attempt_at REAL,
+    PRIMARY KEY (chat_id, tx_hash)
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status);
+"""
+
+
+# ---- Ссылки на токены ботов: сами токены на диск не пишутся ----
+
+_bot_tokens: Dict[str, str] = {}
+_bot_tokens_lock = threading.Lock()
+
+def bot_token_ref(bot_token: str) -> str:
+    """Ссылка на токен бота для outbox: хеш, по которому токен нельзя восстановить."""
+    return "sha256:" + hashlib.sha256(bot_token.encode('utf-8')).hexdigest()
+
+def register_bot_token(bot_token: str) -> str:
+    """Запоминает токен в памяти процесса, чтобы задачи из outbox можно было отправить. Возвращает ссылку."""
+    ref = bot_token_ref(bot_token)
+    with _bot_tokens_lock:
+        _bot_tokens[ref] = bot_token
+    return ref
+
+def resolve_bot_token(ref: str) -> Optional[str]:
+    """Токен по ссылке или None, если ни одна сессия этого процесса еще не передавала такой токен."""
+    with _bot_tokens_lock:
+        return _bot_tokens.get(ref)
+
+
+class AlertOutbox:
+    """
+    Журнал исходящих алертов с атомарными переходами статусов queued -> sending -> success/pending/error.
+    Запись с ключом (chat_id, tx_hash) одна, поэтому уже отправленный или отправляемый алерт
+    не будет поставлен в очередь повторно, а незавершенные отправки восстанавливаются при старте.
+    Вместо токена бота хранится ссылка на него (bot_token_ref): восстановленную задачу можно отправить,
+    когда токен снова зарегистрирован в процессе (register_bot_token).
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        for file_path in (path, f"{path}-wal", f"{path}-shm"):
+            try:
+                if os.path.exists(file_path):
+                    os.chmod(file_path, OUTBOX_FILE_MODE)
+            except OSError as e:
+                print(f"Warning: could not restrict permissions of {file_path}: {e}")
+
+    def enqueue(self, task: Dict[str, Any]) -> bool:
+        """
+        Атомарно ставит алерт в очередь. Возвращает False, если алерт для этого чата уже
+        в очереди, отправляется или успешно отправлен (повторно ставить его не нужно).
+        """
+        now = time.time()
+        params = (
+            str(task['chat_id']), str(task['tx_hash']), register_bot_token(task['bot_token']), task['message_html'],
+            task.get('attempt_number', 1),
+            None if task.get('original_timestamp') is None else str(task.get('original_timestamp')),
+            json.dumps(task.get('digest')) if task.get('digest') else None,
+            now, now
+        )
+        with self._lock:
+            # Один UPSERT-оператор: вставка новой записи или перевод pending/error -> queued атомарны
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (chat_id, tx_hash, bot_ref, message_html, status, attempt, original_timestamp, digest_json, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?) "
+                "ON CONFLICT(chat_id, tx_hash) DO UPDATE SET "
+                "status = 'queued', bot_ref = excluded.bot_ref, message_html = excluded.message_html, "
+                "attempt = excluded.attempt, digest_json = excluded.digest_json, updated_at = excluded.updated_at, next_attempt_at = NULL "
+                "WHERE outbox.status IN ('pending', 'error')",
+                params
+            )
+            return cursor.rowcount == 1
+
+    def mark_sending(self, chat_id: str, tx_hash: str) -> None:
+        self._transition(chat_id, tx_hash, STATUS_SENDING, allowed_from=(STATUS_QUEUED, STATUS_SENDING))
+
+    def mark_result(self, chat_id: str, tx_hash: str, status: str, attempt: int, next_attempt_at: Optional[float] = None) -> None:
+        """
+        Фиксирует итог попытки: success, pending (будет повтор) или error (попытки исчерпаны).
+        Для pending next_attempt_at — время (эпоха) запланированного повтора.
+        """
+        self._transition(chat_id, tx_hash, status, allowed_from=(STATUS_QUEUED, STATUS_SENDING), attempt=attempt, next_attempt_at=next_attempt_at)
+
+    def _transition(
+        self, chat_id: str, tx_hash: str, status: str, allowed_from: Iterable[str],
+        attempt: Optional[int] = None, next_attempt_at: Optional[float] = None
+    ) -> None:
+        now = time.time()
+        allowed = tuple(allowed_from)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE outbox SET status = ?, updated_at = ?, attempt = COALESCE(?, attempt), next_attempt_at = ?, "
+                f"sent_time = CASE WHEN ? = 'success' THEN ? ELSE sent_time END "
+                f"WHERE chat_id = ? AND tx_hash = ? AND status IN ({', '.join('?' for _ in allowed)})",
+                (status, now, attempt, next_attempt_at, status, now, str(chat_id), str(tx_hash)) + allowed
+            )
+
+    def recover(self) -> List[Dict[str, Any]]:
+        """
+        Возвращает задачи, прерванные перезапуском: queued и sending (отправка, оборвавшаяся на середине,
+        повторяется — доставка "почти ровно один раз") и pending с запланированным повтором.
+        У задач повтора attempt_number — номер следующей попытки, next_attempt_at — ее время.
+        bot_token — токен по ссылке bot_ref или None, если токен в процессе еще не зарегистрирован.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+            rows = self._conn.execute(
+                "SELECT chat_id, tx_hash, bot_ref, message_html, status, attempt, original_timestamp, digest_json, next_attempt_at "
+                "FROM outbox WHERE status = 'queued' OR (status = 'pending' AND next_attempt_at IS NOT NULL) ORDER BY created_at"
+            ).fetchall()
+        return [{
+            'chat_id': chat_id,
+            'tx_hash': tx_hash,
+            'bot_ref': bot_ref,
+            'bot_token': resolve_bot_token(bot_ref),
+            'message_html': message_html,
+            'attempt_number': attempt + 1 if status == STATUS_PENDING else attempt,
+            'original_timestamp': original_timestamp,
+            'digest': json.loads(digest_json) if digest_json else None,
+            'next_attempt_at': next_attempt_at if status == STATUS_PENDING else None
+        } for chat_id, tx_hash, bot_ref, message_html, status, attempt, original_timestamp, digest_json, next_attempt_at in rows]
+
+    def get_entries(self, chat_id: str, tx_hashes: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Текущие записи outbox для набора TxID одного чата (для сверки истории сессии)."""
+        tx_hashes = [str(tx) for tx in tx_hashes]
+        result: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for start in range(0, len(tx_hashes), 500): # Ограничение SQLite на число параметров
+                chunk = tx_hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT tx_hash, status, attempt, updated_at, sent_time, next_attempt_at FROM outbox "
+                    f"WHERE chat_id = ? AND tx_hash IN ({', '.join('?' for _ in chunk)})",
+                    (str(chat_id),) + tuple(chunk)
+                ).fetchall()
+                for tx_hash, status, attempt, updated_at, sent_time, next_attempt_at in rows:
+                    result[tx_hash] = {
+                        'status': status, 'attempt': attempt, 'last_attempt_time': updated_at,
+                        'sent_time': sent_time, 'next_attempt_at': next_attempt_at
+                    }
+        return result
+
+    def prune(self) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM outbox WHERE status IN ('success', 'error') AND updated_at < ?",
+                (time.time() - OUTBOX_RETENTION_SECONDS,)
+            )
+
+
+_outbox: Optional[AlertOutbox] = None
+_outbox_lock = threading.Lock()
+
+def get_outbox() -> Optional[AlertOutbox]:
+    """Возвращает outbox процесса (путь задается ARKHAM_ALERT_OUTBOX_PATH) или None, если его не удалось открыть."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            path = os.getenv("ARKHAM_ALERT_OUTBOX_PATH") or DEFAULT_OUTBOX_PATH
+            try:
+                _outbox = AlertOutbox(path)
+                _outbox.prune()
+            except Exception as e:
+                print(f"Error opening alert outbox at {path}: {e}")
+                return None
+        return _outbox
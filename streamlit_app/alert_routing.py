@@ -0,0 +1,96 @@
+# Маршрутизация алертов: какие строки выборки отправлять каким получателям (чатам)
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+import alert_rules
+
+MAIN_DESTINATION = 'main' # Основной чат из настроек (telegram_bot_token/telegram_chat_id)
+
+
+def parse_destinations(raw_json: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Разбирает таблицу маршрутизации из настроек: JSON-список объектов
+    {"name": ..., "chat_id": ..., "bot_token_env": (необязательно), "rule": {...}}.
+    Сам токен бота в JSON не указывается: таблица сохраняется в localStorage, поэтому получатель
+    ссылается на переменную окружения сервера с токеном (bot_token_env).
+    Возвращает (получатели, текст ошибки или None). При ошибке список получателей пуст.
+    Разбор закеширован по тексту настройки; каждый вызов получает свои копии записей.
+    """
+    entries, error = _parse_destinations_cached(raw_json or '')
+    if error:
+        return [], error
+    destinations: List[Dict[str, Any]] = []
+    for entry in entries:
+        bot_token = None
+        if entry['bot_token_env']:
+            bot_token = (os.getenv(entry['bot_token_env']) or '').strip() or None
+            if not bot_token:
+                return [], f"Получатель '{entry['name']}': переменная окружения {entry['bot_token_env']} не задана."
+        destinations.append(dict(entry, bot_token=bot_token))
+    return destinations, None
+
+
+@lru_cache(maxsize=32)
+def _parse_destinations_cached(raw_json: str) -> Tuple[Tuple[Dict[str, Any], ...], Optional[str]]:
+    if not raw_json.strip():
+        return (), None
+    try:
+        entries = json.loads(raw_json)
+    except json.JSONDecodeError as e:
+        return (), f"Некорректный JSON: {e}"
+    if not isinstance(entries, list):
+        return (), "Ожидается JSON-список получателей."
+
+    destinations: List[Dict[str, Any]] = []
+    seen_names = {MAIN_DESTINATION}
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            return (), f"Получатель #{i + 1}: ожидается объект."
+        name = str(entry.get('name') or '').strip()
+        chat_id = str(entry.get('chat_id') or '').strip()
+        if not name or not chat_id:
+            return (), f"Получатель #{i + 1}: нужны поля name и chat_id."
+        if name in seen_names:
+            return (), f"Получатель #{i + 1}: имя '{name}' уже используется."
+        if 'bot_token' in entry:
+            return (), f"Получатель '{name}': токен бота нельзя хранить в настройках, укажите bot_token_env — имя переменной окружения с токеном."
+        rule = entry.get('rule') or {}
+        try:
+            alert_rules.compile_rule(rule)
+        except ValueError as e:
+            return (), f"Получатель '{name}': {e}."
+        seen_names.add(name)
+        destinations.append({
+            'name': name,
+            'chat_id': chat_id,
+            'bot_token_env': str(entry.get('bot_token_env') or '').strip() or None,
+            'rule': rule
+        })
+    return tuple(destinations), None
+
+
+def parse_rule(raw_json: str) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Разбирает и проверяет JSON-правило (пустая строка — правило без ограничений)."""
+    if not raw_json or not raw_json.strip():
+        return {}, None
+    try:
+        rule = json.loads(raw_json)
+        alert_rules.compile_rule(rule)
+    except json.JSONDecodeError as e:
+        return {}, f"Некорректный JSON: {e}"
+    except ValueError as e:
+        return {}, f"Ошибка в правиле: {e}"
+    return rule, None
+
+
+def route_transactions(transactions_df: pd.DataFrame, destinations: List[Dict[str, Any]]) -> Dict[str, pd.Series]:
+    """
+    Вычисляет маску строк для каждого получателя: колонки выборки готовятся один раз,
+    затем каждое правило — несколько векторных операций. Получатель без правила получает все строки.
+    """
+    compiled = {d['name']: alert_rules.compile_rule(d.get('rule') or {}) for d in destinations}
+    return alert_rules.evaluate_rules(transactions_df, compiled)
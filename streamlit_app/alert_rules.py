@@ -0,0 +1,144 @@
+# Декларативные правила алертов, компилируемые в векторные маски pandas
+import re
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+CEX_PATTERN = re.compile(r'\bcex\b', flags=re.IGNORECASE) # Так же CEX выделяется в сообщениях Telegram
+DIRECTIONS = ('any', 'cex_inflow', 'cex_outflow')
+RULE_KEYS = (
+    'min_usd', 'token_usd_thresholds', 'token_symbols', 'networks', 'direction',
+    'include_entities', 'exclude_entities', 'from_address_names', 'to_address_names', 'cex_entities'
+)
+
+CompiledRule = Callable[['RuleContext'], np.ndarray]
+
+
+def usd_values(transactions_df: pd.DataFrame) -> pd.Series:
+    """Колонка USD как числа (строки вида "$1,234,567" тоже разбираются)."""
+    if 'USD' not in transactions_df.columns:
+        return pd.Series(float('nan'), index=transactions_df.index)
+    values = transactions_df['USD']
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float)
+    cleaned = values.astype(str).str.replace(r'[^0-9.eE+\-]', '', regex=True)
+    return pd.to_numeric(cleaned, errors='coerce')
+
+
+class RuleContext:
+    """
+    Колонки выборки, подготовленные один раз для всех правил: USD как числа, символы и сети
+    в нижнем регистре, сущности отправителя/получателя и признак CEX. Признак CEX для набора
+    имен (cex_entities) вычисляется лениво и кешируется.
+    """
+
+    def __init__(self, transactions_df: pd.DataFrame):
+        self.size = len(transactions_df)
+        self.usd = usd_values(transactions_df).to_numpy(dtype=float, na_value=np.nan)
+        self.symbol = self._lower(transactions_df, 'Символ')
+        self.network = self._lower(transactions_df, 'Сеть')
+        self.from_entity = self._lower(transactions_df, 'Откуда')
+        self.to_entity = self._lower(transactions_df, 'Куда')
+        self.from_is_cex = self._matches_cex(self.from_entity)
+        self.to_is_cex = self._matches_cex(self.to_entity)
+        self._cex_cache: Dict[Any, Any] = {}
+
+    @staticmethod
+    def _lower(transactions_df: pd.DataFrame, column: str) -> pd.Series:
+        if column not in transactions_df.columns:
+            return pd.Series('', index=transactions_df.index, dtype=object)
+        return transactions_df[column].fillna('').astype(str).str.strip().str.lower()
+
+    @staticmethod
+    def _matches_cex(entities: pd.Series) -> np.ndarray:
+        return entities.str.contains(CEX_PATTERN, regex=True).to_numpy(dtype=bool)
+
+    def cex_flags(self, cex_entities: frozenset):
+        """(отправитель — CEX, получатель — CEX) с учетом дополнительного списка бирж правила."""
+        if not cex_entities:
+            return self.from_is_cex, self.to_is_cex
+        flags = self._cex_cache.get(cex_entities)
+        if flags is None:
+            flags = (
+                self.from_is_cex | self.from_entity.isin(cex_entities).to_numpy(),
+                self.to_is_cex | self.to_entity.isin(cex_entities).to_numpy()
+            )
+            self._cex_cache[cex_entities] = flags
+        return flags
+
+
+def _name_set(rule: Dict[str, Any], key: str) -> frozenset:
+    values = rule.get(key) or []
+    if isinstance(values, str) or not isinstance(values, (list, tuple, set)):
+        raise ValueError(f"{key}: ожидается список")
+    return frozenset(str(v).strip().lower() for v in values)
+
+
+def compile_rule(rule: Dict[str, Any]) -> CompiledRule:
+    """
+    Проверяет правило и компилирует его в функцию RuleContext -> булев массив строк. Поля правила
+    (все необязательные, объединяются через И):
+      min_usd — общий порог USD; token_usd_thresholds — пороги по токенам ({"BTC": 5e6, "*": 1e6}),
+      перекрывают min_usd для своих токенов; token_symbols, networks — допустимые токены/сети;
+      direction — any / cex_inflow (в CEX из не-CEX) / cex_outflow (из CEX в не-CEX);
+      include_entities / exclude_entities — сущности, которые должны / не должны быть на одной из сторон;
+      from_address_names / to_address_names — точные имена отправителя/получателя;
+      cex_entities — дополнительные имена, считающиеся CEX.
+    Ошибки описания правила — ValueError с понятным сообщением.
+    """
+    if not isinstance(rule, dict):
+        raise ValueError("правило должно быть объектом")
+    unknown_keys = set(rule) - set(RULE_KEYS)
+    if unknown_keys:
+        raise ValueError(f"неизвестные поля правила {sorted(unknown_keys)}")
+
+    try:
+        min_usd = float(rule.get('min_usd') or 0)
+        thresholds = {str(k).strip().lower(): float(v) for k, v in (rule.get('token_usd_thresholds') or {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError("min_usd и token_usd_thresholds должны быть числами")
+    default_threshold = thresholds.pop('*', min_usd)
+    tokens = _name_set(rule, 'token_symbols')
+    networks = _name_set(rule, 'networks')
+    include_entities = _name_set(rule, 'include_entities')
+    exclude_entities = _name_set(rule, 'exclude_entities')
+    from_names = _name_set(rule, 'from_address_names')
+    to_names = _name_set(rule, 'to_address_names')
+    cex_entities = _name_set(rule, 'cex_entities')
+    direction = str(rule.get('direction') or 'any').lower()
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction: одно из {list(DIRECTIONS)}")
+
+    def evaluate(ctx: RuleContext) -> np.ndarray:
+        mask = np.ones(ctx.size, dtype=bool)
+        if thresholds:
+            # Порог каждой строки по ее токену; NaN в USD никогда не проходит порог
+            row_thresholds = ctx.symbol.map(thresholds).fillna(default_threshold).to_numpy(dtype=float)
+            mask &= ctx.usd >= row_thresholds
+        elif default_threshold:
+            mask &= ctx.usd >= default_threshold
+        if tokens:
+            mask &= ctx.symbol.isin(tokens).to_numpy()
+        if networks:
+            mask &= ctx.network.isin(networks).to_numpy()
+        if from_names:
+            mask &= ctx.from_entity.isin(from_names).to_numpy()
+        if to_names:
+            mask &= ctx.to_entity.isin(to_names).to_numpy()
+        if include_entities:
+            mask &= (ctx.from_entity.isin(include_entities) | ctx.to_entity.isin(include_entities)).to_numpy()
+        if exclude_entities:
+            mask &= ~(ctx.from_entity.isin(exclude_entities) | ctx.to_entity.isin(exclude_entities)).to_numpy()
+        if direction != 'any':
+            from_is_cex, to_is_cex = ctx.cex_flags(cex_entities)
+            mask &= (to_is_cex & ~from_is_cex) if direction == 'cex_inflow' else (from_is_cex & ~to_is_cex)
+        return mask
+
+    return evaluate
+
+
+def evaluate_rules(transactions_df: pd.DataFrame, rules: Dict[str, CompiledRule]) -> Dict[str, pd.Series]:
+    """Применяет набор скомпилированных правил к выборке за один проход подготовки колонок."""
+    ctx = RuleContext(transactions_df)
+    return {name: pd.Series(rule(ctx), index=transactions_df.index) for name, rule in rules.items()}
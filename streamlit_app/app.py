@@ -5,10 +5,19 @@ import pandas as pd
 import os
 import time # Добавляем импорт time
 import threading # Добавляем импорт threading
-from collections import deque # Добавляем импорт deque
 from dotenv import load_dotenv
 import arkham_service # Модуль с логикой Arkham
 import telegram_service # НОВЫЙ импорт для Telegram
+import polling_service # Фоновый опрос Arkham вне цикла перезапусков
+import alert_dispatcher # Пул потоков отправки алертов
+import telegram_async # Asyncio-доставка Telegram (необязательный aiohttp)
+import alert_outbox # Надежная очередь алертов на диске
+import alert_claims # Общий для сессий индекс захватов алертов (дедупликация по чату и TxID)
+import alert_history # История алертов с ротацией по приоритету
+import alert_metrics # Задержки конвейера алертов
+import alert_routing # Маршрутизация алертов по получателям
+import transaction_store # Локальное хранилище транзакций
+import settings_persistence # Сохранение настроек по разделам с отслеживанием изменений
 from typing import List, Dict, Any, Tuple, Optional, Set # Нужен typing для подсказок типов
 from streamlit_local_storage import LocalStorage
 import json
@@ -20,7 +29,6 @@ WHITELIST_KEYS = [
     'limit_query_input',
     'auto_refresh_enabled', 'auto_refresh_interval',
     'cache_initialized_flag', 'known_tokens', 'known_addresses',
-    'detailed_token_info', 'detailed_address_info',
     'api_key_loaded', 'error_message', 'api_params_debug',
     'initialized',
     # Новые ключи для Telegram
@@ -28,23 +36,57 @@ WHITELIST_KEYS = [
     'telegram_alerts_enabled',
     'alert_history',
     'telegram_bot_token', # Новый ключ для токена
+    'telegram_digest_enabled', 'telegram_digest_threshold', 'telegram_digest_window',
+    'telegram_destinations_json', 'destination_histories', # Дополнительные получатели и их истории
+    'telegram_main_rule_json', # Правило алертов основного чата
     'alert_history_updated_by_thread' # Новый флаг
 ]
 
+# Крупные разделы настроек хранятся под отдельными ключами localStorage и пишутся только при изменении,
+# не чаще SETTINGS_SAVE_DEBOUNCE; остальные (мелкие) настройки — под прежним ключом app_settings_storage.
+# Отложенные изменения дописывает любой полный запуск скрипта после окна, а без действий пользователя —
+# перезапуск из фрагмента _render_live_updates (окно + до LIVE_UPDATES_CHECK_SECONDS). Если вкладку закрыть
+# раньше, изменения последнего окна теряются: списки Arkham восстановятся из кеша, а записи истории алертов,
+# оставшиеся 'queued'/'sending', после перезагрузки сверяются с outbox сервера
+ARKHAM_LISTS_KEYS = ['known_tokens', 'known_addresses']
+ALERT_HISTORY_KEYS = ['alert_history', 'destination_histories']
+SETTINGS_SAVE_DEBOUNCE = 5 # Сек
+SETTINGS_SECTIONS = [
+    ("app_settings_storage", [k for k in WHITELIST_KEYS if k not in ARKHAM_LISTS_KEYS + ALERT_HISTORY_KEYS], False, 0),
+    ("app_settings_arkham_lists", ARKHAM_LISTS_KEYS, True, SETTINGS_SAVE_DEBOUNCE),
+    ("app_settings_alert_history", ALERT_HISTORY_KEYS, True, SETTINGS_SAVE_DEBOUNCE),
+]
+
 localS = LocalStorage()
 
 APP_MAX_ALERT_ATTEMPTS = 5
+ALERT_HISTORY_MAX_SIZE = 10000 # Ротация дешевая, поэтому размер ограничен лишь объемом localStorage
+# Повторы неудачных отправок планирует пул (alert_dispatcher) с экспоненциальной задержкой. Конвейер сессии
+# повторяет лишь "осиротевшие" pending/error (пул о них не знает) через ALERT_RETRY_INTERVAL, а записи
+# с запланированным пулом повтором (next_attempt_at) — не раньше чем через SCHEDULED_RETRY_GRACE после него
+ALERT_RETRY_INTERVAL = 60 # Сек
+OUTBOX_RECONCILE_AFTER = 30 # Сек; записи 'queued'/'sending' старше этого сверяются с outbox
+LIVE_UPDATES_CHECK_SECONDS = 2 # Как часто фрагмент проверяет новые снимки поллера и статусы алертов
+
+def _get_script_run_ctx():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        return get_script_run_ctx()
+    except ImportError:
+        return None
+
+def _get_session_id() -> Optional[str]:
+    ctx = _get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
 
 def initialize_session_state():
     # Эти состояния нужны всегда, независимо от 'initialized'
-    if 'alert_queue' not in st.session_state: # Очередь пока оставляем, но ее роль может измениться
-        st.session_state.alert_queue = deque()
-    if 'is_sending_alert' not in st.session_state: # Новый флаг для контроля одновременной отправки
-        st.session_state.is_sending_alert = False
-    if 'dispatch_completed_trigger_rerun' not in st.session_state: # Новый флаг
-        st.session_state.dispatch_completed_trigger_rerun = False
+    if 'alert_history_lock' not in st.session_state: # История алертов обновляется и из потоков пула отправки
+        st.session_state.alert_history_lock = threading.RLock()
     if 'alert_history_updated_by_thread' not in st.session_state: # Инициализация нового флага
         st.session_state.alert_history_updated_by_thread = False
+    if 'poll_snapshot_seq' not in st.session_state: # Номер последнего примененного снимка фонового поллера
+        st.session_state.poll_snapshot_seq = 0
 
     if 'initialized' not in st.session_state: # Этот блок для состояний, которые могут загружаться из localStorage
         dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env') 
@@ -58,8 +100,7 @@ def initialize_session_state():
         st.session_state.known_tokens = []
         st.session_state.known_addresses = []
         st.session_state.transactions_df = pd.DataFrame() 
-        st.session_state.detailed_token_info = {}
-        st.session_state.detailed_address_info = {}
+        st.session_state.arkham_cache_version = 0 # Растет при смене списков кеша; по нему пересчитываются детали кеша
         st.session_state.lookback_cache_input = '7d'
         st.session_state.min_usd_cache_input = 10000.0 
         st.session_state.limit_cache_input = 1000
@@ -73,8 +114,14 @@ def initialize_session_state():
         st.session_state.auto_refresh_interval = 60
         st.session_state.telegram_chat_id = ''
         st.session_state.telegram_alerts_enabled = False
-        st.session_state.alert_history = {}
+        st.session_state.alert_history = _new_alert_history()
         st.session_state.telegram_bot_token = ''
+        st.session_state.telegram_digest_enabled = False
+        st.session_state.telegram_digest_threshold = 5
+        st.session_state.telegram_digest_window = 10
+        st.session_state.telegram_destinations_json = ''
+        st.session_state.telegram_main_rule_json = ''
+        st.session_state.destination_histories = {}
         
         st.session_state.initialized = True
 
@@ -83,12 +130,13 @@ def initialize_session_state():
     if ('arkham_monitor' not in st.session_state or st.session_state.get('arkham_monitor') is None) and api_key_present:
         current_api_key = st.session_state.get('api_key') or os.getenv("ARKHAM_API_KEY")
         try:
-            st.session_state.arkham_monitor = arkham_service.create_monitor(current_api_key)
+            # Монитор общий для всех сессий процесса; фильтры каждой сессии хранятся в ее session_state
+            st.session_state.arkham_monitor = arkham_service.get_shared_monitor(current_api_key)
             if st.session_state.arkham_monitor is not None:
                 st.session_state.api_key_loaded = True
             else:
                 st.session_state.api_key_loaded = False
-                st.session_state.error_message = "Не удалось инициализировать Arkham Monitor (create_monitor вернул None)."
+                st.session_state.error_message = "Не удалось инициализировать Arkham Monitor (get_shared_monitor вернул None)."
         except Exception as e:
             st.session_state.arkham_monitor = None
             st.session_state.api_key_loaded = False
@@ -99,44 +147,64 @@ def initialize_session_state():
         if not st.session_state.get('error_message'):
              st.session_state.error_message = "ARKHAM_API_KEY не найден."
              
+def _get_settings_persistence() -> settings_persistence.SettingsPersistence:
+    if 'settings_persistence' not in st.session_state:
+        st.session_state.settings_persistence = settings_persistence.SettingsPersistence(SETTINGS_SECTIONS)
+    return st.session_state.settings_persistence
+
+def _write_local_storage(storage_key: str, payload: str):
+    # У каждого ключа свой key компонента: несколько разделов можно записать за один запуск
+    localS.setItem(storage_key, payload, key=f"set_{storage_key}")
+
 def load_app_settings():
     if "app_state_loaded" not in st.session_state:
         try:
-            raw_state = localS.getItem("app_settings_storage") # ИСПРАВЛЕНО: используем правильное имя ключа
-            if raw_state:
-                state_dict = json.loads(raw_state)
-                if state_dict.get("state_version") == 1:
-                    for k in WHITELIST_KEYS:
-                        if k in state_dict:
-                            if k == 'alert_history':
-                                try:
-                                    loaded_history = state_dict[k]
-                                    if isinstance(loaded_history, dict):
-                                        st.session_state[k] = loaded_history
-                                    else:
-                                        st.session_state[k] = {}
-                                except json.JSONDecodeError:
-                                    st.session_state[k] = {}
-                            else:
-                                st.session_state[k] = state_dict[k]
+            persistence = _get_settings_persistence()
+            state_dict = {}
+            clean_sections = []
+            # Прежние версии хранили все настройки в app_settings_storage; ключи разделов перекрывают их
+            for storage_key, section_keys, _, _ in SETTINGS_SECTIONS:
+                raw_state = localS.getItem(storage_key)
+                if not raw_state:
+                    continue
+                section_dict = json.loads(raw_state)
+                if section_dict.get("state_version") != 1:
+                    continue
+                state_dict.update(section_dict)
+                if set(section_dict) <= set(section_keys) | {"state_version"}:
+                    clean_sections.append(storage_key) # Раздел уже в новом формате — писать обратно не нужно
+            for k in WHITELIST_KEYS:
+                if k in state_dict:
+                    if k == 'alert_history':
+                        loaded_history = state_dict[k]
+                        if isinstance(loaded_history, dict):
+                            st.session_state[k] = _new_alert_history(loaded_history)
+                        else:
+                            st.session_state[k] = _new_alert_history()
+                    elif k == 'destination_histories':
+                        loaded_histories = state_dict[k] if isinstance(state_dict[k], dict) else {}
+                        st.session_state[k] = {
+                            name: _new_alert_history(entries) for name, entries in loaded_histories.items()
+                            if isinstance(entries, dict)
+                        }
+                    else:
+                        st.session_state[k] = state_dict[k]
+            present_keys = [k for k in WHITELIST_KEYS if k in st.session_state]
+            for storage_key in clean_sections:
+                persistence.mark_clean(storage_key, st.session_state.get, present_keys)
             st.session_state.app_state_loaded = True
         except Exception as e:
             # print(f"Error loading app settings from localStorage: {e}") # DEBUG
             st.session_state.app_state_loaded = True # Продолжаем работу, даже если настройки не загрузились
 
 def save_app_settings():
+    """
+    Записывает в localStorage только изменившиеся разделы настроек. Изменения крупных разделов
+    (списки Arkham, истории алертов) объединяются в одну запись за SETTINGS_SAVE_DEBOUNCE.
+    """
     try:
-        state_to_save = {k: st.session_state.get(k) for k in WHITELIST_KEYS if k in st.session_state}
-        for k in ['detailed_token_info', 'detailed_address_info']:
-            if k in state_to_save and isinstance(state_to_save[k], dict):
-                for subk, v in state_to_save[k].items():
-                    if isinstance(v, set):
-                        state_to_save[k][subk] = list(v)
-        state_to_save["state_version"] = 1
-        if 'alert_history' in state_to_save and not isinstance(state_to_save['alert_history'], dict):
-            state_to_save['alert_history'] = {}
-        # print(f"SAVING app_settings_storage: {json.dumps(state_to_save, ensure_ascii=False)[:200]}") # DEBUG
-        localS.setItem("app_settings_storage", json.dumps(state_to_save, ensure_ascii=False)) # Используем имя ключа как первый аргумент
+        present_keys = [k for k in WHITELIST_KEYS if k in st.session_state]
+        _get_settings_persistence().save(st.session_state.get, present_keys, _write_local_storage)
     except Exception as e:
         # print(f"Error saving app settings to localStorage: {e}") # DEBUG
         pass
@@ -151,16 +219,10 @@ def load_arkham_cache(arkham_monitor):
         raw_cache = localS.getItem("arkham_cache_storage") # ИСПРАВЛЕНО: используем правильное имя ключа
         if raw_cache:
             # print(f"LOADING arkham_alert_cache from localStorage. Size: {len(raw_cache)} bytes") # DEBUG
-            cache_dict = json.loads(raw_cache)
-            arkham_monitor.load_full_cache_state(cache_dict)
-            st.session_state.known_tokens = arkham_monitor.get_known_token_symbols()
-            st.session_state.known_addresses = arkham_monitor.get_known_address_names()
-            token_cache_data = cache_dict.get('token_cache', {})
-            address_cache_data = cache_dict.get('address_cache', {})
-            st.session_state.detailed_token_info = token_cache_data.get('symbol_to_ids', {})
-            st.session_state.detailed_address_info = address_cache_data.get('name_to_ids', {})
-            if st.session_state.detailed_token_info is None: st.session_state.detailed_token_info = {}
-            if st.session_state.detailed_address_info is None: st.session_state.detailed_address_info = {}
+            cache_dict = arkham_service.decode_cache_state(raw_cache, _get_cache_encoding_stats()) # Компактная кодировка или прежний JSON
+            # Общий монитор мог быть уже прогрет другой сессией; тогда его кеш актуальнее сохраненного в браузере
+            arkham_service.load_cache_state(arkham_monitor, cache_dict, only_if_empty=True)
+            _sync_known_lists(full=True)
             if st.session_state.known_tokens or st.session_state.known_addresses:
                 st.session_state.cache_initialized_flag = True
             else:
@@ -169,8 +231,14 @@ def load_arkham_cache(arkham_monitor):
             # print("Arkham cache loaded successfully from localStorage.") # DEBUG
         else:
             # print("No Arkham cache found in localStorage.") # DEBUG
-            st.session_state.cache_initialized_flag = False
-            st.session_state.arkham_cache_loaded = False
+            # Кеша в браузере нет, но общий монитор может быть уже прогрет другими сессиями
+            _sync_known_lists(full=True)
+            if st.session_state.known_tokens or st.session_state.known_addresses:
+                st.session_state.cache_initialized_flag = True
+                st.session_state.arkham_cache_loaded = True
+            else:
+                st.session_state.cache_initialized_flag = False
+                st.session_state.arkham_cache_loaded = False
     except Exception as e:
         # print(f"Error loading Arkham cache from localStorage: {e}") # DEBUG
         st.session_state.cache_initialized_flag = False
@@ -179,40 +247,142 @@ def load_arkham_cache(arkham_monitor):
 def save_arkham_cache(arkham_monitor):
     if arkham_monitor is not None:
         try:
-            cache_to_save = arkham_monitor.get_full_cache_state()
+            cache_to_save = arkham_service.get_cache_state(arkham_monitor)
             # print(f"SAVING arkham_cache_storage: {json.dumps(cache_to_save, ensure_ascii=False)[:200]}") # DEBUG
-            localS.setItem("arkham_cache_storage", json.dumps(cache_to_save, ensure_ascii=False)) # Используем имя ключа как первый аргумент
+            encoded_cache = arkham_service.encode_cache_state(cache_to_save, _get_cache_encoding_stats())
+            localS.setItem("arkham_cache_storage", encoded_cache, key="set_arkham_cache_storage")
         except Exception as e:
             # print(f"Error saving Arkham cache to localStorage: {e}") # DEBUG
             pass
 
-def save_alert_history(history: Dict[str, Dict[str, Any]]):
+def _get_cache_encoding_stats() -> Dict[str, Any]:
+    """Статистика кодирования кеша Arkham в localStorage этой сессии (размеры и время)."""
+    if 'arkham_cache_encoding_stats' not in st.session_state:
+        st.session_state.arkham_cache_encoding_stats = {}
+    return st.session_state.arkham_cache_encoding_stats
+
+def _set_known_lists(known_tokens: List[str], known_addresses: List[str], generation: Optional[int] = None):
+    """
+    Заменяет списки известных токенов и адресов сессии и сдвигает версию кеша для деталей кеша.
+    generation — поколение кеша монитора, которому соответствуют списки (None — неизвестно).
+    """
+    st.session_state.known_tokens = known_tokens
+    st.session_state.known_addresses = known_addresses
+    st.session_state.arkham_cache_generation = generation
+    st.session_state.arkham_cache_version = st.session_state.get('arkham_cache_version', 0) + 1
+
+def _sync_known_lists(full: bool = False) -> bool:
+    """
+    Дополняет списки сессии токенами и адресами, появившимися в кеше монитора после поколения сессии,
+    за O(новых элементов). full (или недоступная дельта) заменяет списки целиком.
+    Возвращает True, если списки изменились.
+    """
+    monitor = st.session_state.get('arkham_monitor')
+    if monitor is None:
+        return False
+    since_generation = None if full else st.session_state.get('arkham_cache_generation')
+    generation, new_tokens, new_addresses, is_full = arkham_service.get_cache_delta(monitor, since_generation)
+    if is_full:
+        _set_known_lists(new_tokens, new_addresses, generation)
+        return True
+    st.session_state.arkham_cache_generation = generation
+    if not new_tokens and not new_addresses:
+        return False
+    # Списки дополняются на месте; сохранение настроек замечает это по их длине
+    st.session_state.known_tokens.extend(new_tokens)
+    st.session_state.known_addresses.extend(new_addresses)
+    st.session_state.arkham_cache_version = st.session_state.get('arkham_cache_version', 0) + 1
+    return True
+
+def _get_cache_detail_views() -> Dict[str, Any]:
+    """
+    Таблицы вкладок "Известные Адреса"/"Известные Токены" и число связанных ID. Строятся при первом
+    обращении и запоминаются до смены версии кеша, поэтому обычные перезапуски их не пересчитывают.
+    """
+    version = st.session_state.get('arkham_cache_version', 0)
+    views = st.session_state.get('cache_detail_views')
+    if views is not None and views['version'] == version:
+        return views
+    monitor = st.session_state.get('arkham_monitor')
+    cache_state = arkham_service.get_cache_state(monitor) if monitor is not None else {}
+    address_ids = (cache_state.get('address_cache') or {}).get('name_to_ids') or {}
+    token_ids = (cache_state.get('token_cache') or {}).get('symbol_to_ids') or {}
+
+    def id_count(ids: Any) -> int:
+        return len(ids) if isinstance(ids, (list, tuple, set, frozenset)) else 0
+
+    known_addresses = st.session_state.get('known_addresses', [])
+    known_tokens = st.session_state.get('known_tokens', [])
+    address_counts = [id_count(address_ids.get(name)) for name in known_addresses]
+    token_counts = [id_count(token_ids.get(symbol)) for symbol in known_tokens]
+    views = {
+        'version': version,
+        'addresses_df': pd.DataFrame({"Адрес/Имя": known_addresses, "Кол-во связанных ID": address_counts}),
+        'tokens_df': pd.DataFrame({"Символ Токена": known_tokens, "Кол-во связанных ID": token_counts}),
+        'address_ids_total': sum(address_counts),
+        'token_ids_total': sum(token_counts)
+    }
+    st.session_state.cache_detail_views = views
+    return views
+
+def _new_alert_history(entries: Optional[Dict[str, Dict[str, Any]]] = None) -> alert_history.AlertHistoryStore:
+    return alert_history.AlertHistoryStore(entries, priority_key=_get_rotation_priority_key)
+
+def _get_destination_history(name: str) -> alert_history.AlertHistoryStore:
+    """История алертов получателя; история основного чата — st.session_state.alert_history."""
+    if name == alert_routing.MAIN_DESTINATION:
+        return st.session_state.alert_history
+    histories = st.session_state.destination_histories
+    history = histories.get(name)
+    if not isinstance(history, alert_history.AlertHistoryStore):
+        history = _new_alert_history(history if isinstance(history, dict) else None)
+        histories[name] = history
+    return history
+
+def _get_alert_destinations() -> List[Dict[str, Any]]:
+    """Основной чат из настроек и дополнительные получатели из таблицы маршрутизации."""
+    bot_token = st.session_state.get('telegram_bot_token', '')
+    chat_id = st.session_state.get('telegram_chat_id', '')
+    destinations = []
+    main_rule, main_rule_error = alert_routing.parse_rule(st.session_state.get('telegram_main_rule_json', ''))
+    if bot_token and chat_id and not main_rule_error: # С ошибочным правилом алерты чата приостановлены
+        destinations.append({'name': alert_routing.MAIN_DESTINATION, 'chat_id': chat_id, 'bot_token': bot_token, 'rule': main_rule})
+    extra_destinations, _ = alert_routing.parse_destinations(st.session_state.get('telegram_destinations_json', ''))
+    for destination in extra_destinations:
+        destination_bot_token = destination['bot_token'] or bot_token # По умолчанию бот основного чата
+        if destination_bot_token:
+            destinations.append(dict(destination, bot_token=destination_bot_token))
+    for destination in destinations:
+        # Outbox хранит только ссылки на токены: задачи, восстановленные после перезапуска, ждут токен от сессии
+        alert_dispatcher.register_bot_token(destination['bot_token'])
+    return destinations
+
+def save_alert_history(persist: bool = True):
+    """Ротирует истории алертов получателей (изменяются на месте) и сохраняет их в localStorage."""
     limit_q_input = st.session_state.get('limit_query_input', 50) 
-    max_history_size = 2 * limit_q_input # Увеличим немного, чтобы не так агрессивно удалять активные
-    
-    history_copy_for_saving = history.copy() # Работаем с копией для ротации
+    max_history_size = max(2 * limit_q_input, ALERT_HISTORY_MAX_SIZE)
 
-    if len(history_copy_for_saving) > max_history_size:
-        # print(f"SAVE_ALERT_HISTORY: History size {len(history_copy_for_saving)} > {max_history_size}. Rotating...") # DEBUG
-        sorted_keys_for_removal = sorted(
-            history_copy_for_saving.keys(),
-            key=lambda k: _get_rotation_priority_key(history_copy_for_saving[k])
-        )
-        num_to_remove = len(history_copy_for_saving) - max_history_size
-        hashes_to_remove = sorted_keys_for_removal[:num_to_remove]
-        
-        # print(f"SAVE_ALERT_HISTORY: Hashes to remove by rotation: {hashes_to_remove}") # DEBUG
-        for h_key in hashes_to_remove:
-            if h_key in history_copy_for_saving:
-                 # print(f"SAVE_ALERT_HISTORY: Removing {h_key} with priority {_get_rotation_priority_key(history_copy_for_saving[h_key])}") # DEBUG
-                 del history_copy_for_saving[h_key]
-    
-    # Обновляем alert_history в session_state ТОЛЬКО отротированной копией
-    st.session_state.alert_history = history_copy_for_saving 
-    # print(f"SAVE_ALERT_HISTORY: Alert history in session_state updated. Size: {len(st.session_state.alert_history)}. Triggering save_app_settings.") # DEBUG
+    history = st.session_state.alert_history
+    if not isinstance(history, alert_history.AlertHistoryStore):
+        history = _new_alert_history(history if isinstance(history, dict) else None)
+        st.session_state.alert_history = history
+    # Удаляются только лишние записи с наименьшим приоритетом, без сортировки всей истории
+    history.evict_to(max_history_size)
+    destinations, destinations_error = alert_routing.parse_destinations(st.session_state.get('telegram_destinations_json', ''))
+    destination_histories = st.session_state.get('destination_histories', {})
+    if not destinations_error: # Истории удаленных получателей больше не нужны
+        active_names = {d['name'] for d in destinations}
+        for name in [n for n in destination_histories if n not in active_names]:
+            del destination_histories[name]
+    for name in list(destination_histories):
+        _get_destination_history(name).evict_to(max_history_size)
     
     # save_app_settings() теперь будет использовать актуализированный st.session_state.alert_history
-    save_app_settings()
+    if persist:
+        save_app_settings()
+    else:
+        # Вызов из фонового потока: localStorage доступен только из запуска скрипта, сохранит main()
+        st.session_state.alert_history_updated_by_thread = True
 
 def handle_populate_cache_button():
     if st.session_state.arkham_monitor:
@@ -225,31 +395,14 @@ def handle_populate_cache_button():
             )
         if error:
             st.session_state.error_message = error
-            st.session_state.known_tokens = []
-            st.session_state.known_addresses = []
+            _set_known_lists([], [])
             st.session_state.cache_initialized_flag = False
-            st.session_state.detailed_token_info = {}
-            st.session_state.detailed_address_info = {}
         else:
-            st.session_state.known_tokens = tokens
-            st.session_state.known_addresses = addresses
+            _sync_known_lists(full=True)
             st.session_state.cache_initialized_flag = True
             st.session_state.error_message = None
             st.success(f"Кеш успешно обновлен. Загружено {len(tokens)} токенов и {len(addresses)} адресов.")
             if st.session_state.arkham_monitor:
-                try:
-                    full_cache_state = st.session_state.arkham_monitor.get_full_cache_state()
-                    st.session_state.detailed_token_info = full_cache_state.get('token_cache', {}).get('symbol_to_ids', {})
-                    st.session_state.detailed_address_info = full_cache_state.get('address_cache', {}).get('name_to_ids', {})
-                    if st.session_state.detailed_token_info is None: 
-                        st.session_state.detailed_token_info = {}
-                    if st.session_state.detailed_address_info is None: 
-                        st.session_state.detailed_address_info = {}
-                except Exception as e:
-                    st.warning(f"Ошибка при получении полного состояния кеша из монитора: {e}")
-                    st.session_state.detailed_token_info = {} 
-                    st.session_state.detailed_address_info = {}
-                
                 save_arkham_cache(st.session_state.arkham_monitor) # Сохраняем обновленный кеш Arkham
                 # print("_FETCH_AND_UPDATE_TABLE: Arkham cache saved.") # DEBUG
 
@@ -263,179 +416,381 @@ def handle_populate_cache_button():
 def handle_auto_refresh_toggle():
     pass
 
-def _process_telegram_alerts(transactions_df: pd.DataFrame):
+def _process_telegram_alerts(transactions_df: pd.DataFrame, persist: bool = True, fetched_at: Optional[float] = None):
+    """
+    Направляет выборку всем получателям: правила маршрутизации вычисляются один раз на DataFrame.
+    fetched_at — время получения выборки из API (для метрик задержек; по умолчанию — текущее).
+    """
     if not st.session_state.get('telegram_alerts_enabled', False):
         return
-    bot_token = st.session_state.get('telegram_bot_token', '')
-    chat_id = st.session_state.get('telegram_chat_id', '')
-    if not bot_token or not chat_id:
-        # print("_PROCESS_TELEGRAM_ALERTS: Bot token or chat_id missing. Skipping.") # DEBUG
+    destinations = _get_alert_destinations()
+    if not destinations or transactions_df.empty or 'TxID' not in transactions_df.columns:
+        # print("_PROCESS_TELEGRAM_ALERTS: No destinations, TxID or rows. Skipping.") # DEBUG
         return
+    routes = alert_routing.route_transactions(transactions_df, destinations)
+    message_cache: Dict[Any, Optional[str]] = {} # Сообщение строки форматируется один раз для всех получателей
+    fetched_at = fetched_at or time.time()
+    tasks_to_submit: List[Dict[str, Any]] = []
+    submitted_count = 0
+    try:
+        # История читается и пишется целиком, поэтому держим блокировку, пока потоки отправки ждут
+        with st.session_state.alert_history_lock:
+            history_updated = False
+            for destination in destinations:
+                destination_tasks, destination_updated = _queue_telegram_alerts(
+                    transactions_df[routes[destination['name']]], destination, message_cache, fetched_at
+                )
+                tasks_to_submit.extend(destination_tasks)
+                history_updated = history_updated or destination_updated
+            if history_updated:
+                # save_alert_history ротирует истории получателей и затем вызывает save_app_settings.
+                save_alert_history(persist=persist)
+        for task in tasks_to_submit:
+            _submit_alert_task(task)
+            submitted_count += 1
+    finally:
+        # Захваты задач, не переданных пулу из-за ошибки, отпускаем сразу, чтобы их могли забрать другие сессии;
+        # записи истории этой сессии останутся 'queued' и будут сверены через OUTBOX_RECONCILE_AFTER
+        for task in tasks_to_submit[submitted_count:]:
+            alert_claims.get_claim_index().release(task['chat_id'], [task['tx_hash']])
+
+def _format_alert_messages(candidates_df: pd.DataFrame, message_cache: Dict[Any, Optional[str]]) -> pd.Series:
+    if not candidates_df.index.is_unique:
+        return telegram_service.format_telegram_messages(candidates_df)
+    missing_df = candidates_df[~candidates_df.index.isin(list(message_cache))]
+    if not missing_df.empty:
+        message_cache.update(telegram_service.format_telegram_messages(missing_df).to_dict())
+    return pd.Series([message_cache[i] for i in candidates_df.index], index=candidates_df.index, dtype=object)
+
+def _queue_telegram_alerts(
+    transactions_df: pd.DataFrame,
+    destination: Dict[str, Any],
+    message_cache: Dict[Any, Optional[str]],
+    fetched_at: Optional[float] = None
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Отмечает в истории получателя новые/повторные алерты как 'queued'.
+    Возвращает (задачи для отправки, изменилась ли история). Вызывается под alert_history_lock.
+    """
+    tasks_to_submit: List[Dict[str, Any]] = []
+    if transactions_df.empty:
+        return tasks_to_submit, False
+    bot_token = destination['bot_token']
+    chat_id = destination['chat_id']
         
-    # Используем текущую историю из session_state, которая могла быть обновлена из localStorage
-    session_history = st.session_state.get('alert_history', {}).copy() # Работаем с копией для этого цикла
+    digest_settings = None
+    if st.session_state.get('telegram_digest_enabled', False):
+        digest_settings = {
+            'threshold': st.session_state.get('telegram_digest_threshold', 5),
+            'window': st.session_state.get('telegram_digest_window', 10)
+        }
+
+    # У каждого получателя своя история; изменяем ее на месте
+    session_history = _get_destination_history(destination['name'])
     history_updated_this_cycle = False
     current_time_for_check = time.time()
 
-    if 'TxID' not in transactions_df.columns or transactions_df.empty:
-        # print("_PROCESS_TELEGRAM_ALERTS: No TxID in df or df is empty. Skipping.") # DEBUG
-        return
+    # Обрабатываем от старых к новым; дубликаты TxID в окне ставятся в очередь один раз
+    transactions_df_to_process = transactions_df.iloc[::-1]
+    candidate_mask, history_view = _select_alert_candidates(transactions_df_to_process, session_history, current_time_for_check)
+    if not candidate_mask.any():
+        return tasks_to_submit, False
+    candidates_df = transactions_df_to_process[candidate_mask]
+    candidate_history = history_view[candidate_mask]
 
-    # print(f"_PROCESS_TELEGRAM_ALERTS: Processing {len(transactions_df)} transactions. Current history size: {len(session_history)}") # DEBUG
-    transactions_df_to_process = transactions_df.iloc[::-1] # Обрабатываем от старых к новым
+    # Общий для всех сессий индекс: каждый (чат, TxID) отправляет только захватившая его сессия,
+    # остальные отражают ее статус в своей истории и не формируют сообщение
+    candidate_txids = candidates_df['TxID'].astype(str)
+    attempt_numbers = {
+        tx: 1 if pd.isna(status) else int(attempts_done) + 1
+        for tx, status, attempts_done in zip(candidate_txids, candidate_history['status'], candidate_history['attempt'])
+    }
+    claim_index = alert_claims.get_claim_index()
+    claimed_attempts = claim_index.claim_many(chat_id, candidate_txids, attempt_numbers, APP_MAX_ALERT_ATTEMPTS)
+    if len(claimed_attempts) < len(candidate_txids):
+        lost_txids = [tx for tx in candidate_txids if tx not in claimed_attempts]
+        for tx_hash_str, claim_entry in claim_index.get_entries(chat_id, lost_txids).items():
+            session_history[tx_hash_str] = dict(session_history.get(tx_hash_str, {}), **claim_entry)
+        history_updated_this_cycle = True
+        claimed_mask = candidate_txids.isin(list(claimed_attempts))
+        candidates_df = candidates_df[claimed_mask]
+        candidate_history = candidate_history[claimed_mask]
+        if candidates_df.empty:
+            return tasks_to_submit, history_updated_this_cycle
 
-    for index, row in transactions_df_to_process.iterrows():
-        tx_hash = row.get('TxID')
-        if not tx_hash or pd.isna(tx_hash) or tx_hash == 'N/A':
-            continue
-        
-        tx_hash_str = str(tx_hash)
-        alert_info = session_history.get(tx_hash_str) # Проверяем в КОПИИ истории этого цикла
-        
-        should_queue_task = False 
-        current_attempt_number = 0
-        # print(f"_PROCESS_TELEGRAM_ALERTS: Checking TxID {tx_hash_str}. Alert info from history: {alert_info}") # DEBUG
-
-        if alert_info is None:
-            should_queue_task = True
-            current_attempt_number = 1
-            # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} is NEW. Queuing attempt 1.") # DEBUG
-        elif alert_info.get('status') in ["pending", "error"]:
-            last_attempt_time = alert_info.get('last_attempt_time', 0)
-            attempts_done = alert_info.get('attempt', 0)
-            retry_interval = 60 
-            if attempts_done < APP_MAX_ALERT_ATTEMPTS and \
-               (current_time_for_check - last_attempt_time >= retry_interval):
-                should_queue_task = True
-                current_attempt_number = attempts_done + 1
-                # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} is RETRY ({alert_info.get('status')}). Queuing attempt {current_attempt_number}.") # DEBUG
-            # else: # DEBUG
-                # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} no retry. Attempts: {attempts_done}, Time since last: {current_time_for_check - last_attempt_time}") # DEBUG
-        elif alert_info.get('status') == 'queued' or alert_info.get('status') == 'sending':
-             should_queue_task = False 
-             # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} already '{alert_info.get('status')}' or 'sending'. Skipping queue.") # DEBUG
-        # elif alert_info.get('status') == 'success': # DEBUG
-            # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} already 'success'. Skipping.") # DEBUG
-
-
-        if should_queue_task:
-            message_html = telegram_service.format_telegram_message(row)
-            if message_html:
-                # Обновляем статус на 'queued' в ЛОКАЛЬНОЙ КОПИИ истории (session_history)
-                session_history[tx_hash_str] = {
-                    'status': 'queued', # Статус перед добавлением в очередь
-                    'attempt': current_attempt_number,
-                    'last_attempt_time': current_time_for_check, 
-                    'sent_time': (alert_info.get('sent_time') if alert_info else None), # Сохраняем предыдущее время успеха если было
-                    'original_timestamp_from_data': row.get('Время') 
-                }
-                history_updated_this_cycle = True
-                # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} status set to 'queued' in cycle history.") # DEBUG
-
-                task_data_for_queue = {
-                    'bot_token': bot_token,
-                    'chat_id': chat_id,
-                    'message_html': message_html,
-                    'tx_hash': tx_hash_str,
-                    'attempt_number': current_attempt_number,
-                    'original_timestamp': row.get('Время') 
-                }
-                st.session_state.alert_queue.append(task_data_for_queue)
-                # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} added to st.session_state.alert_queue. Queue size: {len(st.session_state.alert_queue)}") # DEBUG
-            else: # Ошибка форматирования сообщения
-                # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} FAILED to format message. Setting status to 'error'.") # DEBUG
-                session_history[tx_hash_str] = {
-                    'status': 'error', 
-                    'attempt': current_attempt_number, 
-                    'last_attempt_time': current_time_for_check,
-                    'sent_time': None,
-                    'original_timestamp_from_data': row.get('Время')
-                }
-                history_updated_this_cycle = True
+    # Сообщения формируются пакетно и только для отобранных строк
+    messages_html = _format_alert_messages(candidates_df, message_cache)
+    original_timestamps = candidates_df['Время'] if 'Время' in candidates_df.columns else pd.Series(None, index=candidates_df.index, dtype=object)
+    transaction_times = transaction_store.to_epoch(original_timestamps)
+    for message_html, tx_hash_str, original_timestamp, transaction_time, status, attempts_done, previous_sent_time in zip(
+        messages_html, candidates_df['TxID'].astype(str), original_timestamps, transaction_times,
+        candidate_history['status'], candidate_history['attempt'], candidate_history['sent_time']
+    ):
+        is_new = pd.isna(status)
+        current_attempt_number = claimed_attempts[tx_hash_str] # Учитывает попытки других сессий этого чата
+        if message_html:
+            # Обновляем статус на 'queued' в истории сессии
+            session_history[tx_hash_str] = {
+                'status': 'queued', # Статус перед добавлением в очередь
+                'attempt': current_attempt_number,
+                'last_attempt_time': current_time_for_check, 
+                'sent_time': None if is_new or pd.isna(previous_sent_time) else previous_sent_time, # Сохраняем предыдущее время успеха если было
+                'original_timestamp_from_data': original_timestamp 
+            }
+            tasks_to_submit.append({
+                'bot_token': bot_token,
+                'chat_id': chat_id,
+                'message_html': message_html,
+                'tx_hash': tx_hash_str,
+                'destination': destination['name'],
+                'attempt_number': current_attempt_number,
+                'original_timestamp': original_timestamp,
+                'digest': digest_settings,
+                'max_attempts': APP_MAX_ALERT_ATTEMPTS,
+                'timestamps': {'transaction': transaction_time, 'fetched': fetched_at}
+            })
+        else: # Ошибка форматирования сообщения
+            # print(f"_PROCESS_TELEGRAM_ALERTS: TxID {tx_hash_str} FAILED to format message. Setting status to 'error'.") # DEBUG
+            claim_index.set_status(chat_id, tx_hash_str, 'error', current_attempt_number) # Освобождаем захват
+            session_history[tx_hash_str] = {
+                'status': 'error', 
+                'attempt': current_attempt_number, 
+                'last_attempt_time': current_time_for_check,
+                'sent_time': None,
+                'original_timestamp_from_data': original_timestamp
+            }
+        history_updated_this_cycle = True
     
-    if history_updated_this_cycle:
-        # print(f"_PROCESS_TELEGRAM_ALERTS: History updated in this cycle. Calling save_alert_history with cycle's history copy.") # DEBUG
-        # Передаем измененную КОПИЮ session_history в save_alert_history, 
-        # которая обновит st.session_state.alert_history и затем вызовет save_app_settings.
-        save_alert_history(session_history) 
-
-def _dispatch_next_alert_if_needed():
-    if not st.session_state.get('is_sending_alert', False) and st.session_state.alert_queue:
-        task_to_send = st.session_state.alert_queue.popleft()
-        tx_hash_to_send = task_to_send.get('tx_hash')
-        
-        # print(f"_DISPATCH_NEXT_ALERT: Dispatching task for TxID {tx_hash_to_send}. Queue size now: {len(st.session_state.alert_queue)}") # DEBUG
-        st.session_state.is_sending_alert = True 
-
-        # Обновляем статус на 'sending' в st.session_state.alert_history СРАЗУ
-        # и СОХРАНЯЕМ это изменение, чтобы оно отразилось в UI даже до завершения потока.
-        history_changed_by_dispatch = False
-        if tx_hash_to_send:
-            current_entry = st.session_state.alert_history.get(tx_hash_to_send, {}).copy()
-            if current_entry.get('status') != 'sending': # Обновляем только если не 'sending' уже
-                current_entry['status'] = 'sending'
-                current_entry['last_attempt_time'] = time.time() # Обновим время последней активности
-                # attempt и sent_time не трогаем здесь, они будут установлены в потоке
-                if 'attempt' not in current_entry: # Если попытки не было, это первая при отправке
-                     current_entry['attempt'] = task_to_send.get('attempt_number', 1)
-
-                st.session_state.alert_history[tx_hash_to_send] = current_entry
-                history_changed_by_dispatch = True
-                # print(f"_DISPATCH_NEXT_ALERT: TxID {tx_hash_to_send} status set to 'sending' in session_state.alert_history.") # DEBUG
-        
-        if history_changed_by_dispatch:
-            save_alert_history(st.session_state.alert_history) # Сохраняем немедленно изменение статуса на 'sending'
-            # print(f"_DISPATCH_NEXT_ALERT: Called save_alert_history after setting status to 'sending' for {tx_hash_to_send}.") # DEBUG
-
-        thread_args = {
-            'bot_token': task_to_send.get('bot_token'),
-            'chat_id': task_to_send.get('chat_id'),
-            'message_html': task_to_send.get('message_html'),
-            'tx_hash': tx_hash_to_send, # Передаем tx_hash_to_send, а не task_to_send.get('tx_hash')
-            'attempt_number': task_to_send.get('attempt_number'),
-            'original_timestamp': task_to_send.get('original_timestamp')
-        }
+    return tasks_to_submit, history_updated_this_cycle
 
-        alert_dispatch_thread = threading.Thread(target=_send_individual_alert_threaded, kwargs=thread_args, daemon=True)
-        try:
-            # print(f"_DISPATCH_NEXT_ALERT: Attempting to start thread for TxID {tx_hash_to_send}.") # DEBUG
-            st.runtime.scriptrunner.add_script_run_ctx(alert_dispatch_thread)
-            alert_dispatch_thread.start()
-            # print(f"_DISPATCH_NEXT_ALERT: Thread for TxID {tx_hash_to_send} started successfully.") # DEBUG
-        except AttributeError: # Обработка для старых версий Streamlit, если st.runtime отсутствует
+def _select_alert_candidates(transactions_df: pd.DataFrame, history: alert_history.AlertHistoryStore, now: float) -> Tuple[pd.Series, pd.DataFrame]:
+    """
+    Векторно отбирает строки, по которым нужно поставить алерт: новые TxID и 'pending'/'error',
+    у которых остались попытки и подошло время повтора (_retry_due; запасной путь: обычно их повторяет пул).
+    'queued', 'sending' и 'success' пропускаются.
+    Возвращает маску строк и колоночное представление истории для этих строк.
+    """
+    tx_ids = transactions_df['TxID']
+    valid = tx_ids.notna() & (tx_ids.astype(str).str.strip() != '') & (tx_ids.astype(str) != 'N/A')
+    tx_ids = tx_ids.astype(str)
+    history_view = history.status_frame(tx_ids)
+    is_new = history_view['status'].isna()
+    is_retry = _retry_due(history_view, now) & (history_view['attempt'] < APP_MAX_ALERT_ATTEMPTS)
+    return valid & (is_new | is_retry) & ~tx_ids.duplicated(), history_view
+
+def _retry_due(history_view: pd.DataFrame, now: float) -> pd.Series:
+    """
+    Маска записей pending/error, которые пора повторить из конвейера сессии: осиротевшие — через
+    ALERT_RETRY_INTERVAL после последней попытки, запланированные пулом — если повтор просрочен на SCHEDULED_RETRY_GRACE.
+    """
+    retry_at = (history_view['next_attempt_at'] + alert_claims.SCHEDULED_RETRY_GRACE).fillna(
+        history_view['last_attempt_time'] + ALERT_RETRY_INTERVAL
+    )
+    return history_view['status'].isin(['pending', 'error']) & (now >= retry_at)
+
+def _submit_alert_task(task: Dict[str, Any]):
+    """Передает задачу в общий пул отправки; статусы в истории сессии обновляются из потоков пула."""
+    ctx = _get_script_run_ctx()
+
+    def on_start(started_task: Dict[str, Any]):
+        _attach_session_ctx(ctx)
+        tx_hash = started_task.get('tx_hash')
+        with st.session_state.alert_history_lock:
+            history = _get_destination_history(started_task.get('destination', alert_routing.MAIN_DESTINATION))
+            current_entry = history.get(tx_hash, {}).copy()
+            current_entry['status'] = 'sending'
+            current_entry['last_attempt_time'] = time.time() # Обновим время последней активности
+            if 'attempt' not in current_entry: # Если попытки не было, это первая при отправке
+                current_entry['attempt'] = started_task.get('attempt_number', 1)
+            history[tx_hash] = current_entry
+        st.session_state.alert_history_updated_by_thread = True
+
+    def on_complete(finished_task: Dict[str, Any], success: bool):
+        _attach_session_ctx(ctx)
+        _record_alert_result(finished_task, success)
+
+    if 'timestamps' in task:
+        task['timestamps']['queued'] = time.time()
+    if not alert_dispatcher.get_dispatcher().submit(task, on_complete=on_complete, on_start=on_start):
+        # Outbox уже знает этот алерт (отправлен или доставляется после перезапуска) — берем статус оттуда
+        _reconcile_destination_history(
+            {'name': task.get('destination', alert_routing.MAIN_DESTINATION), 'chat_id': task.get('chat_id')},
+            [task.get('tx_hash')]
+        )
+
+def _reconcile_alert_history_with_outbox():
+    """
+    Сверяет с outbox записи историй всех получателей, застрявшие в 'queued'/'sending'
+    дольше OUTBOX_RECONCILE_AFTER (например, история из localStorage после перезапуска сервера),
+    и записи, по которым завершились задачи, восстановленные пулом из outbox.
+    """
+    destinations = _get_alert_destinations()
+    dispatcher = alert_dispatcher.get_existing_dispatcher()
+    recovered_by_chat: Dict[str, List[str]] = {}
+    if dispatcher is not None:
+        sequence, recovered = dispatcher.recovered_results_since(st.session_state.get('recovered_results_seq', 0))
+        st.session_state.recovered_results_seq = sequence
+        for chat_id, tx_hash in recovered:
+            recovered_by_chat.setdefault(chat_id, []).append(tx_hash)
+    for destination in destinations:
+        _reconcile_destination_history(destination)
+        recovered_tx_hashes = recovered_by_chat.get(str(destination.get('chat_id')))
+        if recovered_tx_hashes:
+            with st.session_state.alert_history_lock:
+                history = _get_destination_history(destination['name'])
+                known_tx_hashes = [tx for tx in recovered_tx_hashes if tx in history]
+            if known_tx_hashes:
+                _reconcile_destination_history(destination, known_tx_hashes)
+
+def _reconcile_destination_history(destination: Dict[str, Any], tx_hashes: Optional[List[str]] = None):
+    """Переносит статусы из индекса захватов и outbox в историю получателя (по указанным TxID или по застрявшим записям)."""
+    outbox = alert_outbox.get_outbox()
+    chat_id = destination.get('chat_id')
+    if not chat_id:
+        return
+    now = time.time()
+    with st.session_state.alert_history_lock:
+        history = _get_destination_history(destination['name'])
+        if tx_hashes is None:
+            tx_hashes = [tx for tx, info in history.items()
+                         if info.get('status') in ('queued', 'sending') and
+                         now - info.get('last_attempt_time', 0) >= OUTBOX_RECONCILE_AFTER]
+        if not tx_hashes:
+            return
+        # Сначала общий индекс захватов процесса, затем outbox (переживает перезапуск)
+        entries = alert_claims.get_claim_index().get_entries(chat_id, tx_hashes)
+        missing = [tx for tx in tx_hashes if str(tx) not in entries]
+        if missing and outbox is not None:
             try:
-                from streamlit.runtime.scriptrunner import add_script_run_ctx
-                add_script_run_ctx(alert_dispatch_thread)
-                alert_dispatch_thread.start()
-                # print(f"_DISPATCH_NEXT_ALERT (Fallback): Thread for TxID {tx_hash_to_send} started successfully.") # DEBUG
-            except ImportError as e_import_ctx:
-                # print(f"_DISPATCH_NEXT_ALERT: FAILED to start thread (ImportError {e_import_ctx}) for TxID {tx_hash_to_send}. Returning task to queue.") # DEBUG
-                st.session_state.alert_queue.appendleft(task_to_send) # Возвращаем задачу в начало очереди
-                st.session_state.is_sending_alert = False
-                if tx_hash_to_send and tx_hash_to_send in st.session_state.alert_history:
-                    # Откатываем статус на 'error' или 'pending', если не удалось запустить
-                    st.session_state.alert_history[tx_hash_to_send]['status'] = 'error' 
-                    save_alert_history(st.session_state.alert_history) # Сохраняем изменение статуса
-            except Exception as e_ctx_attach_start: 
-                # print(f"_DISPATCH_NEXT_ALERT: FAILED to start thread (Ctx/Attach Error {e_ctx_attach_start}) for TxID {tx_hash_to_send}. Returning task to queue.") # DEBUG
-                st.session_state.alert_queue.appendleft(task_to_send)
-                st.session_state.is_sending_alert = False
-                if tx_hash_to_send and tx_hash_to_send in st.session_state.alert_history:
-                    st.session_state.alert_history[tx_hash_to_send]['status'] = 'error'
-                    save_alert_history(st.session_state.alert_history)
-        except Exception as e_thread_start: # Ловим другие ошибки при старте потока
-            # print(f"_DISPATCH_NEXT_ALERT: FAILED to start thread (General Error {e_thread_start}) for TxID {tx_hash_to_send}. Returning task to queue.") # DEBUG
-            st.session_state.alert_queue.appendleft(task_to_send)
-            st.session_state.is_sending_alert = False
-            if tx_hash_to_send and tx_hash_to_send in st.session_state.alert_history:
-                st.session_state.alert_history[tx_hash_to_send]['status'] = 'error'
-                save_alert_history(st.session_state.alert_history)
-    # else: # DEBUG
-        # if st.session_state.get('is_sending_alert', False): # DEBUG
-            # print("_DISPATCH_NEXT_ALERT: Skipping, an alert is already being sent.") # DEBUG
-        # elif not st.session_state.alert_queue: # DEBUG
-            # print("_DISPATCH_NEXT_ALERT: Skipping, alert queue is empty.") # DEBUG
+                entries.update(outbox.get_entries(chat_id, missing))
+            except Exception as e:
+                print(f"Error reading alert outbox: {e}")
+                return
+        for tx_hash in tx_hashes:
+            entry = entries.get(str(tx_hash))
+            current_entry = history.get(tx_hash, {}).copy()
+            if entry is not None:
+                current_entry.update({
+                    'status': entry['status'],
+                    'attempt': entry['attempt'],
+                    'last_attempt_time': entry['last_attempt_time'],
+                    'sent_time': entry['sent_time'] or current_entry.get('sent_time'),
+                    'next_attempt_at': entry.get('next_attempt_at')
+                })
+            elif current_entry.get('status') in ('queued', 'sending'):
+                current_entry['status'] = 'pending' # Задача потеряна (outbox не знает о ней) — отправим повторно
+            else:
+                continue
+            history[tx_hash] = current_entry
+    st.session_state.alert_history_updated_by_thread = True
 
+def _attach_session_ctx(ctx):
+    """Привязывает контекст сессии к текущему (фоновому) потоку, чтобы в нем работал st.session_state."""
+    if ctx is None:
+        return
+    from streamlit.runtime.scriptrunner import add_script_run_ctx
+    add_script_run_ctx(threading.current_thread(), ctx)
+
+def _get_query_filter_params() -> Dict[str, Any]:
+    return {
+        'min_usd': st.session_state.min_usd_query_input,
+        'lookback': st.session_state.lookback_query_input,
+        'token_symbols': st.session_state.token_symbols_multiselect,
+        'from_address_names': st.session_state.from_address_names_multiselect,
+        'to_address_names': st.session_state.to_address_names_multiselect
+    }
+
+def _make_poller_result_handler(ctx):
+    """Обработчик снимков поллера: запускает конвейер алертов в фоновом потоке от имени сессии."""
+    def handle_result(snapshot: Dict[str, Any]):
+        # Привязываем контекст сессии к потоку поллера так же, как это делается для потоков отправки
+        _attach_session_ctx(ctx)
+        transactions_df = snapshot.get('transactions_df')
+        if transactions_df is None or transactions_df.empty or 'TxID' not in transactions_df.columns:
+            return
+        # Проверяем только новые транзакции и "осиротевшие" неудачные, а не все окно;
+        # запланированные повторы пул отправки выполняет сам, даже если транзакция ушла из окна
+        new_txids = set(snapshot.get('new_transactions_df', pd.DataFrame()).get('TxID', pd.Series(dtype=object)).astype(str))
+        tx_ids = transactions_df['TxID'].astype(str)
+        needs_retry = pd.Series(False, index=transactions_df.index)
+        now = time.time()
+        with st.session_state.alert_history_lock:
+            for destination in _get_alert_destinations():
+                history_view = _get_destination_history(destination['name']).status_frame(tx_ids)
+                needs_retry |= _retry_due(history_view, now)
+        candidates_df = transactions_df[tx_ids.isin(new_txids) | needs_retry]
+        if not candidates_df.empty:
+            _process_telegram_alerts(candidates_df, persist=False, fetched_at=snapshot.get('fetched_at'))
+    return handle_result
+
+def _sync_background_poller():
+    """Подписывает сессию на фоновый опрос при включенном автообновлении и отписывает при выключенном."""
+    session_id = _get_session_id()
+    api_key = st.session_state.get('api_key') or os.getenv("ARKHAM_API_KEY")
+    if session_id is None or not api_key:
+        return
+    polling_service.unsubscribe_other_keys(session_id, api_key)
+    if not st.session_state.get('auto_refresh_enabled', False):
+        # Без автообновления поток опроса не нужен: снимаем подписку, только если поллер уже есть
+        poller = polling_service.find_poller(api_key)
+        if poller is not None:
+            poller.unsubscribe(session_id)
+        return
+    poller = polling_service.get_poller(api_key)
+    if poller is None:
+        return
+    poller.subscribe(
+        session_id,
+        _get_query_filter_params(),
+        st.session_state.limit_query_input,
+        st.session_state.get('auto_refresh_interval', 60),
+        on_result=_make_poller_result_handler(_get_script_run_ctx())
+    )
+
+def _apply_poller_snapshot() -> bool:
+    """Переносит в session_state свежий снимок поллера. Возвращает True, если снимок был новым."""
+    session_id = _get_session_id()
+    api_key = st.session_state.get('api_key') or os.getenv("ARKHAM_API_KEY")
+    if session_id is None or not api_key or not st.session_state.get('auto_refresh_enabled', False):
+        return False
+    poller = polling_service.find_poller(api_key) # Подписку (и сам поллер) создает _sync_background_poller
+    snapshot = poller.get_snapshot(session_id) if poller is not None else None
+    if snapshot is None or snapshot['seq'] <= st.session_state.poll_snapshot_seq:
+        return False
+    st.session_state.poll_snapshot_seq = snapshot['seq']
+    st.session_state.api_params_debug = snapshot.get('api_params_debug')
+    if snapshot.get('error'):
+        st.session_state.error_message = snapshot['error']
+    else:
+        st.session_state.transactions_df = snapshot['transactions_df']
+        st.session_state.error_message = None
+        # Запрос поллера мог дополнить кеш монитора; переносим в сессию только новые элементы
+        if _sync_known_lists():
+            save_arkham_cache(st.session_state.arkham_monitor)
+    return True
+
+@st.fragment(run_every=LIVE_UPDATES_CHECK_SECONDS)
+def _render_live_updates():
+    """Легкая периодическая проверка: перезапускает приложение только при появлении новых данных."""
+    if st.session_state.get('live_updates_in_app_run', False):
+        st.session_state.live_updates_in_app_run = False # Полный запуск только что все отрисовал
+        return
+    session_id = _get_session_id()
+    api_key = st.session_state.get('api_key') or os.getenv("ARKHAM_API_KEY")
+    auto_refresh_enabled = st.session_state.get('auto_refresh_enabled', False)
+    # Проверка не должна создавать поток опроса: без автообновления поллер не нужен вовсе
+    poller = polling_service.find_poller(api_key) if api_key and auto_refresh_enabled else None
+    has_new_snapshot = False
+    if poller is not None and session_id is not None:
+        poller.touch(session_id)
+        snapshot = poller.get_snapshot(session_id)
+        has_new_snapshot = snapshot is not None and snapshot['seq'] > st.session_state.get('poll_snapshot_seq', 0)
+    dispatcher = alert_dispatcher.get_existing_dispatcher()
+    if dispatcher is not None and dispatcher.recovered_results_sequence() > st.session_state.get('recovered_results_seq', 0):
+        has_new_snapshot = True # Завершились задачи из outbox: истории сверит следующий полный запуск
+    # Перезапуск также нужен, чтобы дописать в localStorage отложенные окном изменения настроек
+    if has_new_snapshot or st.session_state.get('alert_history_updated_by_thread', False) or _get_settings_persistence().flush_due():
+        st.rerun()
 
 def _fetch_and_update_table():
     if not st.session_state.arkham_monitor:
@@ -446,20 +801,16 @@ def _fetch_and_update_table():
     if not st.session_state.cache_initialized_flag:
         st.warning("Внимание: Кеш адресов и токенов не был инициализирован или обновлен. Фильтрация по именам и токенам может быть неэффективной.")
     
-    filter_params = {
-        'min_usd': st.session_state.min_usd_query_input,
-        'lookback': st.session_state.lookback_query_input,
-        'token_symbols': st.session_state.token_symbols_multiselect,
-        'from_address_names': st.session_state.from_address_names_multiselect,
-        'to_address_names': st.session_state.to_address_names_multiselect
-    }
+    filter_params = _get_query_filter_params()
     query_limit = st.session_state.limit_query_input
     
     # print(f"_FETCH_AND_UPDATE_TABLE: Fetching transactions with limit {query_limit} and params {filter_params}") # DEBUG
     with st.spinner("Запрос транзакций..."):
-        df, error, api_params_debug = arkham_service.fetch_transactions(
-            st.session_state.arkham_monitor, filter_params, query_limit
+        # Запрос по кнопке не отвечается из кеша ответов: пользователь ждет свежие данные
+        df, error, api_params_debug = arkham_service.fetch_transactions_local_first(
+            st.session_state.arkham_monitor, filter_params, query_limit, use_response_cache=False
         )
+    fetched_at = time.time()
     
     st.session_state.api_params_debug = api_params_debug 
     
@@ -476,44 +827,20 @@ def _fetch_and_update_table():
         if not st.session_state.transactions_df.empty:
             try:
                 # print("_FETCH_AND_UPDATE_TABLE: Calling _process_telegram_alerts.") # DEBUG
-                _process_telegram_alerts(st.session_state.transactions_df)
+                _process_telegram_alerts(st.session_state.transactions_df, fetched_at=fetched_at)
             except Exception as e:
                 # print(f"_FETCH_AND_UPDATE_TABLE: Error during _process_telegram_alerts: {e}") # DEBUG
                 st.error(f"Ошибка при обработке Telegram алертов: {e}")
         
         # Обновление кеша токенов/адресов после успешного запроса транзакций (т.к. arkham_client мог обновить их)
         if st.session_state.arkham_monitor:
-            updated_tokens = st.session_state.arkham_monitor.get_known_token_symbols()
-            updated_addresses = st.session_state.arkham_monitor.get_known_address_names()
-            
-            tokens_changed = set(st.session_state.get('known_tokens', [])) != set(updated_tokens)
-            addresses_changed = set(st.session_state.get('known_addresses', [])) != set(updated_addresses)
-
-            if tokens_changed:
-                st.session_state.known_tokens = updated_tokens
-                # print(f"_FETCH_AND_UPDATE_TABLE: known_tokens updated ({len(updated_tokens)}).") # DEBUG
-            if addresses_changed:
-                st.session_state.known_addresses = updated_addresses
-                # print(f"_FETCH_AND_UPDATE_TABLE: known_addresses updated ({len(updated_addresses)}).") # DEBUG
-
-            if tokens_changed or addresses_changed: # Если что-то изменилось в базовых списках
-                try:
-                    full_cache_state = st.session_state.arkham_monitor.get_full_cache_state()
-                    st.session_state.detailed_token_info = full_cache_state.get('token_cache', {}).get('symbol_to_ids', {})
-                    st.session_state.detailed_address_info = full_cache_state.get('address_cache', {}).get('name_to_ids', {})
-                    if st.session_state.detailed_token_info is None: st.session_state.detailed_token_info = {}
-                    if st.session_state.detailed_address_info is None: st.session_state.detailed_address_info = {}
-                    # print("_FETCH_AND_UPDATE_TABLE: detailed_token_info and detailed_address_info updated.") # DEBUG
-                except Exception as e:
-                    # print(f"_FETCH_AND_UPDATE_TABLE: Error updating detailed cache info: {e}") # DEBUG
-                    st.warning(f"Ошибка при получении полного состояния кеша из монитора после поиска: {e}")
-                    st.session_state.detailed_token_info = {} 
-                    st.session_state.detailed_address_info = {}
-                
+            # Только элементы, добавленные после поколения кеша сессии, без сравнения полных списков
+            if _sync_known_lists():
+                # Детали кеша (ID адресов и токенов) пересчитаются лениво при следующем показе
                 save_arkham_cache(st.session_state.arkham_monitor) # Сохраняем обновленный кеш Arkham
                 # print("_FETCH_AND_UPDATE_TABLE: Arkham cache saved.") # DEBUG
 
-            if not st.session_state.cache_initialized_flag and (updated_tokens or updated_addresses):
+            if not st.session_state.cache_initialized_flag and (st.session_state.known_tokens or st.session_state.known_addresses):
                  st.session_state.cache_initialized_flag = True
                  # print("_FETCH_AND_UPDATE_TABLE: cache_initialized_flag set to True.") # DEBUG
         
@@ -621,12 +948,59 @@ def render_sidebar():
             help="Отправлять уведомления о новых транзакциях в Telegram.",
             disabled=not alerts_can_be_enabled,
         )
+        st.toggle(
+            "Режим сводок",
+            key='telegram_digest_enabled',
+            help="Объединять всплески транзакций в сводные сообщения (до 4096 символов) вместо отдельного сообщения на каждую.",
+        )
+        digest_cols = st.columns(2)
+        digest_cols[0].number_input(
+            "Порог сводки",
+            min_value=2,
+            step=1,
+            key='telegram_digest_threshold',
+            disabled=not st.session_state.get('telegram_digest_enabled', False),
+            help="Сводка отправляется сразу, как только в очереди чата накопится столько сообщений.",
+        )
+        digest_cols[1].number_input(
+            "Окно (сек)",
+            min_value=0,
+            step=5,
+            key='telegram_digest_window',
+            disabled=not st.session_state.get('telegram_digest_enabled', False),
+            help="Сколько ждать накопления сообщений, если порог не достигнут.",
+        )
+        st.text_area(
+            "Правило алертов (JSON)",
+            key='telegram_main_rule_json',
+            placeholder='{"token_usd_thresholds": {"BTC": 5000000, "*": 1000000}, "direction": "cex_inflow", "exclude_entities": ["Coinbase"]}',
+            help="Какие строки выборки отправлять в основной чат (пусто — все). Поля: min_usd, token_usd_thresholds "
+                 "(порог по токену, \"*\" — для остальных), token_symbols, networks, direction (any / cex_inflow / cex_outflow), "
+                 "include_entities, exclude_entities, from_address_names, to_address_names, cex_entities.",
+        )
+        _, main_rule_error = alert_routing.parse_rule(st.session_state.get('telegram_main_rule_json', ''))
+        if main_rule_error:
+            st.error(f"{main_rule_error} Алерты основного чата приостановлены.")
+        st.text_area(
+            "Дополнительные получатели (JSON)",
+            key='telegram_destinations_json',
+            placeholder='[{"name": "btc-desk", "chat_id": "-100123", "rule": {"min_usd": 5000000, "token_symbols": ["BTC"], "direction": "cex_outflow"}}]',
+            help="Список получателей с правилами: name, chat_id, bot_token_env (необязательно: имя переменной окружения сервера "
+                 "с токеном другого бота, по умолчанию бот выше; сам токен здесь не указывается, настройка сохраняется в браузере) и rule "
+                 "(поля как у правила выше). Правила применяются к уже полученной выборке, "
+                 "поэтому новые получатели не добавляют запросов к Arkham. У каждого получателя своя очередь, лимиты и история.",
+        )
+        destinations, destinations_error = alert_routing.parse_destinations(st.session_state.get('telegram_destinations_json', ''))
+        if destinations_error:
+            st.error(destinations_error)
+        elif destinations:
+            st.caption(f"Получателей помимо основного чата: {len(destinations)}")
 
     with st.sidebar.expander("Автоматическое Обновление"):
         st.toggle(
             "Включить", 
             key='auto_refresh_enabled', 
-            help="Автоматически обновлять таблицу транзакций. ВНИМАНИЕ: Приложение будет неактивно во время ожидания интервала."
+            help="Автоматически обновлять таблицу транзакций. Запросы выполняются фоновым опросом сервера, интерфейс остается активным."
         )
         st.number_input(
             "Интервал обновления (сек)", 
@@ -728,6 +1102,9 @@ def render_main_content():
         known_tokens_list = st.session_state.get('known_tokens', [])
         known_addresses_list = st.session_state.get('known_addresses', [])
         cache_initialized = st.session_state.get('cache_initialized_flag', False)
+        # Тела вкладок выполняются при каждом перезапуске, поэтому таблицы деталей строятся и передаются
+        # в браузер только по явному запросу
+        show_cache_details = cache_initialized and st.toggle("Показать детали кеша (связанные ID)", key="show_cache_details")
         
         tab1, tab2, tab3 = st.tabs(["Сводка", "Известные Адреса", "Известные Токены"])
         
@@ -735,14 +1112,13 @@ def render_main_content():
             if not cache_initialized:
                 st.info("Кеш еще не инициализирован. Пожалуйста, загрузите его, используя опцию в сайдбаре.")
             else:
-                detailed_address_info = st.session_state.get('detailed_address_info', {})
-                total_detailed_addresses_ids = sum(len(ids) for ids in detailed_address_info.values() if isinstance(ids, list))
-                
-                detailed_token_info = st.session_state.get('detailed_token_info', {})
-                total_detailed_tokens_ids = sum(len(ids) for ids in detailed_token_info.values() if isinstance(ids, list))
-
-                st.write(f"Уникальных имен/адресов в кеше: {len(known_addresses_list)} (связанных ID: {total_detailed_addresses_ids})")
-                st.write(f"Уникальных символов токенов в кеше: {len(known_tokens_list)} (связанных ID: {total_detailed_tokens_ids})")
+                if show_cache_details:
+                    cache_detail_views = _get_cache_detail_views()
+                    st.write(f"Уникальных имен/адресов в кеше: {len(known_addresses_list)} (связанных ID: {cache_detail_views['address_ids_total']})")
+                    st.write(f"Уникальных символов токенов в кеше: {len(known_tokens_list)} (связанных ID: {cache_detail_views['token_ids_total']})")
+                else:
+                    st.write(f"Уникальных имен/адресов в кеше: {len(known_addresses_list)}")
+                    st.write(f"Уникальных символов токенов в кеше: {len(known_tokens_list)}")
                 
                 if not known_addresses_list and not known_tokens_list and cache_initialized:
                     st.write("Кеш был инициализирован, но не содержит данных (0 адресов, 0 токенов).")
@@ -752,55 +1128,106 @@ def render_main_content():
                     st.write(f"Примерный размер данных приложения в localStorage: {ls_size_mb:.2f} МБ")
                 else:
                     st.write("Не удалось определить размер данных в localStorage.")
+                encoding_stats = _get_cache_encoding_stats()
+                stored_bytes = encoding_stats.get('encoded_bytes') or encoding_stats.get('stored_bytes')
+                if encoding_stats.get('encoded_bytes'):
+                    st.caption(f"Кеш Arkham в localStorage: {encoding_stats['encoded_bytes'] / 1024:.0f} КБ, кодирование {encoding_stats['encode_ms']:.0f} мс")
+                elif encoding_stats.get('stored_bytes'):
+                    st.caption(f"Кеш Arkham в localStorage: {encoding_stats['stored_bytes'] / 1024:.0f} КБ, декодирование {encoding_stats['decode_ms']:.0f} мс")
+                # Размер в обычном JSON требует полной сериализации кеша, поэтому считается только по запросу
+                if stored_bytes and st.session_state.get('arkham_monitor') is not None and \
+                        st.toggle("Сравнить с размером в JSON", key="arkham_cache_compare_json"):
+                    json_size = arkham_service.cache_state_json_size(arkham_service.get_cache_state(st.session_state.arkham_monitor))
+                    st.caption(f"В обычном JSON: {json_size / 1024:.0f} КБ (компактная кодировка — {stored_bytes / json_size if json_size else 1.0:.0%})")
         with tab2:
             if not cache_initialized:
                 st.info("Кеш не инициализирован. Данные об адресах отсутствуют.")
             elif not known_addresses_list:
                 st.info("Список известных адресов пуст. Загрузите или обновите кеш из сайдбара.")
+            elif not show_cache_details:
+                st.info("Включите \"Показать детали кеша\", чтобы увидеть таблицу адресов.")
             else:
-                data_for_addresses_df = []
-                detailed_address_info_tab = st.session_state.get('detailed_address_info', {})
-                for name in known_addresses_list:
-                    ids_list = detailed_address_info_tab.get(name, []) # Должен быть список ID
-                    count = len(ids_list) if isinstance(ids_list, list) else 0
-                    data_for_addresses_df.append({"Адрес/Имя": name, "Кол-во связанных ID": count})
-                df_addresses = pd.DataFrame(data_for_addresses_df)
-                st.dataframe(df_addresses, use_container_width=True, height=300)
+                st.dataframe(_get_cache_detail_views()['addresses_df'], use_container_width=True, height=300)
         with tab3:
             if not cache_initialized:
                 st.info("Кеш не инициализирован. Данные о токенах отсутствуют.")
             elif not known_tokens_list:
                 st.info("Список известных токенов пуст. Загрузите или обновите кеш из сайдбара.")
+            elif not show_cache_details:
+                st.info("Включите \"Показать детали кеша\", чтобы увидеть таблицу токенов.")
             else:
-                data_for_tokens_df = []
-                detailed_token_info_tab = st.session_state.get('detailed_token_info', {})
-                for symbol in known_tokens_list:
-                    ids_list = detailed_token_info_tab.get(symbol, []) # Должен быть список ID
-                    count_ids = len(ids_list) if isinstance(ids_list, list) else 0
-                    data_for_tokens_df.append({"Символ Токена": symbol, "Кол-во связанных ID": count_ids})
-                df_tokens = pd.DataFrame(data_for_tokens_df)
                 st.dataframe(
-                    df_tokens, 
+                    _get_cache_detail_views()['tokens_df'], 
                     use_container_width=True, 
                     height=300,
                     column_config={}
                 )
 
+    with st.expander("Отладка", expanded=False):
+        st.caption("Параметры последнего запроса к API Arkham")
+        st.json(st.session_state.get('api_params_debug') or {})
+        cache_stats = arkham_service.get_response_cache_stats()
+        st.caption(f"Кеш ответов Arkham (TTL {cache_stats['ttl_seconds']:.0f} сек, записей: {cache_stats['entries']})")
+        stat_cols = st.columns(4)
+        stat_cols[0].metric("Попадания", cache_stats['hits'])
+        stat_cols[1].metric("Промахи", cache_stats['misses'])
+        stat_cols[2].metric("Объединено", cache_stats['coalesced'], help="Запросы, дождавшиеся уже выполняющегося одинакового запроса.")
+        stat_cols[3].metric("Доля попаданий", f"{cache_stats['hit_ratio']:.0%}")
+        store = transaction_store.get_transaction_store()
+        if store is not None:
+            store_stats = store.get_stats()
+            st.caption(
+                f"Локальное хранилище: {store_stats['transactions']} транзакций, "
+                f"ответов без API: {store_stats['local_hits']}, запросов к API: {store_stats['local_misses']}"
+            )
+        http_stats = telegram_service.get_http_stats()
+        st.caption(
+            f"Соединения Telegram: запросов {http_stats['requests']}, новых соединений {http_stats['new_connections']}, "
+            f"переиспользовано {http_stats['reused_connections']} ({http_stats['reuse_ratio']:.0%})"
+        )
+        dispatcher = alert_dispatcher.get_existing_dispatcher() # Панель отладки не запускает пул отправки
+        if dispatcher is not None:
+            st.caption(f"Пул отправки: в очереди {dispatcher.pending_count()}, ждут повтора {dispatcher.scheduled_retry_count()}")
+        else:
+            st.caption("Пул отправки еще не запущен.")
+        _render_alert_latency_metrics()
+
+def _render_alert_latency_metrics():
+    """Перцентили и гистограммы задержек доставленных алертов по этапам конвейера, выгрузка в JSON."""
+    metrics = alert_metrics.get_latency_metrics()
+    summary = metrics.summary()
+    st.caption(
+        "Задержки успешно доставленных алертов (сек): от времени транзакции до доставки в Telegram. "
+        f"Неудачных попыток отправки: {metrics.failure_count()}"
+    )
+    if not any(row['count'] for row in summary):
+        st.caption("Доставленных алертов с отметками этапов пока нет.")
+        return
+    summary_df = pd.DataFrame(summary).set_index('label').drop(columns=['interval'])
+    st.dataframe(summary_df.round(2), use_container_width=True)
+    labels = {row['label']: row['interval'] for row in summary}
+    selected_label = st.selectbox("Гистограмма интервала", list(labels), index=len(labels) - 1, key="alert_latency_interval")
+    st.bar_chart(pd.DataFrame(metrics.histogram(labels[selected_label])).set_index('bucket'))
+    st.download_button(
+        "Скачать метрики задержек (JSON)",
+        data=metrics.export_json(),
+        file_name="alert_latency_metrics.json",
+        mime="application/json",
+        key="alert_latency_export"
+    )
+
 def get_localstorage_size():
     try:
         all_data = localS.getAll() 
         if not all_data:
             return 0.0
         
-        # Считаем только те ключи, которые мы используем: "app_state" и "arkham_alert_cache"
+        # Считаем только те ключи, которые мы используем: разделы настроек и кеш Arkham
         total_size_bytes = 0
-        app_state_raw = localS.getItem("app_settings_storage") # ИСПРАВЛЕНО: используем правильное имя ключа
-        if app_state_raw:
-            total_size_bytes += len(json.dumps("app_settings_storage", ensure_ascii=False)) + len(json.dumps(app_state_raw, ensure_ascii=False))
-        
-        arkham_cache_raw = localS.getItem("arkham_cache_storage") # ИСПРАВЛЕНО: используем правильное имя ключа
-        if arkham_cache_raw:
-            total_size_bytes += len(json.dumps("arkham_cache_storage", ensure_ascii=False)) + len(json.dumps(arkham_cache_raw, ensure_ascii=False))
+        for storage_key in [section[0] for section in SETTINGS_SECTIONS] + ["arkham_cache_storage"]:
+            raw_value = localS.getItem(storage_key)
+            if raw_value:
+                total_size_bytes += len(json.dumps(storage_key, ensure_ascii=False)) + len(json.dumps(raw_value, ensure_ascii=False))
             
         return total_size_bytes / (1024 * 1024)
     except Exception as e:
@@ -809,23 +1236,36 @@ def get_localstorage_size():
 
 def main():
     # print("MAIN_LOOP: Script run started.") # DEBUG
-    initialize_session_state()
+    initialize_session_state() # Загружает .env, поэтому проверка бэкенда доставки идет после нее
+    try:
+        telegram_async.check_backend_available() # Неверная конфигурация доставки останавливает приложение сразу
+    except RuntimeError as e:
+        st.error(str(e))
+        st.stop()
     load_app_settings() # Загружаем настройки, включая alert_history
+    _get_settings_persistence().begin_run()
     
     if st.session_state.get('arkham_monitor') is not None:
         load_arkham_cache(st.session_state.arkham_monitor) # Загружаем кеш Arkham (не настройки алертов)
     
-    # Первоначальный вызов диспетчера на случай, если задачи уже есть в очереди после загрузки
-    # print("MAIN_LOOP: Initial call to _dispatch_next_alert_if_needed.") # DEBUG
-    _dispatch_next_alert_if_needed()
+    # Применяем свежий снимок фонового опроса до отрисовки (алерты по нему уже поставлены в очередь поллером)
+    _apply_poller_snapshot()
+    _reconcile_alert_history_with_outbox()
+    if st.session_state.get('alert_history_updated_by_thread', False):
+        # Статусы обновлены поллером или пулом отправки; ротируем историю, а в localStorage ее запишет финальный save_app_settings()
+        with st.session_state.alert_history_lock:
+            save_alert_history(persist=False)
+        st.session_state.alert_history_updated_by_thread = False
 
     # Критические проверки для остановки приложения, если нет ключа или монитора
     if st.session_state.get('error_message') and not st.session_state.get('arkham_monitor'):
+        save_app_settings() # Фрагмент не будет зарегистрирован — дописываем отложенные разделы сейчас
         st.error(st.session_state.error_message)
         # print("MAIN_LOOP: Critical error - no Arkham monitor and error message present. Stopping.") # DEBUG
         st.stop()
     elif not st.session_state.get('api_key_loaded', False) and not st.session_state.get('arkham_monitor'):
         current_error = st.session_state.get('error_message', "Критическая ошибка: ARKHAM_API_KEY не найден или недействителен, или монитор не создан.")
+        save_app_settings()
         st.error(current_error)
         # print("MAIN_LOOP: Critical error - API key not loaded or no monitor. Stopping.") # DEBUG
         st.stop()
@@ -833,118 +1273,45 @@ def main():
     render_sidebar()
     render_main_content() 
 
-    # Логика обработки завершения потока и перезапуска
-    if st.session_state.get('dispatch_completed_trigger_rerun', False):
-        st.session_state.dispatch_completed_trigger_rerun = False # Сбрасываем флаг немедленно
-        # print("MAIN_LOOP: dispatch_completed_trigger_rerun is True.") # DEBUG
-        if st.session_state.get('alert_history_updated_by_thread', False):
-            # print("MAIN_LOOP: alert_history_updated_by_thread is True. Saving alert history.") # DEBUG
-            save_alert_history(st.session_state.alert_history) # Сохраняем историю, если она была обновлена потоком
-            st.session_state.alert_history_updated_by_thread = False # Сбрасываем флаг после сохранения
-        
-        # print("MAIN_LOOP: Calling _dispatch_next_alert_if_needed before rerun.") # DEBUG
-        _dispatch_next_alert_if_needed() # Пытаемся запустить следующую задачу из очереди, если есть
-        
-        # print("MAIN_LOOP: Triggering st.rerun() due to dispatch_completed_trigger_rerun.") # DEBUG
-        st.rerun() 
-
-    # Дополнительный вызов диспетчера после возможного rerun и перед автообновлением
-    # print("MAIN_LOOP: Calling _dispatch_next_alert_if_needed after rerun logic.") # DEBUG
-    _dispatch_next_alert_if_needed() 
-
-    if st.session_state.get('auto_refresh_enabled', False):
-        interval = st.session_state.get('auto_refresh_interval', 60)
-        
-        # print(f"MAIN_LOOP: Auto-refresh is enabled. Queue size: {len(st.session_state.alert_queue)}, is_sending_alert: {st.session_state.get('is_sending_alert', False)}") # DEBUG
-        # Автообновление только если очередь пуста и нет активной отправки
-        if not st.session_state.alert_queue and not st.session_state.get('is_sending_alert', False):
-            placeholder = st.empty() 
-            # print(f"MAIN_LOOP: Auto-refresh: Sleeping for {interval} seconds.") # DEBUG
-            # Не выводим сообщение об ожидании, если интервал очень короткий
-            if interval > 5 : placeholder.info(f"Автообновление таблицы через {interval} сек...")
-            time.sleep(interval) 
-            placeholder.empty()
-            # print("MAIN_LOOP: Auto-refresh: Woke up. Calling _fetch_and_update_table.") # DEBUG
-            _fetch_and_update_table() # Запрашиваем новые данные
-            # print("MAIN_LOOP: Auto-refresh: Calling _dispatch_next_alert_if_needed after fetch.") # DEBUG
-            _dispatch_next_alert_if_needed() # Обрабатываем новые задачи в очереди
-            # print("MAIN_LOOP: Auto-refresh: Triggering st.rerun().") # DEBUG
-            st.rerun() # Перерисовываем UI
-        else: 
-            # Если очередь не пуста или идет отправка, делаем короткий цикл для обработки очереди
-            # print("MAIN_LOOP: Auto-refresh active, but queue/sending busy. Short sleep and rerun.") # DEBUG
-            time.sleep(1) # Короткая пауза, чтобы не перегружать
-            # print("MAIN_LOOP: Auto-refresh (busy): Calling _dispatch_next_alert_if_needed.") # DEBUG
-            _dispatch_next_alert_if_needed() # Пробуем обработать очередь
-            # print("MAIN_LOOP: Auto-refresh (busy): Triggering st.rerun().") # DEBUG
-            st.rerun() # Перерисовываем для обновления статусов
+    # Автообновление выполняет фоновый поллер; скрипт лишь подписывается и проверяет новые снимки,
+    # поэтому запуск не блокируется на время интервала
+    _sync_background_poller()
     
-    # Финальное сохранение настроек приложения (включая alert_history, если она менялась другими способами)
+    # Финальное сохранение настроек приложения (включая alert_history, если она менялась другими способами);
+    # здесь же записываются разделы, чье окно SETTINGS_SAVE_DEBOUNCE уже прошло
     # print("MAIN_LOOP: Calling final save_app_settings() at the end of script run.") # DEBUG
     save_app_settings()
+
+    # Фрагмент сам перезапускается по таймеру; в рамках полного запуска он лишь регистрируется
+    st.session_state.live_updates_in_app_run = True
+    _render_live_updates()
     # print("MAIN_LOOP: Script run finished.") # DEBUG
 
-def _send_individual_alert_threaded(
-    bot_token: str,
-    chat_id: str,
-    message_html: str,
-    tx_hash: str, 
-    attempt_number: int,
-    original_timestamp: Any 
-):
-    tx_hash_str = str(tx_hash) 
-    # print(f"THREAD_SEND ({tx_hash_str}): Starting attempt {attempt_number}.") # DEBUG_REMOVED
-    try:
-        success = telegram_service.send_telegram_alert(bot_token, chat_id, message_html)
-        send_time = time.time()
-        final_status = ""
-        if success:
-            final_status = "success"
-            # print(f"THREAD_SEND ({tx_hash_str}): Attempt {attempt_number} SUCCESSFUL.") # DEBUG_REMOVED
-        elif attempt_number >= APP_MAX_ALERT_ATTEMPTS:
-            final_status = "error"
-            # print(f"THREAD_SEND ({tx_hash_str}): Attempt {attempt_number} FAILED. Max attempts reached.") # DEBUG_REMOVED
-        else:
-            final_status = "pending"
-            # print(f"THREAD_SEND ({tx_hash_str}): Attempt {attempt_number} FAILED. Will retry. Status set to pending.") # DEBUG_REMOVED
-        
-        # Важно: Обновляем st.session_state.alert_history.
-        # Делаем это через .get().copy() и затем присваивание, чтобы избежать частичных обновлений словаря,
-        # если несколько потоков теоретически попытаются это сделать (хотя is_sending_alert должен это предотвращать)
-        current_alert_entry = st.session_state.alert_history.get(tx_hash_str, {}).copy()
+def _record_alert_result(task: Dict[str, Any], success: bool):
+    """Записывает итог попытки отправки в историю сессии (вызывается из потока пула отправки)."""
+    tx_hash_str = str(task.get('tx_hash'))
+    attempt_number = task.get('attempt_number', 1)
+    send_time = time.time()
+    if success:
+        final_status = "success"
+    elif attempt_number >= APP_MAX_ALERT_ATTEMPTS:
+        final_status = "error"
+    else:
+        final_status = "pending"
+
+    with st.session_state.alert_history_lock:
+        history = _get_destination_history(task.get('destination', alert_routing.MAIN_DESTINATION))
+        current_alert_entry = history.get(tx_hash_str, {}).copy()
         current_alert_entry.update({
             'status': final_status,
             'attempt': attempt_number,
             'last_attempt_time': send_time,
             'sent_time': send_time if success else current_alert_entry.get('sent_time'), 
-            'original_timestamp_from_data': original_timestamp 
+            'next_attempt_at': task.get('next_attempt_at'), # Повтор запланирован пулом — конвейер сессии его не дублирует
+            'original_timestamp_from_data': task.get('original_timestamp')
         })
-        st.session_state.alert_history[tx_hash_str] = current_alert_entry
-        # print(f"THREAD_SEND ({tx_hash_str}): Updated alert_history in session_state: {st.session_state.alert_history[tx_hash_str]}") # DEBUG_REMOVED
-
-    except Exception as e:
-        # print(f"THREAD_SEND ({tx_hash_str}): EXCEPTION during send attempt {attempt_number}: {e}") # DEBUG_REMOVED
-        try:
-            error_status_in_thread = 'error' if attempt_number >= APP_MAX_ALERT_ATTEMPTS else 'pending'
-            
-            current_alert_entry_on_exc = st.session_state.alert_history.get(tx_hash_str, {}).copy()
-            current_alert_entry_on_exc.update({
-                'status': error_status_in_thread,
-                'attempt': attempt_number, 
-                'last_attempt_time': time.time(),
-                'original_timestamp_from_data': original_timestamp
-            })
-            st.session_state.alert_history[tx_hash_str] = current_alert_entry_on_exc
-            # print(f"THREAD_SEND ({tx_hash_str}): Updated alert_history on EXCEPTION: {st.session_state.alert_history[tx_hash_str]}") # DEBUG_REMOVED
-        except Exception as se_e: 
-            # print(f"THREAD_SEND ({tx_hash_str}): Double EXCEPTION while updating session_state: {se_e}") # DEBUG_REMOVED
-            pass 
-    finally:
-        # print(f"THREAD_SEND ({tx_hash_str}): Entering finally block for attempt {attempt_number}.") # DEBUG_REMOVED
-        st.session_state.is_sending_alert = False
-        st.session_state.dispatch_completed_trigger_rerun = True
-        st.session_state.alert_history_updated_by_thread = True 
-        # print(f"THREAD_SEND ({tx_hash_str}): Finished attempt {attempt_number}. Status in history: {st.session_state.alert_history.get(tx_hash_str, {}).get('status')}. Flags set: is_sending_alert=False, dispatch_completed_trigger_rerun=True, alert_history_updated_by_thread=True.") # DEBUG_REMOVED
+        history[tx_hash_str] = current_alert_entry
+    st.session_state.alert_history_updated_by_thread = True 
 
 def _get_rotation_priority_key(item_data: Dict[str, Any]):
     status = item_data.get('status')
@@ -957,13 +1324,13 @@ def _get_rotation_priority_key(item_data: Dict[str, Any]):
     # 3: В процессе отправки (sending) - этот статус очень короткий
     # 4: В очереди (queued) - самый низкий приоритет на удаление / самый высокий на сохранение
 
-    time_value = item_data.get('last_attempt_time', 0) # По умолчанию для сортировки внутри группы
+    time_value = item_data.get('last_attempt_time') or 0 # По умолчанию для сортировки внутри группы
 
     if status == "error" and attempt >= APP_MAX_ALERT_ATTEMPTS:
         priority_group = 0
     elif status == "success":
         priority_group = 1
-        time_value = item_data.get('sent_time', 0) # Для success используем sent_time для более точной сортировки старых
+        time_value = item_data.get('sent_time') or 0 # Для success используем sent_time для более точной сортировки старых
     elif status in ["pending", "error"]: # error здесь означает, что попытки еще есть
         priority_group = 2
     elif status == "sending": 
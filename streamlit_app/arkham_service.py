@@ -2,7 +2,33 @@
 import pandas as pd
 from arkham.arkham_monitor import ArkhamMonitor # Убедиться, что путь импорта соответствует структуре arkham_client
 import requests # Для обработки возможных исключений RequestException
+from requests.adapters import HTTPAdapter
+import base64
+import copy
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from typing import Tuple, List, Dict, Optional, Any, Set # Добавил Any для DataFrame в Python < 3.9 и Set
+import transaction_store # Локальное хранилище полученных транзакций
+
+HTTP_POOL_SIZE = 10 # Размер пула keep-alive соединений к API Arkham для общего монитора
+DEFAULT_RESPONSE_CACHE_TTL = 15.0 # Секунд; переопределяется переменной окружения ARKHAM_RESPONSE_CACHE_TTL
+PLANNER_MAX_TOKENS_PER_REQUEST = 10 # Сколько символов токенов допускается в одном запросе к API
+PLANNER_MAX_NAMES_PER_REQUEST = 25 # Сколько имен адресов (отправителей или получателей) в одном запросе
+PLANNER_MAX_WORKERS = 4 # Сколько частей разбитого запроса выполняется параллельно
+PLANNER_MAX_BATCHES = 8 # Больше частей не создается: каждая запрашивает полный лимит строк
+DEFAULT_CACHE_STATE_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'arkham_cache_state.v2') # ARKHAM_CACHE_STATE_PATH
+CACHE_PERSIST_MIN_INTERVAL = 30 # Сек; новые адреса/токены из запросов пишутся на диск не чаще
+CACHE_DELTA_LOG_SIZE = 256 # Сколько последних поколений кеша хранят свои новые элементы для get_cache_delta
+CACHE_REJECTED_NAMES_SIZE = 4096 # Сколько имен из ответов, которых нет в кеше, помнится до сброса
+CACHE_TOKEN_COLUMNS = ('Символ',) # Колонки ответа, из сущностей которых пополняется кеш токенов
+CACHE_ADDRESS_COLUMNS = ('Откуда', 'Куда') # ... и кеш адресов
 
 def create_monitor(api_key: str) -> Optional[ArkhamMonitor]:
     """Создает и возвращает экземпляр ArkhamMonitor."""
@@ -15,107 +41,630 @@ def create_monitor(api_key: str) -> Optional[ArkhamMonitor]:
         print(f"Error creating ArkhamMonitor: {e}") # Логирование для отладки
         return None
 
-def populate_arkham_cache(monitor: ArkhamMonitor, lookback: str, min_usd: float, limit: int) -> Tuple[List[str], List[str], Optional[str]]:
+# ---- Общий на процесс монитор ----
+
+_shared_monitors: Dict[str, ArkhamMonitor] = {}
+_shared_monitors_lock = threading.Lock()
+
+_io_unlock = threading.local() # Блокировка монитора, которую HTTP-запрос текущего потока отпускает на время ввода-вывода
+
+def _monitor_lock(monitor: ArkhamMonitor):
     """
-    Наполняет внутренний кеш ArkhamMonitor (адреса, токены) и возвращает эти списки.
-    Возвращает (known_tokens, known_addresses, error_message_or_none).
+    Блокировка общего монитора. Она защищает только кеш адресов/токенов (разрешение имен в фильтре,
+    разбор ответа, чтение и загрузка состояния): фильтры у каждого запроса свои (_request_view),
+    а на время HTTP-запроса блокировка отпускается (_install_pooled_session).
+    """
+    lock = getattr(monitor, '_service_lock', None)
+    return lock if lock is not None else nullcontext()
+
+def _find_http_sessions(root: Any, max_depth: int = 3) -> List[requests.Session]:
+    """Объекты requests.Session, достижимые из атрибутов монитора (monitor.<клиент>.<сессия> и т.п.)."""
+    found: List[requests.Session] = []
+    seen: Set[int] = set()
+    stack = [(root, 0)]
+    while stack:
+        obj, depth = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, requests.Session):
+            found.append(obj)
+            continue
+        if depth >= max_depth or isinstance(obj, type) or not hasattr(obj, '__dict__'):
+            continue
+        stack.extend((value, depth + 1) for value in vars(obj).values())
+    return found
+
+def _install_pooled_session(monitor: ArkhamMonitor, pool_size: int) -> List[requests.Session]:
+    """
+    Подключает пул keep-alive соединений к сессиям requests, через которые клиент Arkham действительно
+    отправляет запросы (ищутся среди атрибутов монитора, а не угадываются по имени). На время запроса
+    сессия отпускает блокировку монитора, поэтому запросы разных сессий Streamlit идут параллельно.
+    Если клиент не хранит requests.Session, пул подключить некуда — это ошибка конфигурации.
+    """
+    sessions = _find_http_sessions(monitor)
+    if not sessions:
+        raise RuntimeError(
+            "ArkhamMonitor не хранит requests.Session: пул соединений к API Arkham подключить некуда, "
+            "параллельные запросы общего монитора невозможны."
+        )
+    for session in sessions:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.request = _unlocking_request(session.request)
+    return sessions
+
+def _unlocking_request(send_request):
+    """Обертка Session.request: отпускает блокировку монитора, взятую _run_request, пока идет HTTP-запрос."""
+    def request(*args, **kwargs):
+        lock = getattr(_io_unlock, 'lock', None)
+        if lock is None:
+            return send_request(*args, **kwargs)
+        _io_unlock.lock = None # Вложенные запросы того же потока блокировку уже не трогают
+        lock.release()
+        try:
+            return send_request(*args, **kwargs)
+        finally:
+            lock.acquire()
+            _io_unlock.lock = lock
+    return request
+
+def _request_view(monitor: ArkhamMonitor, filter_params: Dict[str, Any]) -> ArkhamMonitor:
+    """
+    Монитор для одного запроса: общие с monitor кеш, HTTP-клиент и обработчик ответов, но собственный
+    фильтр, поэтому set_filters не меняет состояние общего монитора. Вызывается под блокировкой монитора
+    (set_filters разрешает имена через кеш).
+    """
+    view = copy.copy(monitor)
+    view_filter = copy.copy(monitor.filter)
+    for name, value in vars(view_filter).items():
+        if isinstance(value, (dict, list, set)):
+            setattr(view_filter, name, copy.copy(value)) # set_filters может менять контейнеры фильтра на месте
+    view.filter = view_filter
+    view.set_filters(
+        min_usd=filter_params.get('min_usd'),
+        lookback=filter_params.get('lookback'),
+        token_symbols=filter_params.get('token_symbols'),
+        from_address_names=filter_params.get('from_address_names'),
+        to_address_names=filter_params.get('to_address_names')
+    )
+    return view
+
+def _run_request(monitor: ArkhamMonitor, view: ArkhamMonitor, limit: int) -> pd.DataFrame:
+    """
+    view.get_transactions под блокировкой monitor, которая отпускается только на время HTTP-запроса.
+    Запрос — единственное место, где кеш монитора пополняется, поэтому здесь же учитываются его новые элементы.
+    """
+    lock = getattr(monitor, '_service_lock', None)
+    with lock if lock is not None else nullcontext():
+        _current_cache_generation(monitor) # Учтенные элементы фиксируются до того, как ответ пополнит кеш
+        _io_unlock.lock = lock
+        try:
+            df = view.get_transactions(limit=limit)
+        finally:
+            _io_unlock.lock = None
+        _record_cache_additions(monitor, df)
+        return df
+
+def get_shared_monitor(api_key: str, pool_size: int = HTTP_POOL_SIZE) -> Optional[ArkhamMonitor]:
+    """
+    Возвращает общий для всех сессий процесса ArkhamMonitor (один на API-ключ).
+    Все функции этого модуля берут блокировку монитора, поэтому его можно использовать из разных потоков.
+    Бросает RuntimeError, если к клиенту нельзя подключить пул соединений или у монитора нет фильтра.
+    """
+    if not api_key:
+        return None
+    with _shared_monitors_lock:
+        monitor = _shared_monitors.get(api_key)
+        if monitor is None:
+            monitor = create_monitor(api_key)
+            if monitor is None:
+                return None
+            if getattr(monitor, 'filter', None) is None:
+                raise RuntimeError("У ArkhamMonitor нет атрибута filter: фильтры нельзя задавать на каждый запрос.")
+            monitor._service_lock = threading.RLock()
+            _install_pooled_session(monitor, pool_size)
+            _load_persisted_cache(monitor)
+            _shared_monitors[api_key] = monitor
+        return monitor
+
+def get_cache_state(monitor: ArkhamMonitor) -> Dict[str, Any]:
+    """Возвращает полное состояние кеша монитора под блокировкой."""
+    with _monitor_lock(monitor):
+        return monitor.get_full_cache_state()
+
+def load_cache_state(monitor: ArkhamMonitor, cache_state: Dict[str, Any], only_if_empty: bool = False) -> bool:
+    """
+    Загружает состояние кеша в монитор. При only_if_empty не перезаписывает уже наполненный кеш
+    (общий монитор мог быть прогрет другой сессией). Возвращает True, если состояние было загружено.
+    """
+    with _monitor_lock(monitor):
+        if only_if_empty and (monitor.get_known_token_symbols() or monitor.get_known_address_names()):
+            return False
+        monitor.load_full_cache_state(cache_state)
+        _reset_cache_generation(monitor)
+        return True
+
+# ---- Поколения кеша: что добавилось в списки токенов/адресов с прошлой проверки ----
+
+def _current_cache_generation(monitor: ArkhamMonitor) -> int:
+    """
+    Текущее поколение кеша без просмотра списков монитора: поколения открываются там, где кеш пополняется
+    (_run_request, load_cache_state). Списки читаются только при первом обращении к монитору.
+    Вызывается под блокировкой монитора.
+    """
+    if not hasattr(monitor, '_cache_generation'):
+        monitor._cache_generation = 0
+        monitor._cache_known_tokens = set(monitor.get_known_token_symbols())
+        monitor._cache_known_addresses = set(monitor.get_known_address_names())
+        monitor._cache_delta_log = deque(maxlen=CACHE_DELTA_LOG_SIZE) # (поколение, новые токены, новые адреса)
+        monitor._cache_rejected_names = set() # ("token"/"address", имя) из ответов, которых нет в кеше
+    return monitor._cache_generation
+
+def _response_names(transactions_df: Optional[pd.DataFrame], columns: Tuple[str, ...]) -> Set[str]:
+    """Уникальные непустые значения колонок ответа (символы токенов или сущности адресов)."""
+    names: Set[str] = set()
+    if transactions_df is None:
+        return names
+    for column in columns:
+        if column in transactions_df.columns:
+            names.update(str(value) for value in transactions_df[column].dropna().unique())
+    return names
+
+def _record_cache_additions(monitor: ArkhamMonitor, transactions_df: Optional[pd.DataFrame]) -> int:
+    """
+    Учитывает токены и адреса, добавленные в кеш при разборе ответа transactions_df. Кеш пополняется
+    сущностями из строк ответа, поэтому кандидаты берутся из его колонок (O(ответа)). Списки монитора
+    читаются, только если в ответе есть еще не встречавшиеся имена; имена, которых кеш не принял
+    (например, адреса без сущности), запоминаются и больше сверку не вызывают.
+    Вызывается после запроса под блокировкой монитора. Возвращает текущее поколение.
+    """
+    generation = _current_cache_generation(monitor)
+    rejected = monitor._cache_rejected_names
+    unseen_tokens = [t for t in _response_names(transactions_df, CACHE_TOKEN_COLUMNS)
+                     if t not in monitor._cache_known_tokens and ('token', t) not in rejected]
+    unseen_addresses = [a for a in _response_names(transactions_df, CACHE_ADDRESS_COLUMNS)
+                        if a not in monitor._cache_known_addresses and ('address', a) not in rejected]
+    if not unseen_tokens and not unseen_addresses:
+        return generation
+    # Имена ответа и кеша могут не совпадать по написанию, поэтому новые элементы берутся из самих списков
+    tokens = monitor.get_known_token_symbols()
+    addresses = monitor.get_known_address_names()
+    new_tokens = [t for t in tokens if t not in monitor._cache_known_tokens]
+    new_addresses = [a for a in addresses if a not in monitor._cache_known_addresses]
+    monitor._cache_known_tokens.update(new_tokens)
+    monitor._cache_known_addresses.update(new_addresses)
+    if len(rejected) > CACHE_REJECTED_NAMES_SIZE:
+        rejected.clear()
+    rejected.update(('token', t) for t in unseen_tokens if t not in monitor._cache_known_tokens)
+    rejected.update(('address', a) for a in unseen_addresses if a not in monitor._cache_known_addresses)
+    if not new_tokens and not new_addresses:
+        return generation
+    monitor._cache_generation += 1
+    monitor._cache_delta_log.append((monitor._cache_generation, new_tokens, new_addresses))
+    return monitor._cache_generation
+
+def _reset_cache_generation(monitor: ArkhamMonitor) -> int:
+    """
+    Кеш загружен целиком: дельты прежних поколений недействительны, учтенные элементы перечитываются
+    из списков монитора. Вызывается под блокировкой монитора. Возвращает новое поколение.
     """
+    _current_cache_generation(monitor)
+    monitor._cache_delta_log.clear()
+    monitor._cache_rejected_names.clear()
+    monitor._cache_known_tokens = set(monitor.get_known_token_symbols())
+    monitor._cache_known_addresses = set(monitor.get_known_address_names())
+    monitor._cache_generation += 1
+    return monitor._cache_generation
+
+def get_cache_generation(monitor: ArkhamMonitor) -> int:
+    """Текущее поколение кеша монитора: растет при каждом пополнении списков токенов/адресов."""
     if not monitor:
-        return [], [], "Экземпляр ArkhamMonitor не инициализирован."
+        return 0
+    with _monitor_lock(monitor):
+        return _current_cache_generation(monitor)
+
+def get_cache_delta(monitor: ArkhamMonitor, since_generation: Optional[int]) -> Tuple[int, List[str], List[str], bool]:
+    """
+    Новые токены и адреса после поколения since_generation: (поколение, токены, адреса, полный_список).
+    Если дельта недоступна (since_generation нет, он старше журнала или кеш заменялся целиком),
+    возвращаются полные списки и полный_список = True.
+    """
+    if not monitor:
+        return 0, [], [], True
+    with _monitor_lock(monitor):
+        generation = _current_cache_generation(monitor)
+        if since_generation == generation:
+            return generation, [], [], False
+        log = monitor._cache_delta_log
+        if since_generation is None or since_generation > generation or \
+                not log or log[0][0] > since_generation + 1 or log[-1][0] != generation:
+            return generation, list(monitor.get_known_token_symbols()), list(monitor.get_known_address_names()), True
+        new_tokens: List[str] = []
+        new_addresses: List[str] = []
+        for entry_generation, tokens, addresses in log:
+            if entry_generation > since_generation:
+                new_tokens.extend(tokens)
+                new_addresses.extend(addresses)
+        return generation, new_tokens, new_addresses, False
+
+# ---- Компактная кодировка состояния кеша для localStorage ----
+
+CACHE_ENCODING_PREFIX = "v2:" # Версия кодировки; строка без префикса — прежний обычный JSON
+
+def _pack_cache_value(value: Any, strings: List[str], string_ids: Dict[str, int]) -> Any:
+    """
+    Словарное кодирование: каждая строка (ID, адрес, имя) заменяется номером в общей таблице строк,
+    поэтому повторяющиеся идентификаторы хранятся один раз. Словарь -> ["d", k1, v1, ...],
+    список/множество -> ["l", ...], прочие скаляры -> ["n", значение].
+    """
+    if isinstance(value, str):
+        string_id = string_ids.get(value)
+        if string_id is None:
+            string_id = string_ids[value] = len(strings)
+            strings.append(value)
+        return string_id
+    if isinstance(value, dict):
+        packed = ["d"]
+        for key, item in value.items():
+            packed.append(_pack_cache_value(str(key), strings, string_ids))
+            packed.append(_pack_cache_value(item, strings, string_ids))
+        return packed
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return ["l"] + [_pack_cache_value(item, strings, string_ids) for item in value]
+    return ["n", value]
+
+def _unpack_cache_value(packed: Any, strings: List[str]) -> Any:
+    if isinstance(packed, int):
+        return strings[packed]
+    tag = packed[0]
+    if tag == "d":
+        return {strings[packed[i]]: _unpack_cache_value(packed[i + 1], strings) for i in range(1, len(packed), 2)}
+    if tag == "l":
+        return [_unpack_cache_value(item, strings) for item in packed[1:]]
+    return packed[1]
+
+def encode_cache_state(cache_state: Dict[str, Any], stats: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Кодирует состояние кеша для localStorage: словарь строк + deflate + base64 с префиксом версии.
+    Множества становятся списками, как и при обычном json.dumps. Если передан stats, в него
+    записываются encoded_bytes и encode_ms — статистика принадлежит вызывающему (сессии или файлу).
+    """
+    started = time.perf_counter()
+    strings: List[str] = []
+    packed = _pack_cache_value(cache_state, strings, {})
+    payload = json.dumps([strings, packed], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    encoded = CACHE_ENCODING_PREFIX + base64.b64encode(zlib.compress(payload, 9)).decode('ascii')
+    if stats is not None:
+        stats.update({'encoded_bytes': len(encoded), 'encode_ms': (time.perf_counter() - started) * 1000})
+    return encoded
+
+def cache_state_json_size(cache_state: Dict[str, Any]) -> int:
+    """Размер состояния кеша в обычном JSON (байт) — для сравнения с компактной кодировкой, считается по запросу."""
+    return len(json.dumps(cache_state, ensure_ascii=False, default=list).encode('utf-8'))
+
+def decode_cache_state(raw: str, stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Декодирует состояние кеша из localStorage: компактную кодировку или прежний обычный JSON.
+    Если передан stats, в него записываются stored_bytes и decode_ms.
+    """
+    started = time.perf_counter()
+    if raw.startswith(CACHE_ENCODING_PREFIX):
+        payload = zlib.decompress(base64.b64decode(raw[len(CACHE_ENCODING_PREFIX):]))
+        strings, packed = json.loads(payload.decode('utf-8'))
+        cache_state = _unpack_cache_value(packed, strings)
+    else:
+        cache_state = json.loads(raw)
+    if stats is not None:
+        stats.update({'stored_bytes': len(raw), 'decode_ms': (time.perf_counter() - started) * 1000})
+    return cache_state
+
+# ---- Кеш адресов/токенов на диске сервера, общий для всех сессий ----
+
+_cache_file_lock = threading.Lock()
+
+def _cache_state_path() -> str:
+    return os.getenv("ARKHAM_CACHE_STATE_PATH") or DEFAULT_CACHE_STATE_PATH
+
+def _load_persisted_cache(monitor: ArkhamMonitor) -> bool:
+    """Загружает в общий монитор кеш, сохраненный на диске, чтобы сессии начинали без прогрева через API."""
+    monitor._persisted_cache_generation = 0
+    monitor._persisted_cache_at = 0.0
+    path = _cache_state_path()
     try:
-        monitor.set_filters(min_usd=min_usd, lookback=lookback)
-        # initial_df = monitor.get_transactions(limit=limit) # Сам DataFrame здесь не используется напрямую
-        monitor.get_transactions(limit=limit) # Вызов для побочного эффекта наполнения кеша
-        
-        known_tokens = monitor.get_known_token_symbols()
-        known_addresses = monitor.get_known_address_names()
-        return known_tokens, known_addresses, None
-    except requests.exceptions.RequestException as e:
-        error_msg = f"Сетевая ошибка при обновлении кеша Arkham: {e}"
-        print(error_msg)
-        return [], [], error_msg
+        with _cache_file_lock:
+            if not os.path.exists(path):
+                return False
+            with open(path, 'r', encoding='utf-8') as f:
+                raw = f.read()
+        load_cache_state(monitor, decode_cache_state(raw))
+        with _monitor_lock(monitor):
+            monitor._persisted_cache_generation = _current_cache_generation(monitor)
+            cache_size = len(monitor._cache_known_tokens) + len(monitor._cache_known_addresses)
+        monitor._persisted_cache_at = time.time()
+        print(f"Loaded Arkham cache from {path}: {cache_size} tokens and addresses")
+        return True
     except Exception as e:
-        error_msg = f"Непредвиденная ошибка при обновлении кеша Arkham: {e}"
-        print(error_msg)
-        return [], [], error_msg
+        print(f"Error loading Arkham cache from {path}: {e}")
+        return False
 
-def get_detailed_token_info(monitor: ArkhamMonitor) -> Tuple[Optional[Dict[str, Set[str]]], Optional[str]]:
+def persist_cache_state(monitor: ArkhamMonitor, force: bool = False) -> bool:
     """
-    Получает детализированную информацию о токенах (символ -> множество ID).
-    Возвращает (token_details_map, error_message_or_none).
+    Ставит сохранение кеша общего монитора на диск в очередь фоновой записи, если в нем появились
+    новые адреса/токены. Снимок, кодирование и запись выполняет поток записи, а не вызывающий запрос.
+    Без force файл пишется не чаще CACHE_PERSIST_MIN_INTERVAL. Возвращает True, если запись запланирована.
     """
-    if not monitor:
-        return None, "Экземпляр ArkhamMonitor не инициализирован."
+    if not hasattr(monitor, '_persisted_cache_generation'): # Монитор создан не через get_shared_monitor — его кеш не сохраняется
+        return False
+    with _monitor_lock(monitor):
+        if _current_cache_generation(monitor) == monitor._persisted_cache_generation:
+            return False
+    _get_cache_writer().request(monitor, force)
+    return True
+
+def _write_cache_state(monitor: ArkhamMonitor) -> bool:
+    """Записывает снимок кеша монитора в файл (вызывается потоком записи). Возвращает True, если файл записан."""
+    with _monitor_lock(monitor):
+        generation = _current_cache_generation(monitor)
+        if generation == monitor._persisted_cache_generation:
+            return False
+        cache_state = monitor.get_full_cache_state()
+    path = _cache_state_path()
     try:
-        token_map = monitor.get_token_symbol_map()
-        # Дополнительно отфильтруем, чтобы ключи соответствовали get_known_token_symbols()
-        # Это важно, если get_token_symbol_map может содержать больше символов, чем get_known_token_symbols
-        known_symbols = monitor.get_known_token_symbols()
-        filtered_token_map = {sym: ids for sym, ids in token_map.items() if sym in known_symbols}
-        return filtered_token_map, None
+        encoded = encode_cache_state(cache_state)
+        with _cache_file_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(encoded)
+            os.replace(tmp_path, path) # Атомарная замена: при сбое остается прежний файл
+        with _monitor_lock(monitor):
+            # Поколение считается сохраненным только после успешной замены файла
+            monitor._persisted_cache_generation = max(monitor._persisted_cache_generation, generation)
+        return True
     except Exception as e:
-        error_msg = f"Непредвиденная ошибка при получении детальной информации о токенах: {e}"
-        print(error_msg)
-        return None, error_msg
+        print(f"Error saving Arkham cache to {path}: {e}")
+        return False
+    finally:
+        monitor._persisted_cache_at = time.time() # После ошибки следующая попытка — через интервал, а не сразу
+
+
+class _CacheStateWriter:
+    """
+    Поток записи кеша мониторов на диск. Запросы одного монитора объединяются в одну запись;
+    без force монитор записывается не раньше чем через CACHE_PERSIST_MIN_INTERVAL после прошлой записи.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending: Dict[int, Tuple[ArkhamMonitor, bool]] = {} # id(монитор) -> (монитор, force)
+        self._writing = False
+        self._thread: Optional[threading.Thread] = None
+
+    def request(self, monitor: ArkhamMonitor, force: bool) -> None:
+        with self._condition:
+            _, pending_force = self._pending.get(id(monitor), (monitor, False))
+            self._pending[id(monitor)] = (monitor, force or pending_force)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="arkham-cache-writer", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Ждет, пока не останется запланированных и выполняющихся записей (для тестов и остановки)."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+    def _next_due(self) -> Tuple[Optional[ArkhamMonitor], Optional[float]]:
+        """(монитор, который пора записать, None) или (None, сколько ждать до ближайшей записи)."""
+        now = time.time()
+        wait = None
+        for key, (monitor, force) in self._pending.items():
+            ready_at = monitor._persisted_cache_at + CACHE_PERSIST_MIN_INTERVAL
+            if force or now >= ready_at:
+                del self._pending[key]
+                return monitor, None
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                monitor, wait = self._next_due()
+                if monitor is None:
+                    self._condition.wait(wait)
+                    continue
+                self._writing = True
+            try:
+                _write_cache_state(monitor)
+            except Exception as e:
+                print(f"Error in Arkham cache writer: {e}")
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+
+_cache_writer: Optional[_CacheStateWriter] = None
+_cache_writer_lock = threading.Lock()
+
+def _get_cache_writer() -> _CacheStateWriter:
+    global _cache_writer
+    with _cache_writer_lock:
+        if _cache_writer is None:
+            _cache_writer = _CacheStateWriter()
+        return _cache_writer
+
+# ---- Кеш ответов с TTL и объединением одинаковых запросов ----
+
+class TTLResponseCache:
+    """
+    Кеш ответов Arkham по каноническим параметрам API. Одновременные одинаковые запросы
+    ждут один выполняющийся вызов (single-flight) вместо повторных обращений к API.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        self._in_flight: Dict[str, Dict[str, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_load(self, key: str, loader, refresh: bool = False) -> Any:
+        """
+        Ответ из кеша или результат loader. refresh — не отвечать из кеша (запрос пользователя должен
+        получить свежие данные); свежий результат все равно кешируется, выполняющийся запрос переиспользуется.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not refresh and entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                is_leader = False
+            else:
+                self.misses += 1
+                flight = {'event': threading.Event(), 'result': None, 'error': None}
+                self._in_flight[key] = flight
+                is_leader = True
+
+        if not is_leader:
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+
+        try:
+            result = loader()
+            flight['result'] = result
+            with self._lock:
+                if self.ttl > 0:
+                    self._entries[key] = (time.time() + self.ttl, result)
+                self._evict_expired()
+            return result
+        except Exception as e: # Ошибки не кешируем, но передаем ожидающим
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight['event'].set()
+
+    def _evict_expired(self) -> None:
+        now = time.time()
+        for key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
 
-def get_detailed_address_info(monitor: ArkhamMonitor) -> Tuple[Optional[Dict[str, int]], Optional[str]]:
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses + self.coalesced
+            return {
+                'ttl_seconds': self.ttl,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_ratio': (self.hits + self.coalesced) / total if total else 0.0
+            }
+
+_response_cache: Optional[TTLResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> TTLResponseCache:
+    """Возвращает кеш ответов процесса. TTL читается при первом обращении (после загрузки .env)."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            try:
+                ttl = float(os.getenv("ARKHAM_RESPONSE_CACHE_TTL", DEFAULT_RESPONSE_CACHE_TTL))
+            except ValueError:
+                ttl = DEFAULT_RESPONSE_CACHE_TTL
+            _response_cache = TTLResponseCache(ttl)
+        return _response_cache
+
+def get_response_cache_stats() -> Dict[str, Any]:
+    return get_response_cache().get_stats()
+
+def _response_cache_key(monitor: ArkhamMonitor, api_params: Optional[Dict[str, Any]], filter_params: Dict[str, Any], query_limit: int) -> str:
+    if api_params is not None:
+        canonical = json.dumps(api_params, sort_keys=True, default=str)
+    else:
+        canonical = _filter_set_key(filter_params, query_limit)
+    return f"{id(monitor)}:{canonical}"
+
+def populate_arkham_cache(monitor: ArkhamMonitor, lookback: str, min_usd: float, limit: int) -> Tuple[List[str], List[str], Optional[str]]:
     """
-    Получает детализированную информацию об адресах (имя -> количество связанных ID).
-    Возвращает (address_details_map, error_message_or_none).
+    Наполняет внутренний кеш ArkhamMonitor (адреса, токены) и возвращает эти списки.
+    Возвращает (known_tokens, known_addresses, error_message_or_none).
     """
     if not monitor:
-        return None, "Экземпляр ArkhamMonitor не инициализирован."
+        return [], [], "Экземпляр ArkhamMonitor не инициализирован."
     try:
-        known_names = monitor.get_known_address_names()
-        address_info_map = {}
-        if hasattr(monitor, 'address_cache') and monitor.address_cache is not None:
-            for name in known_names:
-                # Предполагаем, что monitor.address_cache.get_identifiers_by_name(name) существует и возвращает set
-                try:
-                    associated_ids = monitor.address_cache.get_identifiers_by_name(name)
-                    address_info_map[name] = len(associated_ids)
-                except AttributeError: # Если у address_cache нет такого метода
-                    address_info_map[name] = 0 # Или другое значение по умолчанию
-                    print(f"Warning: monitor.address_cache.get_identifiers_by_name отсутствует.")
-                except Exception as e_inner:
-                    print(f"Error getting ID count for address {name}: {e_inner}")
-                    address_info_map[name] = 0 # Ошибка при получении, ставим 0
-        else:
-            # Если нет address_cache, заполняем нулями или другим индикатором
-            for name in known_names:
-                address_info_map[name] = 0 
-            print("Warning: monitor.address_cache отсутствует. Детальная информация по адресам не будет полной.")
-            
-        return address_info_map, None
+        with _monitor_lock(monitor):
+            view = _request_view(monitor, {'min_usd': min_usd, 'lookback': lookback})
+        # Сам DataFrame здесь не используется напрямую
+        _run_request(monitor, view, limit) # Вызов для побочного эффекта наполнения кеша
+        with _monitor_lock(monitor):
+            known_tokens = monitor.get_known_token_symbols()
+            known_addresses = monitor.get_known_address_names()
+        persist_cache_state(monitor, force=True)
+        return known_tokens, known_addresses, None
+    except requests.exceptions.RequestException as e:
+        error_msg = f"Сетевая ошибка при обновлении кеша Arkham: {e}"
+        print(error_msg)
+        return [], [], error_msg
     except Exception as e:
-        error_msg = f"Непредвиденная ошибка при получении детальной информации об адресах: {e}"
+        error_msg = f"Непредвиденная ошибка при обновлении кеша Arkham: {e}"
         print(error_msg)
-        return None, error_msg
+        return [], [], error_msg
 
-def fetch_transactions(monitor: ArkhamMonitor, filter_params: Dict[str, Any], query_limit: int) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[Dict[str, Any]]]:
+def fetch_transactions(
+    monitor: ArkhamMonitor, filter_params: Dict[str, Any], query_limit: int, use_response_cache: bool = True,
+    split_batches: bool = True
+) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[Dict[str, Any]]]:
     """
     Получает транзакции на основе заданных фильтров.
     Возвращает (transactions_df, error_message_or_none, api_params_for_debug).
     filter_params может содержать: min_usd, lookback, token_symbols, from_address_names, to_address_names
+    use_response_cache=False — не отвечать из кеша ответов (запрос, запущенный пользователем).
+    split_batches=False — не разбивать фильтр планировщиком (часть уже разбитого запроса).
     """
     api_params_for_debug = None # Инициализируем
     if not monitor:
         return None, "Экземпляр ArkhamMonitor не инициализирован.", api_params_for_debug
+    batches = plan_filter_batches(filter_params) if split_batches else [filter_params]
+    if len(batches) > 1:
+        return _fetch_transactions_batched(monitor, batches, query_limit, use_response_cache)
     try:
         active_filters = {k: v for k, v in filter_params.items() if v is not None}
-        
-        monitor.set_filters(
-            min_usd=active_filters.get('min_usd'),
-            lookback=active_filters.get('lookback'),
-            token_symbols=active_filters.get('token_symbols'),
-            from_address_names=active_filters.get('from_address_names'),
-            to_address_names=active_filters.get('to_address_names')
-        )
-        # Получаем сформированные параметры API для отладки
-        if hasattr(monitor, 'filter') and monitor.filter is not None:
-             api_params_for_debug = monitor.filter.get_api_params(limit=query_limit)
-             
-        transactions_df = monitor.get_transactions(limit=query_limit)
+
+        # Фильтры сессии живут в отдельном мониторе-представлении; общий монитор не меняется
+        with _monitor_lock(monitor):
+            view = _request_view(monitor, active_filters)
+            # Получаем сформированные параметры API для отладки (они же ключ кеша ответов)
+            api_params_for_debug = view.filter.get_api_params(limit=query_limit)
+
+        def load_transactions():
+            df = _run_request(monitor, view, query_limit)
+            # В локальное хранилище пишутся только ответы API, а не повторы из кеша ответов
+            store = transaction_store.get_transaction_store()
+            if store is not None and df is not None:
+                try:
+                    store.record(df, active_filters, query_limit, _lookback_seconds(active_filters.get('lookback')))
+                except Exception as e:
+                    print(f"Error saving transactions to local store: {e}")
+            return df
+
+        cache_key = _response_cache_key(monitor, api_params_for_debug, active_filters, query_limit)
+        transactions_df = get_response_cache().get_or_load(cache_key, load_transactions, refresh=not use_response_cache)
+        if transactions_df is not None:
+            transactions_df = transactions_df.copy(deep=False) # Закешированный DataFrame общий для всех сессий
+        persist_cache_state(monitor) # Запрос мог пополнить кеш новыми адресами/токенами
         return transactions_df, None, api_params_for_debug
     except requests.exceptions.RequestException as e:
         error_msg = f"Сетевая ошибка при запросе транзакций Arkham: {e}"
@@ -124,4 +673,229 @@ def fetch_transactions(monitor: ArkhamMonitor, filter_params: Dict[str, Any], qu
     except Exception as e:
         error_msg = f"Непредвиденная ошибка при запросе транзакций Arkham: {e}"
         print(error_msg)
-        return None, error_msg, api_params_for_debug 
\ No newline at end of file
+        return None, error_msg, api_params_for_debug 
+
+def fetch_transactions_local_first(
+    monitor: ArkhamMonitor, filter_params: Dict[str, Any], query_limit: int, use_response_cache: bool = True
+) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Как fetch_transactions, но сначала пробует ответить из локального хранилища:
+    сужение недавно запрошенных фильтров не требует обращения к API. Покрытие должно быть не старше
+    TTL кеша ответов, поэтому локальный ответ не устаревает сильнее ответа из кеша.
+    """
+    active_filters = {k: v for k, v in filter_params.items() if v is not None}
+    store = transaction_store.get_transaction_store()
+    if store is not None:
+        try:
+            local_df = store.query(
+                active_filters, query_limit, _lookback_seconds(active_filters.get('lookback')), max_age=get_response_cache().ttl
+            )
+        except Exception as e:
+            print(f"Error querying local transaction store: {e}")
+            local_df = None
+        if local_df is not None:
+            return local_df, None, {'source': 'local_store', 'filters': active_filters, 'limit': query_limit}
+    return fetch_transactions(monitor, filter_params, query_limit, use_response_cache)
+
+# ---- Планировщик: разбиение больших фильтров на параллельные запросы ----
+
+def _chunks(values: Optional[List[str]], size: int) -> List[Optional[List[str]]]:
+    if not values:
+        return [values]
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def plan_filter_batches(filter_params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Разбивает фильтр с длинными списками токенов/адресов на несколько ограниченных по размеру запросов.
+    Части образуют декартово произведение кусков, поэтому их объединение равно исходному фильтру.
+    Частей не больше PLANNER_MAX_BATCHES: при превышении куски самого раздробленного списка укрупняются.
+    """
+    chunk_sizes = {
+        'token_symbols': PLANNER_MAX_TOKENS_PER_REQUEST,
+        'from_address_names': PLANNER_MAX_NAMES_PER_REQUEST,
+        'to_address_names': PLANNER_MAX_NAMES_PER_REQUEST
+    }
+    while True:
+        chunks = {key: _chunks(filter_params.get(key), size) for key, size in chunk_sizes.items()}
+        if len(chunks['token_symbols']) * len(chunks['from_address_names']) * len(chunks['to_address_names']) <= PLANNER_MAX_BATCHES:
+            break
+        widest = max(chunks, key=lambda key: len(chunks[key]))
+        chunk_sizes[widest] *= 2
+    batches = []
+    for tokens, from_names, to_names in itertools.product(chunks['token_symbols'], chunks['from_address_names'], chunks['to_address_names']):
+        batch = dict(filter_params)
+        batch['token_symbols'] = tokens
+        batch['from_address_names'] = from_names
+        batch['to_address_names'] = to_names
+        batches.append(batch)
+    return batches
+
+def _sort_by_time_desc(df: pd.DataFrame) -> pd.DataFrame:
+    if 'Время' not in df.columns:
+        return df
+    order = pd.to_datetime(df['Время'], errors='coerce', utc=True)
+    if not order.notna().any():
+        return df
+    return df.loc[order.sort_values(ascending=False, kind='mergesort', na_position='last').index]
+
+def _fetch_transactions_batched(
+    monitor: ArkhamMonitor, batches: List[Dict[str, Any]], query_limit: int, use_response_cache: bool = True
+) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Выполняет части запроса параллельно через общий монитор (у каждой части свой фильтр, HTTP-запросы
+    идут через общий пул соединений) и объединяет результат: без дублей TxID, от новых к старым, с лимитом.
+    Найденные частями адреса и токены сразу попадают в кеш общего монитора.
+    """
+    def run_batch(batch: Dict[str, Any]):
+        # Каждая часть запрашивает полный лимит: иначе верхние query_limit строк объединения могут быть неверны
+        return fetch_transactions(monitor, batch, query_limit, use_response_cache, split_batches=False)
+
+    with ThreadPoolExecutor(max_workers=min(PLANNER_MAX_WORKERS, len(batches)), thread_name_prefix="arkham-planner") as executor:
+        results = list(executor.map(run_batch, batches))
+
+    batch_params = []
+    frames = []
+    for df, error, api_params in results:
+        if error:
+            return None, error, {'batches': len(batches), 'batch_params': batch_params + [api_params]}
+        batch_params.append(api_params)
+        if df is not None and not df.empty:
+            frames.append(df)
+
+    api_params_for_debug = {'batches': len(batches), 'batch_params': batch_params}
+    if not frames:
+        return pd.DataFrame(), None, api_params_for_debug
+    merged_df = pd.concat(frames, ignore_index=True)
+    if 'TxID' in merged_df.columns:
+        merged_df = merged_df.drop_duplicates(subset='TxID', keep='first')
+    merged_df = _sort_by_time_desc(merged_df).head(query_limit).reset_index(drop=True)
+    return merged_df, None, api_params_for_debug
+
+# ---- Инкрементальная загрузка по водяному знаку ----
+
+# Доступные в фильтре Arkham периоды (в секундах), от меньшего к большему
+LOOKBACK_SECONDS = {'1h': 3600, '6h': 6 * 3600, '12h': 12 * 3600, '24h': 24 * 3600, '3d': 3 * 86400, '7d': 7 * 86400, '30d': 30 * 86400}
+INCREMENTAL_PROBE_LIMIT = 10 # Начальный размер "пробного" запроса новых транзакций
+INCREMENTAL_OVERLAP_SECONDS = 600 # Запас по времени на задержку индексации транзакций в Arkham
+INCREMENTAL_FULL_REFRESH_SECONDS = 900 # Периодическая полная пересинхронизация окна
+
+def _filter_set_key(filter_params: Dict[str, Any], query_limit: int) -> str:
+    """Канонический ключ набора фильтров (порядок элементов списков не важен)."""
+    canonical = {}
+    for k, v in filter_params.items():
+        if isinstance(v, (list, tuple, set)):
+            v = sorted(str(x) for x in v)
+        canonical[k] = v
+    return repr((sorted(canonical.items()), query_limit))
+
+LOOKBACK_UNIT_SECONDS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+def _lookback_seconds(lookback: Optional[str]) -> Optional[float]:
+    """Длительность периода фильтра в секундах ('1h', '90m', '2d'...) или None, если период не распознан."""
+    if not lookback:
+        return None
+    if lookback in LOOKBACK_SECONDS:
+        return LOOKBACK_SECONDS[lookback]
+    unit = LOOKBACK_UNIT_SECONDS.get(str(lookback)[-1:])
+    try:
+        return float(str(lookback)[:-1]) * unit if unit else None
+    except ValueError:
+        return None
+
+def _narrowest_lookback(seconds_needed: float, max_lookback: Optional[str]) -> Optional[str]:
+    """
+    Минимальный период фильтра, покрывающий нужный интервал, но не шире заданного пользователем.
+    Если период пользователя не распознан, он не сужается (иначе можно выйти за его границы).
+    """
+    max_seconds = _lookback_seconds(max_lookback)
+    if max_lookback and max_seconds is None:
+        return max_lookback
+    for name, seconds in LOOKBACK_SECONDS.items():
+        if max_seconds is not None and seconds >= max_seconds:
+            break
+        if seconds >= seconds_needed:
+            return name
+    return max_lookback
+
+def _txid_set(df: Optional[pd.DataFrame]) -> Set[str]:
+    if df is None or df.empty or 'TxID' not in df.columns:
+        return set()
+    return set(df['TxID'].dropna().astype(str))
+
+def fetch_transactions_incremental(
+    monitor: ArkhamMonitor,
+    filter_params: Dict[str, Any],
+    query_limit: int,
+    state: Optional[Dict[str, Any]]
+) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame], Optional[str], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Получает только транзакции новее водяного знака и вливает их в скользящее окно.
+    Возвращает (window_df, new_df, error_message_or_none, api_params_for_debug, new_state).
+    state — значение, возвращенное предыдущим вызовом для того же потребителя (или None).
+    """
+    key = _filter_set_key(filter_params, query_limit)
+    now = time.time()
+    needs_full_fetch = (
+        state is None or state.get('key') != key or
+        state.get('window_df') is None or state['window_df'].empty or
+        now - state.get('full_fetch_at', 0) >= INCREMENTAL_FULL_REFRESH_SECONDS
+    )
+
+    if needs_full_fetch:
+        df, error, api_params_debug = fetch_transactions(monitor, filter_params, query_limit)
+        if error:
+            return None, None, error, api_params_debug, state
+        window_df = df if df is not None else pd.DataFrame()
+        known_txids = _txid_set(window_df)
+        # При пересинхронизации новыми считаются только TxID, которых не было в прежнем окне
+        previous_txids = state.get('known_txids', set()) if state is not None and state.get('key') == key else set()
+        new_df = window_df[~window_df['TxID'].astype(str).isin(previous_txids)] if previous_txids and 'TxID' in window_df.columns else window_df
+        new_state = {
+            'key': key,
+            'window_df': window_df,
+            'known_txids': known_txids,
+            'watermark_txid': str(window_df['TxID'].iloc[0]) if 'TxID' in window_df.columns and not window_df.empty else None,
+            'watermark_time': now,
+            'full_fetch_at': now
+        }
+        return window_df, new_df, None, api_params_debug, new_state
+
+    window_df = state['window_df']
+    known_txids = state['known_txids']
+    # Сужаем период запроса до интервала с момента прошлого опроса
+    incremental_params = dict(filter_params)
+    incremental_params['lookback'] = _narrowest_lookback(
+        now - state['watermark_time'] + INCREMENTAL_OVERLAP_SECONDS, filter_params.get('lookback')
+    )
+    # Наращиваем лимит, пока не дойдем до уже известных транзакций (или до лимита окна)
+    probe_limit = min(INCREMENTAL_PROBE_LIMIT, query_limit)
+    while True:
+        probe_df, error, api_params_debug = fetch_transactions(monitor, incremental_params, probe_limit)
+        if error:
+            return None, None, error, api_params_debug, state
+        probe_df = probe_df if probe_df is not None else pd.DataFrame()
+        reached_known = bool(_txid_set(probe_df) & known_txids)
+        if reached_known or len(probe_df) < probe_limit or probe_limit >= query_limit:
+            break
+        probe_limit = min(probe_limit * 4, query_limit)
+
+    if probe_df.empty or 'TxID' not in probe_df.columns:
+        new_df = probe_df.iloc[0:0]
+    else:
+        new_df = probe_df[~probe_df['TxID'].astype(str).isin(known_txids)]
+
+    if not new_df.empty:
+        # Новые транзакции идут первыми (ответ API отсортирован от новых к старым)
+        window_df = pd.concat([new_df, window_df], ignore_index=True)
+        window_df = window_df.drop_duplicates(subset='TxID', keep='first').head(query_limit).reset_index(drop=True)
+        known_txids = _txid_set(window_df)
+
+    new_state = dict(state)
+    new_state.update({
+        'window_df': window_df,
+        'known_txids': known_txids,
+        'watermark_txid': str(window_df['TxID'].iloc[0]) if not window_df.empty else state.get('watermark_txid'),
+        'watermark_time': now
+    })
+    return window_df, new_df, None, api_params_debug, new_state
@@ -0,0 +1,162 @@
+# Фоновый опрос Arkham, не зависящий от цикла перезапусков Streamlit
+import itertools
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import pandas as pd
+
+import arkham_service
+
+POLL_TICK_SECONDS = 1.0 # Как часто поток проверяет, не пора ли выполнить очередной запрос
+SUBSCRIPTION_IDLE_TIMEOUT = 120 # Через сколько секунд без "пульса" сессии подписка считается брошенной (вкладка закрыта)
+
+# Номера снимков общие для всех поллеров: сессия, сменившая API-ключ, не примет новый снимок за устаревший
+_snapshot_seq = itertools.count(1)
+
+
+class TransactionPoller:
+    """
+    Долгоживущий фоновый поток (один на API-ключ), который сам опрашивает Arkham по расписанию
+    каждой подписанной сессии и публикует последний снимок результатов.
+    Скрипт Streamlit только читает готовый снимок и сразу завершается.
+    Запросы всех сессий ключа поток выполняет по очереди: при многих подписках или медленном API
+    фактический период опроса сессии может превышать ее интервал автообновления.
+    """
+
+    def __init__(self, monitor: Any):
+        self.monitor = monitor # Общий монитор процесса; его блокировку берет arkham_service
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[str, Dict[str, Any]] = {}
+        self._snapshots: Dict[str, Dict[str, Any]] = {}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="arkham-poller", daemon=True)
+        self._thread.start()
+
+    def subscribe(
+        self,
+        session_id: str,
+        filter_params: Dict[str, Any],
+        query_limit: int,
+        interval: float,
+        on_result: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> None:
+        """Регистрирует (или обновляет) расписание опроса для сессии. Повторный вызов служит "пульсом"."""
+        now = time.time()
+        with self._lock:
+            existing = self._subscriptions.get(session_id)
+            params_changed = existing is None or \
+                existing['filter_params'] != filter_params or \
+                existing['query_limit'] != query_limit
+            self._subscriptions[session_id] = {
+                'filter_params': dict(filter_params),
+                'query_limit': query_limit,
+                'interval': max(float(interval), POLL_TICK_SECONDS),
+                'on_result': on_result,
+                # При смене фильтров опрашиваем сразу, иначе сохраняем текущее расписание
+                'next_run': now if params_changed else existing['next_run'],
+                'last_seen': now,
+                # Водяной знак инкрементальной загрузки; при смене фильтров начинаем с полного запроса
+                'incremental_state': None if params_changed else existing.get('incremental_state')
+            }
+
+    def touch(self, session_id: str) -> None:
+        """Продлевает жизнь подписки сессии без изменения параметров."""
+        with self._lock:
+            if session_id in self._subscriptions:
+                self._subscriptions[session_id]['last_seen'] = time.time()
+
+    def unsubscribe(self, session_id: str) -> None:
+        with self._lock:
+            self._subscriptions.pop(session_id, None)
+
+    def is_subscribed(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._subscriptions
+
+    def get_snapshot(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Возвращает последний опубликованный снимок для сессии (или None, если его еще нет)."""
+        with self._lock:
+            return self._snapshots.get(session_id)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(POLL_TICK_SECONDS):
+            now = time.time()
+            with self._lock:
+                # Убираем подписки сессий, которые давно не подавали признаков жизни
+                for session_id in [s for s, sub in self._subscriptions.items()
+                                   if now - sub['last_seen'] > max(SUBSCRIPTION_IDLE_TIMEOUT, 3 * sub['interval'])]:
+                    del self._subscriptions[session_id]
+                    self._snapshots.pop(session_id, None)
+                due = [(s, sub) for s, sub in self._subscriptions.items() if sub['next_run'] <= now]
+                for _, sub in due:
+                    sub['next_run'] = now + sub['interval']
+
+            for session_id, sub in due:
+                self._poll_subscription(session_id, sub)
+
+    def _poll_subscription(self, session_id: str, sub: Dict[str, Any]) -> None:
+        df, new_df, error, api_params_debug, incremental_state = arkham_service.fetch_transactions_incremental(
+            self.monitor, sub['filter_params'], sub['query_limit'], sub.get('incremental_state')
+        )
+        with self._lock:
+            current_sub = self._subscriptions.get(session_id)
+            if current_sub is None: # Сессия отписалась, пока шел запрос
+                return
+            if current_sub['filter_params'] == sub['filter_params'] and current_sub['query_limit'] == sub['query_limit']:
+                current_sub['incremental_state'] = incremental_state
+            snapshot = {
+                'seq': next(_snapshot_seq),
+                'transactions_df': df if df is not None else pd.DataFrame(),
+                'new_transactions_df': new_df if new_df is not None else pd.DataFrame(),
+                'error': error,
+                'api_params_debug': api_params_debug,
+                'fetched_at': time.time()
+            }
+            self._snapshots[session_id] = snapshot
+
+        on_result = sub.get('on_result')
+        if on_result is not None and not error:
+            try:
+                on_result(snapshot)
+            except Exception as e:
+                print(f"Error in poller result handler for session {session_id}: {e}")
+
+
+_pollers: Dict[str, TransactionPoller] = {}
+_pollers_lock = threading.Lock()
+
+def get_poller(api_key: str) -> Optional[TransactionPoller]:
+    """Возвращает поллер для API-ключа (как и общий монитор, один на ключ), создавая его при первом обращении."""
+    if not api_key:
+        return None
+    with _pollers_lock:
+        poller = _pollers.get(api_key)
+        if poller is None:
+            try:
+                monitor = arkham_service.get_shared_monitor(api_key)
+            except Exception as e: # Ошибку создания монитора показывает инициализация приложения
+                print(f"Error creating shared monitor for poller: {e}")
+                return None
+            if monitor is None:
+                return None
+            poller = TransactionPoller(monitor)
+            _pollers[api_key] = poller
+        return poller
+
+def find_poller(api_key: str) -> Optional[TransactionPoller]:
+    """Возвращает уже созданный поллер для API-ключа, не создавая ни поллер, ни монитор."""
+    if not api_key:
+        return None
+    with _pollers_lock:
+        return _pollers.get(api_key)
+
+def unsubscribe_other_keys(session_id: str, api_key: str) -> None:
+    """Снимает подписки сессии у поллеров других API-ключей (сессия сменила ключ)."""
+    with _pollers_lock:
+        pollers = [poller for key, poller in _pollers.items() if key != api_key]
+    for poller in pollers:
+        poller.unsubscribe(session_id)
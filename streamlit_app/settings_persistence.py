@@ -0,0 +1,108 @@
+# Сохранение настроек сессии по разделам: пишутся только изменившиеся разделы, крупные — не чаще окна
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+StateGetter = Callable[[str], Any]
+Writer = Callable[[str, str], None]
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_section(values: Dict[str, Any]) -> str:
+    """JSON раздела настроек (множества сохраняются списками, исходные объекты не изменяются)."""
+    return json.dumps(dict(values, state_version=1), ensure_ascii=False, default=_json_default)
+
+
+def _identity_fingerprint(value: Any) -> Any:
+    """
+    Отпечаток крупного значения без сериализации: истории алертов — (id, revision), словари историй —
+    по истории на получателя, остальное — id и длина объекта (такие значения в session_state заменяются
+    целиком или только дополняются).
+    """
+    revision = getattr(value, 'revision', None)
+    if revision is not None:
+        return ('revision', id(value), revision)
+    if isinstance(value, dict) and value and all(hasattr(v, 'revision') for v in value.values()):
+        return ('revisions', id(value), tuple((k, id(v), v.revision) for k, v in value.items()))
+    return ('id', id(value), len(value) if hasattr(value, '__len__') else None)
+
+
+def _held(value: Any) -> Any:
+    """Ссылки, удерживающие объекты отпечатка (и вложенные истории) от сборки мусора."""
+    return (value, list(value.values())) if isinstance(value, dict) else value
+
+
+class SettingsPersistence:
+    """
+    Следит, какие разделы настроек изменились с последней записи, и пишет только их, каждый под своим
+    ключом localStorage. Мелкие разделы сравниваются по готовому JSON, крупные (by_identity) — по отпечатку
+    без сериализации и записываются не чаще debounce секунд: изменения внутри окна объединяются в одну запись.
+    За один запуск скрипта раздел пишется не больше одного раза (повторная запись ключа в том же
+    запуске конфликтует в компоненте localStorage) — остаток дописывается в следующем запуске.
+    Отложенные изменения пишет только следующий save(): пока его не было (flush_due подсказывает, когда
+    пора перезапустить скрипт), они живут лишь в памяти сессии.
+    """
+
+    def __init__(self, sections: Sequence[Tuple[str, Sequence[str], bool, float]]):
+        # sections: (ключ localStorage, ключи session_state, by_identity, debounce сек)
+        self._sections = [(storage_key, list(keys), by_identity, debounce) for storage_key, keys, by_identity, debounce in sections]
+        self._written: Dict[str, Any] = {} # Отпечаток последней записи раздела
+        self._held_values: Dict[str, List[Any]] = {} # Держим записанные объекты, чтобы их id не переиспользовались
+        self._written_at: Dict[str, float] = {}
+        self._written_this_run: Set[str] = set()
+        self._pending: Set[str] = set() # Разделы с изменениями, отложенными окном или ограничением "раз за запуск"
+
+    def begin_run(self) -> None:
+        """Вызывается в начале каждого запуска скрипта."""
+        self._written_this_run.clear()
+
+    def mark_clean(self, storage_key: str, get_value: StateGetter, present_keys: Sequence[str]) -> None:
+        """Отмечает раздел как уже сохраненный (только что загружен из localStorage) — его не нужно писать обратно."""
+        for section_key, keys, by_identity, _ in self._sections:
+            if section_key == storage_key:
+                self._written[storage_key] = self._fingerprint(keys, by_identity, get_value, present_keys)[0]
+                self._held_values[storage_key] = [_held(get_value(k)) for k in keys if k in present_keys]
+                self._written_at[storage_key] = time.time()
+
+    def save(self, get_value: StateGetter, present_keys: Sequence[str], writer: Writer) -> List[str]:
+        """Записывает изменившиеся разделы, чье окно объединения прошло. Возвращает записанные ключи."""
+        now = time.time()
+        written = []
+        self._pending.clear()
+        for storage_key, keys, by_identity, debounce in self._sections:
+            fingerprint, payload = self._fingerprint(keys, by_identity, get_value, present_keys)
+            if fingerprint == self._written.get(storage_key):
+                continue
+            if storage_key in self._written_this_run or now - self._written_at.get(storage_key, 0.0) < debounce:
+                self._pending.add(storage_key)
+                continue
+            if payload is None:
+                payload = dumps_section({k: get_value(k) for k in keys if k in present_keys})
+            writer(storage_key, payload)
+            self._written[storage_key] = fingerprint
+            self._held_values[storage_key] = [_held(get_value(k)) for k in keys if k in present_keys]
+            self._written_at[storage_key] = now
+            self._written_this_run.add(storage_key)
+            written.append(storage_key)
+        return written
+
+    def flush_due(self) -> bool:
+        """Есть отложенные изменения, окно которых уже прошло (стоит перезапустить скрипт ради записи)."""
+        now = time.time()
+        return any(
+            now - self._written_at.get(storage_key, 0.0) >= debounce
+            for storage_key, _, _, debounce in self._sections if storage_key in self._pending
+        )
+
+    @staticmethod
+    def _fingerprint(keys: Sequence[str], by_identity: bool, get_value: StateGetter, present_keys: Sequence[str]) -> Tuple[Any, Optional[str]]:
+        """(отпечаток, готовый JSON или None). Для мелких разделов отпечаток — сам JSON, он же и пишется."""
+        if by_identity:
+            return tuple((k, _identity_fingerprint(get_value(k))) for k in keys if k in present_keys), None
+        payload = dumps_section({k: get_value(k) for k in keys if k in present_keys})
+        return payload, payload
@@ -0,0 +1,111 @@
+# Asyncio-доставка сообщений Telegram: один поток с event loop вместо потока на сообщение.
+# Требует aiohttp (необязательная зависимость); включается переменной TELEGRAM_DELIVERY_BACKEND=asyncio.
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+try:
+    import aiohttp
+except ImportError: # aiohttp не установлен — asyncio-доставка недоступна (check_backend_available)
+    aiohttp = None
+
+import telegram_service
+
+ASYNC_MAX_IN_FLIGHT = telegram_service.env_number("TELEGRAM_ASYNC_MAX_IN_FLIGHT", 200, int) # Одновременных запросов к Telegram
+
+
+class AsyncTelegramBackend:
+    """
+    Отправляет сообщения из отдельного потока с event loop. Количество одновременных запросов
+    ограничено семафором, лимиты Telegram соблюдаются теми же ведрами токенов, что и в telegram_service.
+    """
+
+    def __init__(self, max_in_flight: int = ASYNC_MAX_IN_FLIGHT):
+        if aiohttp is None:
+            raise RuntimeError("Для asyncio-доставки нужен пакет aiohttp")
+        self._max_in_flight = max_in_flight
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="telegram-async", daemon=True)
+        self._thread.start()
+        self._sessions: Dict[str, "aiohttp.ClientSession"] = {} # Используются только из потока loop
+        self._semaphore = asyncio.run_coroutine_threadsafe(self._create_semaphore(), self._loop).result()
+
+    async def _create_semaphore(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self._max_in_flight)
+
+    def submit(self, bot_token: str, chat_id: str, message_html: str) -> "Future[Tuple[bool, Optional[float]]]":
+        """Ставит отправку в event loop и сразу возвращает Future с (success, retry_after)."""
+        return asyncio.run_coroutine_threadsafe(self._send(bot_token, chat_id, message_html), self._loop)
+
+    def _get_session(self, bot_token: str) -> "aiohttp.ClientSession":
+        session = self._sessions.get(bot_token)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_in_flight, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=telegram_service.TELEGRAM_CONNECT_TIMEOUT,
+                    sock_read=telegram_service.TELEGRAM_READ_TIMEOUT
+                )
+            )
+            self._sessions[bot_token] = session
+        return session
+
+    async def _send(self, bot_token: str, chat_id: str, message_html: str) -> Tuple[bool, Optional[float]]:
+        wait = telegram_service.reserve_send_slot(bot_token, chat_id)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        api_url, payload = telegram_service.build_send_request(bot_token, chat_id, message_html)
+        payload['disable_web_page_preview'] = 'true' # aiohttp не сериализует bool в форме
+        async with self._semaphore:
+            try:
+                async with self._get_session(bot_token).post(api_url, data=payload) as response:
+                    try:
+                        response_data = await response.json(content_type=None)
+                    except ValueError:
+                        response_data = {'description': (await response.text())[:200]}
+                    return telegram_service.parse_send_response(bot_token, chat_id, response.status, response_data)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Network error sending Telegram alert: {e}")
+                return False, None
+            except Exception as e:
+                print(f"Unexpected error sending Telegram alert: {e}")
+                return False, None
+
+    def send_telegram_message(self, bot_token: str, chat_id: str, message_html: str) -> Tuple[bool, Optional[float]]:
+        """Блокирующий вариант с тем же интерфейсом, что telegram_service.send_telegram_message."""
+        return self.submit(bot_token, chat_id, message_html).result()
+
+    def send_telegram_alert(self, bot_token: str, chat_id: str, message_html: str) -> bool:
+        """Тот же интерфейс, что telegram_service.send_telegram_alert."""
+        success, _ = self.send_telegram_message(bot_token, chat_id, message_html)
+        return success
+
+
+_backend: Optional[AsyncTelegramBackend] = None
+_backend_lock = threading.Lock()
+
+def is_enabled() -> bool:
+    """Запрошена ли asyncio-доставка (TELEGRAM_DELIVERY_BACKEND=asyncio)."""
+    return os.getenv("TELEGRAM_DELIVERY_BACKEND", "threads").strip().lower() == "asyncio"
+
+def check_backend_available() -> None:
+    """
+    Проверка при запуске приложения: бросает RuntimeError, если asyncio-доставка запрошена,
+    а aiohttp не установлен. Тихая замена синхронной доставкой скрыла бы ошибку конфигурации.
+    """
+    if is_enabled() and aiohttp is None:
+        raise RuntimeError(
+            "TELEGRAM_DELIVERY_BACKEND=asyncio требует пакет aiohttp: установите его (pip install aiohttp) "
+            "или уберите переменную, чтобы использовать доставку потоками."
+        )
+
+def get_async_backend() -> AsyncTelegramBackend:
+    """Возвращает asyncio-бэкенд процесса. Бросает RuntimeError, если aiohttp не установлен."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            check_backend_available()
+            _backend = AsyncTelegramBackend()
+        return _backend
@@ -1,10 +1,37 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import html
 import time
+import threading
 import re # Добавляем импорт re для регулярных выражений
-from typing import Optional, Dict, Any
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple
+import numpy as np
 import pandas as pd
+
+# Лимиты Telegram Bot API: ~30 сообщений/сек на бота, ~1 сообщение/сек в личный чат, ~20 сообщений/мин в группу
+TELEGRAM_GLOBAL_RATE_PER_SEC = 30.0
+TELEGRAM_CHAT_RATE_PER_SEC = 1.0
+TELEGRAM_GROUP_RATE_PER_SEC = 20.0 / 60.0
+TELEGRAM_DEFAULT_RETRY_AFTER = 5.0 # Если 429 пришел без parameters.retry_after
+TELEGRAM_MESSAGE_LIMIT = 4096 # Максимальная длина текста сообщения
+DIGEST_SEPARATOR = "\n\n"
+
+def env_number(name: str, default, cast=float):
+    """Читает число из переменной окружения; при пустом или некорректном значении возвращает default."""
+    try:
+        return cast(os.getenv(name, default))
+    except (TypeError, ValueError):
+        print(f"Warning: некорректное значение {name}={os.getenv(name)!r}, используется {default}")
+        return default
+
+# Пул keep-alive соединений к api.telegram.org (на токен бота); значения можно переопределить переменными окружения
+TELEGRAM_HTTP_POOL_SIZE = env_number("TELEGRAM_HTTP_POOL_SIZE", 8, int)
+TELEGRAM_CONNECT_TIMEOUT = env_number("TELEGRAM_CONNECT_TIMEOUT", 3.05)
+TELEGRAM_READ_TIMEOUT = env_number("TELEGRAM_READ_TIMEOUT", 10.0)
+TELEGRAM_HTTP_RETRIES = env_number("TELEGRAM_HTTP_RETRIES", 2, int) # Только повторы установки соединения
 # from dotenv import load_dotenv # Больше не нужно
 
 # УДАЛЕНО: Загрузка переменных окружения на уровне модуля
@@ -18,88 +45,261 @@ def _escape_html(text: Optional[str]) -> str:
     # Убираем потенциальные пробелы по краям перед экранированием
     return html.escape(str(text).strip())
 
+_CEX_DEX_PATTERN = re.compile(r'\b(cex|dex)\b', flags=re.IGNORECASE)
+ARKHAM_TX_URL = "https://platform.arkhamintelligence.com/explorer/tx/"
+
+def _bold_upper(match: re.Match) -> str:
+    return f'<b>{match.group(0).upper()}</b>' # Делает CEX/DEX заглавными
+
+@lru_cache(maxsize=8192)
+def _highlight_cex_dex_str(text_raw: str) -> str:
+    """Экранирует имя сущности и выделяет CEX/DEX (с границами слова, без учета регистра). Кешируется по имени."""
+    return _CEX_DEX_PATTERN.sub(_bold_upper, _escape_html(text_raw))
+
+def _highlight_cex_dex(text_raw: Any) -> str:
+    if not isinstance(text_raw, str):
+        return _escape_html(text_raw) # Просто экранируем, если не строка
+    return _highlight_cex_dex_str(text_raw)
+
+def _message_icon(token_symbol_raw: Any) -> str:
+    token_symbol_lower = str(token_symbol_raw).lower() if token_symbol_raw else ""
+    if 'usd' in token_symbol_lower:
+        return "💲"
+    if 'eth' in token_symbol_lower:
+        return "💎"
+    if 'btc' in token_symbol_lower or 'bitcoin' in token_symbol_lower:
+        return "💰"
+    return "🌐" # Иконка по умолчанию
+
+def _format_usd(usd_amount_raw: Any) -> str:
+    # Форматирование USD: просто экранируем исходную строку
+    if usd_amount_raw is None or pd.isna(usd_amount_raw):
+        return "N/A"
+    return _escape_html(str(usd_amount_raw))
+
+def _format_tx_id(tx_id_raw: Any) -> Optional[str]:
+    if tx_id_raw and not pd.isna(tx_id_raw) and str(tx_id_raw).strip() != 'N/A':
+        return _escape_html(str(tx_id_raw)) # Экранируем TxID тоже на всякий случай
+    return None
+
+def _compose_message(icon: str, usd: str, symbol: str, network: str, from_html: str, to_html: str, time_str: str, tx_id: str) -> str:
+    return (
+        f"{icon} <b>{usd}</b> <b>{symbol}</b> ({network})\n"
+        f"<b>From:</b> {from_html}\n"
+        f"<b>To:</b> {to_html}\n"
+        f"<i>{time_str}</i>\n"
+        f"🔗 <a href=\"{ARKHAM_TX_URL}{tx_id}\">View on Arkham</a>"
+    ).strip() # Убираем пустые строки в начале/конце, если они случайно образовались
+
 def format_telegram_message(transaction_row: pd.Series) -> Optional[str]:
-    """Форматирует данные транзакции в HTML-сообщение для Telegram."""
+    """Форматирует данные транзакции (Series или dict строки) в HTML-сообщение для Telegram."""
     try:
-        # Извлечение данных
-        time_str_raw = transaction_row.get("Время", "N/A")
-        network_str_raw = transaction_row.get("Сеть", "N/A")
-        from_str_raw = transaction_row.get("Откуда", "N/A")
-        to_str_raw = transaction_row.get("Куда", "N/A")
-        token_symbol_raw = transaction_row.get("Символ", "N/A")
-        usd_amount_raw = transaction_row.get("USD", None) # Получаем как есть, м.б. None или не число
-        tx_id_raw = transaction_row.get("TxID", None)
-
-        # Экранирование основных строк
-        time_str = _escape_html(time_str_raw)
-        network_str = _escape_html(network_str_raw)
-        token_symbol_str = _escape_html(token_symbol_raw)
-        
-        # ---- Определение иконки ----
-        message_icon = "🌐" # Иконка по умолчанию
-        token_symbol_lower = str(token_symbol_raw).lower() if token_symbol_raw else ""
-        if 'usd' in token_symbol_lower:
-            message_icon = "💲"
-        elif 'eth' in token_symbol_lower:
-            message_icon = "💎"
-        elif 'btc' in token_symbol_lower or 'bitcoin' in token_symbol_lower:
-            message_icon = "💰"
-        # ---- Конец определения иконки ----
-        
-        # Проверка и экранирование TxID
-        tx_id_str = None
-        if tx_id_raw and not pd.isna(tx_id_raw) and str(tx_id_raw).strip() != 'N/A':
-             tx_id_str = _escape_html(str(tx_id_raw)) # Экранируем TxID тоже на всякий случай
-
+        tx_id_str = _format_tx_id(transaction_row.get("TxID", None))
         if not tx_id_str:
             print("Warning: Valid TxID is missing, cannot format Telegram message.")
             return None
-
-        # Форматирование USD: просто экранируем исходную строку
-        usd_amount_formatted = "N/A"
-        if usd_amount_raw is not None and not pd.isna(usd_amount_raw):
-            usd_amount_formatted = _escape_html(str(usd_amount_raw))
-        
-        # Форматирование Откуда/Куда с выделением CEX/DEX
-        def highlight_cex_dex(text_raw):
-            if not isinstance(text_raw, str):
-                return _escape_html(text_raw) # Просто экранируем, если не строка
-            
-            escaped_text = _escape_html(text_raw)
-            
-            # Замена CEX/DEX на <b>CEX</b>/<b>DEX</b> без учета регистра, но с границами слова
-            # Используем функцию для замены, чтобы сохранить регистр слова CEX/DEX если нужно,
-            # но проще сделать их заглавными в теге <b>
-            def replace_match(match):
-                 word = match.group(0)
-                 # return f'<b>{word}</b>' # Сохраняет регистр
-                 return f'<b>{word.upper()}</b>' # Делает заглавными
-                 
-            highlighted_text = re.sub(r'\b(cex|dex)\b', replace_match, escaped_text, flags=re.IGNORECASE)
-            return highlighted_text
-
-        from_str_formatted = highlight_cex_dex(from_str_raw)
-        to_str_formatted = highlight_cex_dex(to_str_raw)
-            
-        # Формирование HTML-сообщения
-        message_html = (
-            f"{message_icon} <b>{usd_amount_formatted}</b> <b>{token_symbol_str}</b> ({network_str})\n"
-            f"<b>From:</b> {from_str_formatted}\n"
-            f"<b>To:</b> {to_str_formatted}\n"
-            f"<i>{time_str}</i>\n"
-            f"🔗 <a href=\"https://platform.arkhamintelligence.com/explorer/tx/{tx_id_str}\">View on Arkham</a>"
+        token_symbol_raw = transaction_row.get("Символ", "N/A")
+        return _compose_message(
+            _message_icon(token_symbol_raw),
+            _format_usd(transaction_row.get("USD", None)), # Получаем как есть, м.б. None или не число
+            _escape_html(token_symbol_raw),
+            _escape_html(transaction_row.get("Сеть", "N/A")),
+            _highlight_cex_dex(transaction_row.get("Откуда", "N/A")),
+            _highlight_cex_dex(transaction_row.get("Куда", "N/A")),
+            _escape_html(transaction_row.get("Время", "N/A")),
+            tx_id_str
         )
-        # Убираем пустые строки в начале/конце, если они случайно образовались
-        return message_html.strip() 
-        
     except Exception as e:
         print(f"Error formatting telegram message: {e}")
         # Добавим вывод самой строки для отладки
-        print(f"Row data causing error: {transaction_row.to_dict()}")
+        print(f"Row data causing error: {dict(transaction_row)}")
         return None
 
-def send_telegram_alert(bot_token: str, chat_id: str, message_html: str) -> bool:
-    """Отправляет HTML-сообщение в Telegram и возвращает статус успеха."""
+def _map_unique(values: pd.Series, func) -> np.ndarray:
+    """Применяет func к каждому уникальному значению колонки один раз и раскладывает результат по строкам."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    results = np.empty(len(uniques) + 1, dtype=object)
+    for i, value in enumerate(uniques):
+        results[i] = func(value)
+    results[-1] = func(np.nan) # codes == -1 (пропуски) указывают на последний элемент
+    return results[codes]
+
+def format_telegram_messages(transactions_df: pd.DataFrame) -> pd.Series:
+    """
+    Пакетная версия format_telegram_message: форматирует все строки DataFrame по колонкам,
+    вычисляя экранирование/выделение один раз на уникальное значение.
+    Возвращает Series HTML с тем же индексом; для строк без валидного TxID — None.
+    """
+    if transactions_df.empty:
+        return pd.Series(dtype=object, index=transactions_df.index)
+
+    def column(name: str, default: Any) -> pd.Series:
+        if name in transactions_df.columns:
+            return transactions_df[name]
+        return pd.Series(default, index=transactions_df.index, dtype=object)
+
+    symbols = column("Символ", "N/A")
+    parts = zip(
+        _map_unique(symbols, _message_icon),
+        _map_unique(column("USD", None), _format_usd),
+        _map_unique(symbols, _escape_html),
+        _map_unique(column("Сеть", "N/A"), _escape_html),
+        _map_unique(column("Откуда", "N/A"), _highlight_cex_dex),
+        _map_unique(column("Куда", "N/A"), _highlight_cex_dex),
+        _map_unique(column("Время", "N/A"), _escape_html),
+        _map_unique(column("TxID", None), _format_tx_id)
+    )
+    messages = [_compose_message(*row_parts) if row_parts[-1] else None for row_parts in parts]
+    return pd.Series(messages, index=transactions_df.index, dtype=object)
+
+def build_digest_messages(messages: List[str], limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[Tuple[str, List[int]]]:
+    """
+    Упаковывает несколько отформатированных сообщений в как можно меньшее число сводок не длиннее limit.
+    Возвращает список (digest_html, индексы исходных сообщений), порядок сообщений сохраняется.
+    """
+    digests: List[Tuple[str, List[int]]] = []
+    current_parts: List[str] = []
+    current_indices: List[int] = []
+    current_body_len = 0 # Длина частей вместе с разделителями, без заголовка
+
+    def header(count: int) -> str:
+        return f"📦 <b>Сводка: {count} транзакций</b>{DIGEST_SEPARATOR}"
+
+    def flush():
+        nonlocal current_body_len
+        current_body_len = 0
+        if not current_parts:
+            return
+        if len(current_parts) == 1: # Одиночное сообщение отправляем как есть
+            digests.append((current_parts[0], list(current_indices)))
+        else:
+            digests.append((header(len(current_parts)) + DIGEST_SEPARATOR.join(current_parts), list(current_indices)))
+        current_parts.clear()
+        current_indices.clear()
+
+    for index, message in enumerate(messages):
+        added_len = len(message) + (len(DIGEST_SEPARATOR) if current_parts else 0)
+        if current_parts and len(header(len(current_parts) + 1)) + current_body_len + added_len > limit:
+            flush()
+            added_len = len(message)
+        current_parts.append(message)
+        current_indices.append(index)
+        current_body_len += added_len
+    flush()
+    return digests
+
+class TokenBucket:
+    """Потокобезопасное ведро токенов. reserve() резервирует токен и возвращает, сколько секунд подождать."""
+
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1 # Может уйти в минус: это очередь резерваций
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._blocked_until - now)
+
+    def delay(self) -> float:
+        """Через сколько секунд будет доступен токен (без резервирования)."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            return max(wait, self._blocked_until - now)
+
+    def block_for(self, seconds: float) -> None:
+        """Блокирует ведро после ответа 429 (retry_after)."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+_buckets: Dict[Tuple[str, Optional[str]], TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+def _get_bucket(bot_token: str, chat_id: Optional[str]) -> TokenBucket:
+    """Ведро на бота (chat_id=None) или на пару бот+чат. Группы/каналы имеют отрицательный chat_id."""
+    key = (bot_token, None if chat_id is None else str(chat_id))
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if chat_id is None:
+                bucket = TokenBucket(TELEGRAM_GLOBAL_RATE_PER_SEC, TELEGRAM_GLOBAL_RATE_PER_SEC)
+            elif str(chat_id).startswith('-'):
+                bucket = TokenBucket(TELEGRAM_GROUP_RATE_PER_SEC, 1)
+            else:
+                bucket = TokenBucket(TELEGRAM_CHAT_RATE_PER_SEC, 1)
+            _buckets[key] = bucket
+        return bucket
+
+def get_send_delay(bot_token: str, chat_id: str) -> float:
+    """Сколько секунд осталось до момента, когда в чат можно отправлять без нарушения лимитов."""
+    return max(_get_bucket(bot_token, None).delay(), _get_bucket(bot_token, chat_id).delay())
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+_http_requests_sent = 0
+
+def _create_session(pool_size: int, retries: int) -> requests.Session:
+    # Повторяем только ошибки установки соединения: запрос точно не ушел, дубля алерта не будет.
+    # Ответы 5xx и ошибки чтения не повторяются — sendMessage не идемпотентен и сообщение могло быть доставлено;
+    # такие случаи повторяет пул отправки по своему расписанию, а 429 обрабатывается лимитером выше.
+    retry = Retry(
+        total=retries, connect=retries, read=0, status=0, other=0,
+        allowed_methods=frozenset({'POST'}), backoff_factor=0.3, raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    return session
+
+def _get_session(bot_token: str) -> requests.Session:
+    """Возвращает переиспользуемую сессию с пулом keep-alive соединений для токена бота."""
+    with _sessions_lock:
+        session = _sessions.get(bot_token)
+        if session is None:
+            session = _create_session(TELEGRAM_HTTP_POOL_SIZE, TELEGRAM_HTTP_RETRIES)
+            _sessions[bot_token] = session
+        return session
+
+def get_http_stats() -> Dict[str, Any]:
+    """Статистика переиспользования соединений к Telegram по всем сессиям."""
+    new_connections = 0
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        requests_sent = _http_requests_sent
+    for session in sessions:
+        pools = session.get_adapter('https://').poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                new_connections += pool.num_connections
+    reused = max(requests_sent - new_connections, 0)
+    return {
+        'sessions': len(sessions),
+        'requests': requests_sent,
+        'new_connections': new_connections,
+        'reused_connections': reused,
+        'reuse_ratio': reused / requests_sent if requests_sent else 0.0
+    }
+
+def reserve_send_slot(bot_token: str, chat_id: str) -> float:
+    """Резервирует отправку в лимитерах бота и чата; возвращает, сколько секунд подождать перед запросом."""
+    return max(_get_bucket(bot_token, None).reserve(), _get_bucket(bot_token, chat_id).reserve())
+
+def build_send_request(bot_token: str, chat_id: str, message_html: str) -> Tuple[str, Dict[str, Any]]:
+    """URL и тело запроса sendMessage (общие для синхронной и asyncio-доставки)."""
     api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
     payload = {
         'chat_id': chat_id,
@@ -107,21 +307,60 @@ def send_telegram_alert(bot_token: str, chat_id: str, message_html: str) -> bool
         'parse_mode': 'HTML',
         'disable_web_page_preview': True
     }
+    return api_url, payload
+
+def parse_send_response(bot_token: str, chat_id: str, status_code: int, response_data: Any) -> Tuple[bool, Optional[float]]:
+    """Разбирает ответ sendMessage в (success, retry_after); при 429 блокирует лимитер чата на retry_after."""
+    if not isinstance(response_data, dict):
+        response_data = {}
+    if status_code == 429:
+        retry_after = TELEGRAM_DEFAULT_RETRY_AFTER
+        try:
+            retry_after = float((response_data.get('parameters') or {}).get('retry_after', retry_after))
+        except (TypeError, ValueError):
+            pass
+        print(f"Telegram rate limit hit for chat {chat_id}, retry after {retry_after} s")
+        _get_bucket(bot_token, chat_id).block_for(retry_after)
+        return False, retry_after
+    if status_code >= 400 or not response_data.get('ok'):
+        print(f"Telegram API error ({status_code}): {response_data.get('description')}")
+        return False, None
+    return True, None
+
+def send_telegram_message(bot_token: str, chat_id: str, message_html: str) -> Tuple[bool, Optional[float]]:
+    """
+    Отправляет HTML-сообщение с соблюдением лимитов Telegram.
+    Возвращает (success, retry_after): retry_after не None, если Telegram ответил 429 —
+    это не ошибка сообщения, его нужно повторить через указанное время.
+    """
+    global _http_requests_sent
+    wait = reserve_send_slot(bot_token, chat_id)
+    if wait > 0:
+        time.sleep(wait)
+
+    api_url, payload = build_send_request(bot_token, chat_id, message_html)
     try:
-        response = requests.post(api_url, data=payload, timeout=10) # Таймаут 10 секунд
-        response.raise_for_status() # Проверка на HTTP ошибки (4xx, 5xx)
-        response_data = response.json()
-        if response_data.get('ok'):
-            return True
-        else:
-            print(f"Telegram API error: {response_data.get('description')}")
-            return False
+        with _sessions_lock:
+            _http_requests_sent += 1
+        response = _get_session(bot_token).post(
+            api_url, data=payload, timeout=(TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+        )
+        try:
+            response_data = response.json()
+        except ValueError:
+            response_data = {'description': response.text[:200]}
+        return parse_send_response(bot_token, chat_id, response.status_code, response_data)
     except requests.exceptions.RequestException as e:
         print(f"Network error sending Telegram alert: {e}")
-        return False
+        return False, None
     except Exception as e:
         print(f"Unexpected error sending Telegram alert: {e}")
-        return False
+        return False, None
+
+def send_telegram_alert(bot_token: str, chat_id: str, message_html: str) -> bool:
+    """Отправляет HTML-сообщение в Telegram и возвращает статус успеха."""
+    success, _ = send_telegram_message(bot_token, chat_id, message_html)
+    return success
 
 # УДАЛЕНО: Пример использования, так как get_telegram_token() удалена
 # if __name__ == '__main__':
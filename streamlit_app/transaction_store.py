@@ -0,0 +1,224 @@
+# Локальное хранилище транзакций (SQLite) для повторной фильтрации без обращения к API
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'transactions.sqlite3')
+LOCAL_ANSWER_MAX_AGE = 15 # Сек; покрытие старше считается устаревшим (arkham_service передает TTL кеша ответов)
+TRANSACTION_RETENTION_SECONDS = 31 * 86400 # Дольше самого длинного периода фильтра (30d)
+COVERAGE_RETENTION_SECONDS = 3600
+COVERAGE_MAX_UNINDEXED_SHARE = 0.05 # Доля строк без разбираемых Время/USD, при которой покрытие еще записывается
+FUTURE_TIME_TOLERANCE = 300 # Сек; "Время" дальше в будущем говорит о том, что это не UTC
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    txid TEXT PRIMARY KEY,
+    ts REAL,
+    symbol TEXT,
+    from_entity TEXT,
+    to_entity TEXT,
+    usd REAL,
+    row_json TEXT NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_ts ON transactions(ts);
+CREATE INDEX IF NOT EXISTS idx_transactions_symbol ON transactions(symbol, ts);
+CREATE INDEX IF NOT EXISTS idx_transactions_from ON transactions(from_entity, ts);
+CREATE INDEX IF NOT EXISTS idx_transactions_to ON transactions(to_entity, ts);
+CREATE TABLE IF NOT EXISTS coverage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    min_usd REAL NOT NULL,
+    token_symbols TEXT NOT NULL,
+    from_address_names TEXT NOT NULL,
+    to_address_names TEXT NOT NULL,
+    lookback_seconds REAL NOT NULL,
+    covered_since REAL NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_coverage_fetched_at ON coverage(fetched_at);
+"""
+
+
+def to_epoch(values: pd.Series) -> pd.Series:
+    """
+    Переводит колонку "Время" в секунды эпохи (None, если не разбирается). Время без часового пояса
+    считается UTC: так его возвращает API Arkham. record() проверяет это допущение по строкам из будущего.
+    Формат ISO 8601 задан явно: без него pandas угадывает формат и разбирает колонку поэлементно.
+    """
+    parsed = pd.to_datetime(values, errors='coerce', utc=True, format='ISO8601')
+    epochs = (parsed - pd.Timestamp(0, tz='UTC')).dt.total_seconds()
+    return epochs.astype(object).where(epochs.notna(), None)
+
+def _name_list(value: Any) -> List[str]:
+    return sorted(str(v) for v in value) if value else []
+
+
+class TransactionStore:
+    """
+    Хранит каждую полученную от API транзакцию (индексы по TxID, времени, токену и сущностям)
+    и журнал "покрытия" выполненных запросов. Запрос, который сужает недавно покрытый запрос
+    (выше мин. USD, подмножество токенов/адресов, короче период), отвечается локально.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self.local_hits = 0
+        self.local_misses = 0
+
+    def record(self, transactions_df: pd.DataFrame, filter_params: Dict[str, Any], query_limit: int, lookback_seconds: Optional[float]) -> None:
+        """
+        Сохраняет результат запроса к API и отмечает, какую область данных он покрывает. Строки без
+        разбираемых Время/USD сохраняются, но локальным запросом не находятся. Поэтому покрытие
+        записывается, только если таких строк не больше COVERAGE_MAX_UNINDEXED_SHARE.
+        """
+        now = time.time()
+        rows = []
+        unindexed = 0 # Строки без разбираемого времени или суммы нельзя фильтровать локально
+        ts_values = pd.Series(dtype=object)
+        if transactions_df is not None and not transactions_df.empty and 'TxID' in transactions_df.columns:
+            ts_values = to_epoch(transactions_df['Время']) if 'Время' in transactions_df.columns else pd.Series(None, index=transactions_df.index, dtype=object)
+            usd_values = pd.to_numeric(transactions_df['USD'], errors='coerce') if 'USD' in transactions_df.columns else pd.Series(None, index=transactions_df.index)
+            records = transactions_df.to_dict('records')
+            for i, record in enumerate(records):
+                tx_id = record.get('TxID')
+                if tx_id is None or pd.isna(tx_id) or tx_id == 'N/A':
+                    continue
+                usd = usd_values.iloc[i]
+                if ts_values.iloc[i] is None or pd.isna(usd):
+                    unindexed += 1
+                rows.append((
+                    str(tx_id),
+                    ts_values.iloc[i],
+                    None if record.get('Символ') is None else str(record.get('Символ')),
+                    None if record.get('Откуда') is None else str(record.get('Откуда')),
+                    None if record.get('Куда') is None else str(record.get('Куда')),
+                    None if pd.isna(usd) else float(usd),
+                    json.dumps(record, ensure_ascii=False, default=str),
+                    now
+                ))
+
+        with self._lock, self._conn:
+            if rows:
+                # Уже сохраненные неизменившиеся строки не перезаписываются (повторные опросы возвращают их снова)
+                self._conn.executemany(
+                    "INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(txid) DO UPDATE SET "
+                    "ts = excluded.ts, symbol = excluded.symbol, from_entity = excluded.from_entity, "
+                    "to_entity = excluded.to_entity, usd = excluded.usd, row_json = excluded.row_json "
+                    "WHERE row_json != excluded.row_json", rows
+                )
+            if lookback_seconds is None or unindexed > COVERAGE_MAX_UNINDEXED_SHARE * len(rows):
+                return
+            known_ts = [t for t in ts_values if t is not None]
+            if known_ts and max(known_ts) > now + FUTURE_TIME_TOLERANCE:
+                # Время не в UTC: окна покрытия посчитались бы со сдвигом, локально такие данные не отдаем
+                print("Warning: transaction times are ahead of the clock; local coverage is not recorded (is 'Время' UTC?)")
+                return
+            if transactions_df is not None and len(transactions_df) >= query_limit:
+                # Ответ обрезан лимитом: надежно покрыт только интервал новее самой старой строки
+                if not known_ts:
+                    return
+                covered_since = min(known_ts)
+            else:
+                covered_since = now - lookback_seconds
+            self._conn.execute(
+                "INSERT INTO coverage (min_usd, token_symbols, from_address_names, to_address_names, "
+                "lookback_seconds, covered_since, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    float(filter_params.get('min_usd') or 0),
+                    json.dumps(_name_list(filter_params.get('token_symbols')), ensure_ascii=False),
+                    json.dumps(_name_list(filter_params.get('from_address_names')), ensure_ascii=False),
+                    json.dumps(_name_list(filter_params.get('to_address_names')), ensure_ascii=False),
+                    lookback_seconds, covered_since, now
+                )
+            )
+
+    def query(self, filter_params: Dict[str, Any], query_limit: int, lookback_seconds: Optional[float], max_age: float = LOCAL_ANSWER_MAX_AGE) -> Optional[pd.DataFrame]:
+        """Отвечает на запрос из локальных данных или возвращает None, если нужен запрос к API."""
+        if lookback_seconds is None:
+            return None
+        now = time.time()
+        min_usd = float(filter_params.get('min_usd') or 0)
+        tokens = _name_list(filter_params.get('token_symbols'))
+        from_names = _name_list(filter_params.get('from_address_names'))
+        to_names = _name_list(filter_params.get('to_address_names'))
+        window_start = now - lookback_seconds
+
+        with self._lock:
+            coverage_rows = self._conn.execute(
+                "SELECT min_usd, token_symbols, from_address_names, to_address_names, lookback_seconds, covered_since "
+                "FROM coverage WHERE fetched_at >= ? AND min_usd <= ? AND lookback_seconds >= ? ORDER BY covered_since ASC",
+                (now - max_age, min_usd, lookback_seconds)
+            ).fetchall()
+
+            for _, c_tokens, c_from, c_to, _, covered_since in coverage_rows:
+                # Пустой список в покрытии означает "без ограничения"
+                if not self._is_subset(tokens, json.loads(c_tokens)) or \
+                   not self._is_subset(from_names, json.loads(c_from)) or \
+                   not self._is_subset(to_names, json.loads(c_to)):
+                    continue
+                fully_covered = covered_since <= window_start
+                result = self._select(min_usd, tokens, from_names, to_names, max(window_start, covered_since), query_limit)
+                if fully_covered or len(result) >= query_limit:
+                    self.local_hits += 1
+                    return result
+            self.local_misses += 1
+            return None
+
+    @staticmethod
+    def _is_subset(requested: List[str], covered: List[str]) -> bool:
+        if not covered:
+            return True
+        return bool(requested) and set(requested) <= set(covered)
+
+    def _select(self, min_usd: float, tokens: List[str], from_names: List[str], to_names: List[str], since: float, limit: int) -> pd.DataFrame:
+        clauses = ["ts >= ?", "usd >= ?"]
+        params: List[Any] = [since, min_usd]
+        for column, values in (('symbol', tokens), ('from_entity', from_names), ('to_entity', to_names)):
+            if values:
+                clauses.append(f"{column} IN ({', '.join('?' for _ in values)})")
+                params.extend(values)
+        params.append(limit)
+        rows = self._conn.execute(
+            f"SELECT row_json FROM transactions WHERE {' AND '.join(clauses)} ORDER BY ts DESC LIMIT ?", params
+        ).fetchall()
+        return pd.DataFrame([json.loads(r[0]) for r in rows])
+
+    def prune(self) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM transactions WHERE stored_at < ?", (now - TRANSACTION_RETENTION_SECONDS,))
+            self._conn.execute("DELETE FROM coverage WHERE fetched_at < ?", (now - COVERAGE_RETENTION_SECONDS,))
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        return {'transactions': count, 'local_hits': self.local_hits, 'local_misses': self.local_misses}
+
+
+_store: Optional[TransactionStore] = None
+_store_lock = threading.Lock()
+
+def get_transaction_store() -> Optional[TransactionStore]:
+    """Возвращает хранилище процесса (путь задается ARKHAM_LOCAL_STORE_PATH) или None, если его не удалось открыть."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            path = os.getenv("ARKHAM_LOCAL_STORE_PATH") or DEFAULT_STORE_PATH
+            try:
+                _store = TransactionStore(path)
+                _store.prune()
+            except Exception as e:
+                print(f"Error opening local transaction store at {path}: {e}")
+                return None
+        return _store
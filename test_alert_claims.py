@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_claims
+
+
+def test_only_one_session_claims_an_alert():
+    index = alert_claims.AlertClaimIndex()
+    assert index.claim_many('42', ['t1', 't2']) == {'t1': 1, 't2': 1}
+    assert index.claim_many('42', ['t1', 't2', 't3']) == {'t3': 1}
+    assert index.claim_many('43', ['t1']) == {'t1': 1} # Другой чат — отдельный алерт
+    index.set_status('42', 't1', 'sending')
+    index.set_status('42', 't2', 'success')
+    assert index.claim_many('42', ['t1', 't2']) == {}
+    entries = index.get_entries('42', ['t1', 't2', 'missing'])
+    assert set(entries) == {'t1', 't2'} and entries['t2']['sent_time']
+    assert not set(entries['t1']) & set(alert_claims.INTERNAL_FIELDS)
+
+
+def test_failed_alerts_are_reclaimed_with_the_next_attempt():
+    index = alert_claims.AlertClaimIndex()
+    index.claim_many('42', ['t1'])
+    index.set_status('42', 't1', 'error', attempt=3)
+    # Сессия без истории по TxID просит попытку 1, но индекс знает о трех
+    assert index.claim_many('42', ['t1'], {'t1': 1}, max_attempts=5) == {'t1': 4}
+    index.set_status('42', 't1', 'error', attempt=5)
+    assert index.claim_many('42', ['t1'], {'t1': 1}, max_attempts=5) == {}
+
+
+def test_scheduled_retries_are_not_reclaimed():
+    index = alert_claims.AlertClaimIndex()
+    index.set_status('42', 't1', 'pending', attempt=1, next_attempt_at=time.time() + 10)
+    assert index.claim_many('42', ['t1']) == {}
+    index.set_status('42', 't2', 'pending', attempt=1, next_attempt_at=time.time() - alert_claims.SCHEDULED_RETRY_GRACE - 1)
+    assert index.claim_many('42', ['t2']) == {'t2': 2}
+
+
+def test_unsubmitted_claims_are_released_or_expire(monkeypatch):
+    index = alert_claims.AlertClaimIndex()
+    index.set_status('42', 't1', 'error', attempt=2)
+    assert index.claim_many('42', ['t1', 't2']) == {'t1': 3, 't2': 1}
+    index.release('42', ['t1', 't2'])
+    assert index.get_entries('42', ['t1', 't2'])['t1']['status'] == 'error'
+    assert index.claim_many('42', ['t1', 't2']) == {'t1': 3, 't2': 1}
+
+    # Захват, не переданный пулу, истекает; переданный (set_status) — нет
+    index.set_status('42', 't2', 'queued', attempt=1)
+    now = time.time()
+    monkeypatch.setattr(alert_claims.time, 'time', lambda: now + alert_claims.UNSUBMITTED_CLAIM_TIMEOUT + 1)
+    assert index.claim_many('42', ['t1', 't2']) == {'t1': 3}
+    index.release('42', ['t2']) # Принятую пулом задачу release не трогает
+    assert index.get_entries('42', ['t2'])['t2']['status'] == 'queued'
+
+
+def test_old_claims_are_evicted():
+    index = alert_claims.AlertClaimIndex(max_claims=2)
+    index.claim_many('42', ['t1', 't2', 't3'])
+    assert set(index.get_entries('42', ['t1', 't2', 't3'])) == {'t2', 't3'}
@@ -0,0 +1,119 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_claims
+import alert_dispatcher
+import telegram_service
+
+
+@pytest.fixture(autouse=True)
+def claim_index(monkeypatch):
+    """Свежий индекс захватов на каждый тест: статусы алертов не переходят между тестами."""
+    index = alert_claims.AlertClaimIndex()
+    monkeypatch.setattr(alert_claims, '_index', index)
+    return index
+
+
+@pytest.fixture
+def make_dispatcher():
+    """Создает пулы отправки и останавливает их потоки после теста."""
+    created = []
+
+    def make(**kwargs):
+        dispatcher = alert_dispatcher.AlertDispatcher(**kwargs)
+        created.append(dispatcher)
+        return dispatcher
+
+    yield make
+    for dispatcher in created:
+        assert dispatcher.shutdown(timeout=5)
+
+
+def _task(chat_id, tx_hash):
+    return {'bot_token': '1:test', 'chat_id': chat_id, 'tx_hash': tx_hash, 'message_html': f'{chat_id}:{tx_hash}', 'attempt_number': 1}
+
+
+def test_messages_keep_chat_order_and_chats_run_in_parallel(monkeypatch, make_dispatcher):
+    sent = []
+    active = {}
+    overlap = {'chats': 0, 'same_chat': False}
+    lock = threading.Lock()
+
+    def fake_send(bot_token, chat_id, message_html):
+        with lock:
+            if active.get(chat_id):
+                overlap['same_chat'] = True
+            active[chat_id] = True
+            overlap['chats'] = max(overlap['chats'], sum(active.values()))
+        time.sleep(0.02)
+        with lock:
+            active[chat_id] = False
+            sent.append(message_html)
+        return True, None
+
+    monkeypatch.setattr(telegram_service, 'send_telegram_message', fake_send)
+    monkeypatch.setattr(telegram_service, 'get_send_delay', lambda bot_token, chat_id: 0.0)
+    dispatcher = make_dispatcher(max_workers=2)
+    done = threading.Semaphore(0)
+    for i in range(5):
+        for chat_id in ('a', 'b'):
+            dispatcher.submit(_task(chat_id, f't{i}'), on_complete=lambda task, success: done.release())
+    for _ in range(10):
+        assert done.acquire(timeout=5)
+
+    assert [m for m in sent if m.startswith('a:')] == [f'a:t{i}' for i in range(5)]
+    assert [m for m in sent if m.startswith('b:')] == [f'b:t{i}' for i in range(5)]
+    assert not overlap['same_chat']
+    assert overlap['chats'] == 2
+    assert dispatcher.pending_count() == 0
+
+
+def test_retry_delay_grows_exponentially_with_jitter(monkeypatch):
+    monkeypatch.setattr(alert_dispatcher, 'RETRY_BASE_DELAY', 30.0)
+    monkeypatch.setattr(alert_dispatcher, 'RETRY_MAX_DELAY', 900.0)
+    for attempt, full_delay in ((1, 30), (2, 60), (3, 120), (10, 900)):
+        delays = [alert_dispatcher.retry_delay(attempt) for _ in range(50)]
+        assert all(full_delay / 2 <= d <= full_delay for d in delays)
+
+
+def test_failed_sends_report_the_scheduled_retry(monkeypatch, make_dispatcher, claim_index):
+    monkeypatch.setattr(telegram_service, 'send_telegram_message', lambda bot_token, chat_id, message_html: (False, None))
+    monkeypatch.setattr(telegram_service, 'get_send_delay', lambda bot_token, chat_id: 0.0)
+    monkeypatch.setattr(alert_dispatcher, 'retry_delay', lambda attempt_number: 60.0)
+    dispatcher = make_dispatcher(max_workers=1)
+    results = []
+    done = threading.Event()
+
+    def on_complete(task, success):
+        results.append((task, success))
+        done.set()
+
+    dispatcher.submit(dict(_task('retry-chat', 't1'), max_attempts=3), on_complete=on_complete)
+    dispatcher.submit(dict(_task('retry-chat', 't2'), max_attempts=1), on_complete=on_complete)
+    deadline = time.time() + 5
+    while len(results) < 2 and time.time() < deadline:
+        done.wait(0.1)
+    by_tx = {task['tx_hash']: task for task, success in results}
+    assert by_tx['t1']['next_attempt_at'] == pytest.approx(time.time() + 60, abs=5)
+    assert by_tx['t2']['next_attempt_at'] is None # Попытки исчерпаны — повтора не будет
+    assert claim_index.get_entries('retry-chat', ['t1'])['t1']['next_attempt_at']
+
+
+def test_shutdown_stops_workers_and_keeps_scheduled_retries_out(monkeypatch, make_dispatcher):
+    monkeypatch.setattr(telegram_service, 'send_telegram_message', lambda bot_token, chat_id, message_html: (False, None))
+    monkeypatch.setattr(telegram_service, 'get_send_delay', lambda bot_token, chat_id: 0.0)
+    monkeypatch.setattr(alert_dispatcher, 'retry_delay', lambda attempt_number: 0.2)
+    dispatcher = make_dispatcher(max_workers=2)
+    done = threading.Event()
+    dispatcher.submit(dict(_task('stop-chat', 't1'), max_attempts=3), on_complete=lambda task, success: done.set())
+    assert done.wait(5)
+    assert dispatcher.shutdown(timeout=5)
+    time.sleep(0.3) # Время повтора наступило, но остановленный пул его не выполняет
+    assert dispatcher.scheduled_retry_count() == 1
+    assert not any(worker.is_alive() for worker in dispatcher._workers)
@@ -0,0 +1,100 @@
+import json
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_history
+
+
+def _entry(last_attempt_time, status='success'):
+    return {'status': status, 'attempt': 1, 'last_attempt_time': last_attempt_time, 'sent_time': None}
+
+
+def test_evict_to_removes_lowest_priority_entries():
+    history = alert_history.AlertHistoryStore({f't{i}': _entry(i) for i in range(10)})
+    history['t0'] = _entry(100) # Новая запись заменяет старую, устаревшая версия в куче игнорируется
+    removed = history.evict_to(7)
+    assert sorted(removed) == ['t1', 't2', 't3']
+    assert len(history) == 7 and 't0' in history
+    assert history.evict_to(7) == []
+
+
+def test_custom_priority_key():
+    priority = lambda entry: (entry['status'] != 'success', entry['last_attempt_time'])
+    history = alert_history.AlertHistoryStore(priority_key=priority)
+    history['pending'] = _entry(1, status='pending')
+    history['old_success'] = _entry(2)
+    history['new_success'] = _entry(3)
+    assert history.evict_to(1) == ['old_success', 'new_success']
+    assert list(history) == ['pending']
+
+
+def test_revision_changes_on_every_mutation():
+    history = alert_history.AlertHistoryStore()
+    revisions = [history.revision]
+
+    def changed():
+        revisions.append(history.revision)
+        return revisions[-1] != revisions[-2]
+
+    history['a'] = _entry(1)
+    assert changed()
+    history.update({'b': _entry(2), 'c': _entry(3)})
+    assert changed()
+    del history['a']
+    assert changed()
+    history.pop('b')
+    assert changed()
+    history.evict_to(0)
+    assert changed()
+    assert history.evict_to(0) == [] and not changed()
+    history['d'] = _entry(4)
+    history.clear()
+    assert changed() and len(history) == 0
+
+
+def test_store_is_a_plain_json_dict_and_copies_keep_priority():
+    history = alert_history.AlertHistoryStore({'a': _entry(1)})
+    assert json.loads(json.dumps(history)) == {'a': _entry(1)}
+    copy = history.copy()
+    assert isinstance(copy, alert_history.AlertHistoryStore)
+    copy['b'] = _entry(0)
+    assert copy.evict_to(1) == ['b']
+    assert 'b' not in history
+
+
+def test_heap_is_compacted_on_frequent_updates():
+    history = alert_history.AlertHistoryStore()
+    for i in range(1000):
+        history['same'] = _entry(i)
+    assert len(history._heap) <= 2 * len(history) + 64 + 1
+
+
+def test_status_frame_marks_missing_entries_as_new():
+    history = alert_history.AlertHistoryStore({
+        'sent': {'status': 'success', 'attempt': 1, 'last_attempt_time': 10.0, 'sent_time': 11.0},
+        'failed': {'status': 'error', 'attempt': 2, 'last_attempt_time': 20.0, 'sent_time': None}
+    })
+    tx_ids = pd.Series(['new', 'sent', 'failed', 'sent'], index=[5, 6, 7, 8])
+    view = history.status_frame(tx_ids)
+    assert list(view.index) == [5, 6, 7, 8]
+    assert list(pd.isna(view['status'])) == [True, False, False, False]
+    assert list(view['status'][1:]) == ['success', 'error', 'success']
+    assert list(view['attempt']) == [0, 1, 2, 1]
+    assert list(view['last_attempt_time']) == [0, 10.0, 20.0, 10.0]
+    assert view.loc[6, 'sent_time'] == 11.0 and pd.isna(view.loc[7, 'sent_time'])
+
+
+def test_status_frame_follows_history_changes():
+    history = alert_history.AlertHistoryStore()
+    tx_ids = pd.Series(['a'])
+    assert pd.isna(history.status_frame(tx_ids)['status'].iloc[0])
+    history['a'] = _entry(5, status='queued')
+    assert history.status_frame(tx_ids)['status'].iloc[0] == 'queued'
+    history['a'] = _entry(6, status='pending')
+    assert history.status_frame(tx_ids)['last_attempt_time'].iloc[0] == 6
+    del history['a']
+    assert pd.isna(history.status_frame(tx_ids)['status'].iloc[0])
@@ -0,0 +1,33 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_metrics
+
+
+def test_summary_and_histogram_per_interval():
+    metrics = alert_metrics.AlertLatencyMetrics()
+    for i in range(10):
+        metrics.record({'transaction': 0.0, 'fetched': 1.0, 'queued': 1.5, 'dispatched': 2.0, 'sent': 2.0 + i})
+    metrics.record({'fetched': 5.0, 'queued': 4.0}) # Часы разошлись — интервал считается нулевым
+    summary = {row['interval']: row for row in metrics.summary()}
+    assert summary['detection']['count'] == 10
+    assert summary['queueing']['count'] == 11
+    assert summary['delivery']['p50'] == pytest.approx(4.5)
+    assert summary['end_to_end']['max'] == pytest.approx(11.0)
+    histogram = metrics.histogram('queueing')
+    assert sum(row['count'] for row in histogram) == 11
+    assert histogram[0]['count'] == 1 and histogram[0]['bucket'].startswith('01.')
+
+
+def test_failed_attempts_are_counted_without_latencies():
+    metrics = alert_metrics.AlertLatencyMetrics()
+    metrics.record({'transaction': 0.0, 'fetched': 1.0, 'queued': 2.0, 'dispatched': 3.0, 'sent': 4.0}, success=False)
+    assert metrics.failure_count() == 1
+    assert all(row['count'] == 0 for row in metrics.summary())
+    exported = json.loads(metrics.export_json())
+    assert exported['failed_attempts'] == 1 and set(exported['samples']) == {name for name, _, _, _ in alert_metrics.INTERVALS}
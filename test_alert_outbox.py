@@ -0,0 +1,75 @@
+import os
+import stat
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_dispatcher
+import alert_outbox
+
+
+def _task(tx_hash, bot_token='123:secret', chat_id='42'):
+    return {'chat_id': chat_id, 'tx_hash': tx_hash, 'bot_token': bot_token, 'message_html': f'<b>{tx_hash}</b>', 'attempt_number': 1}
+
+
+def test_enqueue_is_idempotent_until_failure(tmp_path):
+    outbox = alert_outbox.AlertOutbox(str(tmp_path / 'outbox.sqlite3'))
+    assert outbox.enqueue(_task('t1'))
+    assert not outbox.enqueue(_task('t1')) # Уже в очереди
+    outbox.mark_sending('42', 't1')
+    assert not outbox.enqueue(_task('t1'))
+    outbox.mark_result('42', 't1', alert_outbox.STATUS_PENDING, 1, next_attempt_at=time.time() + 60)
+    assert outbox.enqueue(dict(_task('t1'), attempt_number=2)) # pending -> queued
+    outbox.mark_result('42', 't1', alert_outbox.STATUS_SUCCESS, 2)
+    assert not outbox.enqueue(_task('t1'))
+    entry = outbox.get_entries('42', ['t1', 'missing'])
+    assert list(entry) == ['t1']
+    assert entry['t1']['status'] == 'success' and entry['t1']['attempt'] == 2 and entry['t1']['sent_time']
+
+
+def test_recover_returns_interrupted_and_scheduled_tasks(tmp_path):
+    outbox = alert_outbox.AlertOutbox(str(tmp_path / 'outbox.sqlite3'))
+    for tx in ('queued', 'sending', 'pending', 'done'):
+        outbox.enqueue(_task(tx))
+    outbox.mark_sending('42', 'sending')
+    outbox.mark_result('42', 'pending', alert_outbox.STATUS_PENDING, 1, next_attempt_at=123.0)
+    outbox.mark_result('42', 'done', alert_outbox.STATUS_SUCCESS, 1)
+    recovered = {task['tx_hash']: task for task in outbox.recover()}
+    assert set(recovered) == {'queued', 'sending', 'pending'}
+    assert recovered['pending']['attempt_number'] == 2
+    assert recovered['pending']['next_attempt_at'] == 123.0
+    assert recovered['queued']['next_attempt_at'] is None
+    assert recovered['queued']['bot_token'] == '123:secret'
+
+
+def test_bot_tokens_are_not_written_to_disk(tmp_path):
+    path = str(tmp_path / 'outbox.sqlite3')
+    outbox = alert_outbox.AlertOutbox(path)
+    outbox.enqueue(_task('t1', bot_token='999:very-secret-token'))
+    outbox._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    with open(path, 'rb') as f:
+        assert b'very-secret-token' not in f.read()
+    assert stat.S_IMODE(os.stat(path).st_mode) == alert_outbox.OUTBOX_FILE_MODE
+
+
+def test_recovered_tasks_wait_for_their_bot_token(tmp_path, monkeypatch):
+    outbox = alert_outbox.AlertOutbox(str(tmp_path / 'outbox.sqlite3'))
+    outbox.enqueue(_task('t1', bot_token='777:restart-token'))
+    monkeypatch.setattr(alert_outbox, '_bot_tokens', {}) # Как после перезапуска процесса
+    dispatcher = alert_dispatcher.AlertDispatcher(max_workers=0, outbox=outbox)
+    assert dispatcher.recover() == 1
+    assert dispatcher.awaiting_token_count() == 1
+    assert dispatcher.pending_count() == 0
+    assert dispatcher.release_awaiting(alert_outbox.register_bot_token('777:restart-token'), '777:restart-token') == 1
+    assert dispatcher.awaiting_token_count() == 0
+    assert dispatcher.pending_count('42') == 1
+
+
+def test_recovered_results_are_published(tmp_path):
+    dispatcher = alert_dispatcher.AlertDispatcher(max_workers=0)
+    dispatcher._record_recovered_result({'chat_id': 42, 'tx_hash': 't1'}, True)
+    dispatcher._record_recovered_result({'chat_id': 42, 'tx_hash': 't2'}, False)
+    assert dispatcher.recovered_results_sequence() == 2
+    assert dispatcher.recovered_results_since(0) == (2, [('42', 't1'), ('42', 't2')])
+    assert dispatcher.recovered_results_since(1) == (2, [('42', 't2')])
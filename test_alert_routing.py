@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_routing
+
+
+def test_parse_destinations_validates_entries():
+    destinations, error = alert_routing.parse_destinations(json.dumps([
+        {'name': 'btc', 'chat_id': '-100', 'rule': {'token_symbols': ['BTC']}},
+        {'name': 'all', 'chat_id': 42}
+    ]))
+    assert error is None
+    assert [(d['name'], d['chat_id'], d['bot_token']) for d in destinations] == [('btc', '-100', None), ('all', '42', None)]
+    assert alert_routing.parse_destinations('') == ([], None)
+    for raw in ('{', '{}', '[1]', '[{"name": "x"}]', '[{"name": "main", "chat_id": "1"}]',
+                '[{"name": "x", "chat_id": "1", "rule": {"direction": "sideways"}}]'):
+        destinations, error = alert_routing.parse_destinations(raw)
+        assert destinations == [] and error
+
+
+def test_bot_tokens_are_not_accepted_in_settings(monkeypatch):
+    raw = json.dumps([{'name': 'desk', 'chat_id': '1', 'bot_token': '123:secret'}])
+    destinations, error = alert_routing.parse_destinations(raw)
+    assert destinations == [] and 'bot_token_env' in error
+
+    raw = json.dumps([{'name': 'desk', 'chat_id': '1', 'bot_token_env': 'TEST_DESK_BOT_TOKEN'}])
+    monkeypatch.delenv('TEST_DESK_BOT_TOKEN', raising=False)
+    destinations, error = alert_routing.parse_destinations(raw)
+    assert destinations == [] and 'TEST_DESK_BOT_TOKEN' in error
+    monkeypatch.setenv('TEST_DESK_BOT_TOKEN', '456:from-env')
+    destinations, error = alert_routing.parse_destinations(raw)
+    assert error is None and destinations[0]['bot_token'] == '456:from-env'
+
+
+def test_parsed_destinations_are_cached_but_not_shared():
+    raw = json.dumps([{'name': 'desk', 'chat_id': '1'}])
+    first, _ = alert_routing.parse_destinations(raw)
+    first[0]['chat_id'] = 'changed'
+    hits = alert_routing._parse_destinations_cached.cache_info().hits
+    second, _ = alert_routing.parse_destinations(raw)
+    assert alert_routing._parse_destinations_cached.cache_info().hits == hits + 1
+    assert second[0]['chat_id'] == '1'
+
+
+def test_route_transactions_applies_each_rule():
+    df = pd.DataFrame({
+        'Символ': ['BTC', 'ETH', 'BTC'],
+        'USD': [6e6, 2e6, 1e6],
+        'Откуда': ['Binance CEX', 'wallet', 'wallet'],
+        'Куда': ['wallet', 'Kraken CEX', 'wallet']
+    }, index=[7, 8, 9])
+    routes = alert_routing.route_transactions(df, [
+        {'name': 'all', 'rule': {}},
+        {'name': 'big_btc', 'rule': {'token_symbols': ['BTC'], 'min_usd': 5e6}},
+        {'name': 'inflow', 'rule': {'direction': 'cex_inflow'}}
+    ])
+    assert list(routes['all']) == [True, True, True]
+    assert list(routes['big_btc'][routes['big_btc']].index) == [7]
+    assert list(routes['inflow'][routes['inflow']].index) == [8]
+
+
+def test_parse_rule():
+    assert alert_routing.parse_rule('') == ({}, None)
+    assert alert_routing.parse_rule('{"min_usd": 5}') == ({'min_usd': 5}, None)
+    assert alert_routing.parse_rule('{')[1].startswith('Некорректный JSON')
+    assert alert_routing.parse_rule('{"token_symbols": "BTC"}')[1].startswith('Ошибка в правиле')
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_rules
+
+
+def _frame():
+    return pd.DataFrame({
+        'Символ': ['BTC', 'ETH', 'USDT', 'BTC'],
+        'Сеть': ['bitcoin', 'ethereum', 'tron', 'bitcoin'],
+        'USD': ['$6,000,000', '$2,000,000', None, '$1,500,000'],
+        'Откуда': ['Binance CEX', 'Whale', 'Kraken', 'Coinbase'],
+        'Куда': ['Cold Wallet', 'OKX cex', 'Whale', 'Whale']
+    })
+
+
+def _mask(rule, df=None):
+    df = _frame() if df is None else df
+    return list(alert_rules.evaluate_rules(df, {'r': alert_rules.compile_rule(rule)})['r'])
+
+
+def test_usd_thresholds_per_token():
+    assert _mask({}) == [True, True, True, True]
+    assert _mask({'min_usd': 1.8e6}) == [True, True, False, False]
+    # Порог по токену перекрывает общий, "*" — для остальных токенов; пустой USD не проходит
+    assert _mask({'min_usd': 1e9, 'token_usd_thresholds': {'BTC': 1e6, '*': 3e6}}) == [True, False, False, True]
+
+
+def test_name_filters_are_case_insensitive():
+    assert _mask({'token_symbols': ['btc']}) == [True, False, False, True]
+    assert _mask({'networks': ['Ethereum', 'TRON']}) == [False, True, True, False]
+    assert _mask({'include_entities': ['whale']}) == [False, True, True, True]
+    assert _mask({'exclude_entities': ['WHALE']}) == [True, False, False, False]
+    assert _mask({'from_address_names': ['coinbase'], 'to_address_names': ['whale']}) == [False, False, False, True]
+
+
+def test_direction_uses_cex_marker_and_extra_entities():
+    assert _mask({'direction': 'cex_inflow'}) == [False, True, False, False]
+    assert _mask({'direction': 'cex_outflow'}) == [True, False, False, False]
+    assert _mask({'direction': 'cex_outflow', 'cex_entities': ['Kraken', 'coinbase']}) == [True, False, True, True]
+
+
+def test_missing_columns_do_not_fail():
+    df = pd.DataFrame({'USD': [5.0, 1.0]})
+    assert _mask({'min_usd': 2}, df) == [True, False]
+    assert _mask({'token_symbols': ['BTC']}, df) == [False, False]
+
+
+@pytest.mark.parametrize('rule', [
+    [], {'unknown': 1}, {'min_usd': 'many'}, {'token_usd_thresholds': [1]},
+    {'token_symbols': 'BTC'}, {'direction': 'sideways'}
+])
+def test_invalid_rules_raise_value_error(rule):
+    with pytest.raises(ValueError):
+        alert_rules.compile_rule(rule)
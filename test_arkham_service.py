@@ -0,0 +1,352 @@
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+pytest.importorskip("arkham.arkham_monitor")
+
+import arkham_service
+
+
+def test_narrowest_lookback_picks_smallest_covering_preset():
+    assert arkham_service._narrowest_lookback(1200, '7d') == '1h'
+    assert arkham_service._narrowest_lookback(5 * 3600, '7d') == '6h'
+    assert arkham_service._narrowest_lookback(10 * 86400, '7d') == '7d'
+
+
+def test_narrowest_lookback_never_wider_than_user_lookback():
+    assert arkham_service._narrowest_lookback(20 * 3600, '12h') == '12h'
+    # Периоды не из списка фильтра: пресет шире периода пользователя не выбирается
+    assert arkham_service._narrowest_lookback(2 * 3600, '2h') == '2h'
+    assert arkham_service._narrowest_lookback(1200, '2h') == '1h'
+    assert arkham_service._narrowest_lookback(3 * 3600, '90m') == '90m'
+    assert arkham_service._narrowest_lookback(1200, 'all') == 'all'
+
+
+def test_lookback_seconds():
+    assert arkham_service._lookback_seconds('24h') == 86400
+    assert arkham_service._lookback_seconds('90m') == 5400
+    assert arkham_service._lookback_seconds('2w') == 14 * 86400
+    assert arkham_service._lookback_seconds('bogus') is None
+    assert arkham_service._lookback_seconds(None) is None
+
+
+class FakeFilter:
+    def __init__(self):
+        self.params = {}
+
+    def get_api_params(self, limit):
+        return dict(self.params, limit=limit)
+
+
+class FakeClient:
+    def __init__(self, session):
+        self.session = session
+
+
+class FakeMonitor:
+    """Монитор с тем же устройством, что и ArkhamMonitor: фильтр, клиент с requests.Session и кеш."""
+
+    def __init__(self, session=None):
+        self.filter = FakeFilter()
+        self.client = FakeClient(session)
+        self.seen = []
+
+    def set_filters(self, **kwargs):
+        self.filter.params.update({k: v for k, v in kwargs.items() if v is not None})
+
+    def get_transactions(self, limit=50):
+        self.client.session.request('GET', 'https://api.arkhamintelligence.com/transfers', params=self.filter.get_api_params(limit))
+        self.seen.append(limit)
+        return pd.DataFrame()
+
+    def get_known_token_symbols(self):
+        return []
+
+    def get_known_address_names(self):
+        return []
+
+
+def test_request_view_does_not_change_shared_filters():
+    monitor = FakeMonitor()
+    monitor.set_filters(min_usd=1)
+    view = arkham_service._request_view(monitor, {'min_usd': 5, 'lookback': '24h'})
+    assert view.filter.get_api_params(10) == {'min_usd': 5, 'lookback': '24h', 'limit': 10}
+    assert monitor.filter.params == {'min_usd': 1}
+    assert view.client is monitor.client
+
+
+def test_install_pooled_session_requires_requests_session():
+    with pytest.raises(RuntimeError):
+        arkham_service._install_pooled_session(FakeMonitor(session=None), 4)
+
+
+def test_requests_through_shared_monitor_run_concurrently():
+    state = {'active': 0, 'max_active': 0}
+    state_lock = threading.Lock()
+
+    def slow_request(*args, **kwargs):
+        with state_lock:
+            state['active'] += 1
+            state['max_active'] = max(state['max_active'], state['active'])
+        time.sleep(0.2)
+        with state_lock:
+            state['active'] -= 1
+
+    session = requests.Session()
+    session.request = slow_request
+    monitor = FakeMonitor(session)
+    monitor._service_lock = threading.RLock()
+    assert arkham_service._install_pooled_session(monitor, 4) == [session]
+    assert session.get_adapter('https://api.arkhamintelligence.com')._pool_maxsize == 4
+
+    def run(lookback):
+        with arkham_service._monitor_lock(monitor):
+            view = arkham_service._request_view(monitor, {'lookback': lookback})
+        arkham_service._run_request(monitor, view, 10)
+
+    threads = [threading.Thread(target=run, args=(lookback,)) for lookback in ('1h', '6h', '24h')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert state['max_active'] == 3
+    assert monitor.seen == [10, 10, 10]
+    assert monitor.filter.params == {}
+
+
+def test_ttl_response_cache_hits_and_refresh():
+    cache = arkham_service.TTLResponseCache(ttl=60)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_load('k', loader) == 1
+    assert cache.get_or_load('k', loader) == 1
+    assert cache.get_or_load('k', loader, refresh=True) == 2
+    assert cache.get_or_load('k', loader) == 2
+    assert cache.get_stats()['hits'] == 2
+
+
+def test_ttl_response_cache_expires_and_skips_errors():
+    cache = arkham_service.TTLResponseCache(ttl=0)
+    assert cache.get_or_load('k', lambda: 'a') == 'a'
+    assert cache.get_or_load('k', lambda: 'b') == 'b'
+
+    def failing():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        cache.get_or_load('e', failing)
+    assert cache.get_or_load('e', lambda: 'ok') == 'ok'
+
+
+def test_ttl_response_cache_coalesces_concurrent_loads():
+    cache = arkham_service.TTLResponseCache(ttl=60)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_loader():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_load('k', slow_loader)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(cache.get_or_load('k', slow_loader)))
+    follower.start()
+    time.sleep(0.1)
+    release.set()
+    leader.join()
+    follower.join()
+    assert results == ['result', 'result']
+    assert len(calls) == 1
+    assert cache.get_stats()['coalesced'] == 1
+
+
+def test_plan_filter_batches_small_filter_is_one_batch():
+    params = {'min_usd': 1, 'token_symbols': ['ETH'], 'from_address_names': None, 'to_address_names': None}
+    assert arkham_service.plan_filter_batches(params) == [params]
+
+
+def test_plan_filter_batches_splits_and_caps():
+    tokens = [f'T{i}' for i in range(35)]
+    names = [f'N{i}' for i in range(60)]
+    params = {'token_symbols': tokens, 'from_address_names': names, 'to_address_names': None}
+    batches = arkham_service.plan_filter_batches(params)
+    assert 1 < len(batches) <= arkham_service.PLANNER_MAX_BATCHES
+    token_chunks = {tuple(b['token_symbols']) for b in batches}
+    name_chunks = {tuple(b['from_address_names']) for b in batches}
+    assert len(batches) == len(token_chunks) * len(name_chunks) # Декартово произведение кусков
+    assert sorted(x for chunk in token_chunks for x in chunk) == sorted(tokens)
+    assert sorted(x for chunk in name_chunks for x in chunk) == sorted(names)
+
+
+def test_batched_fetch_runs_through_shared_monitor(monkeypatch):
+    monkeypatch.setattr(arkham_service.transaction_store, 'get_transaction_store', lambda: None)
+    monkeypatch.setattr(arkham_service, 'get_response_cache', lambda: arkham_service.TTLResponseCache(0))
+
+    class TokenMonitor(FakeMonitor):
+        def get_transactions(self, limit=50):
+            self.seen.append(tuple(self.filter.params['token_symbols']))
+            return pd.DataFrame([
+                {'TxID': f'{symbol}-tx', 'Время': f'2024-01-01 00:00:{i:02d}'}
+                for i, symbol in enumerate(self.filter.params['token_symbols'])
+            ])
+
+    monitor = TokenMonitor()
+    monitor._service_lock = threading.RLock()
+    tokens = [f'T{i:02d}' for i in range(25)]
+    df, error, debug = arkham_service.fetch_transactions(monitor, {'token_symbols': tokens}, 100)
+    assert error is None
+    assert debug['batches'] == 3
+    assert len(monitor.seen) == 3
+    assert sorted(df['TxID']) == sorted(f'{t}-tx' for t in tokens)
+    assert monitor.filter.params == {}
+
+
+def test_cache_state_encoding_round_trip():
+    cache_state = {
+        'address_to_ids': {'Binance': ['0xabc', '0xdef'], 'Кошелек': ['0xabc']},
+        'symbol_to_ids': {'ETH': {'ethereum'}, 'USDT': []},
+        'meta': {'count': 3, 'ratio': 0.5, 'flag': True, 'missing': None}
+    }
+    stats = {}
+    encoded = arkham_service.encode_cache_state(cache_state, stats)
+    assert encoded.startswith(arkham_service.CACHE_ENCODING_PREFIX)
+    assert stats['encoded_bytes'] == len(encoded) and 'json_bytes' not in stats
+    decoded = arkham_service.decode_cache_state(encoded, stats)
+    assert decoded == dict(cache_state, symbol_to_ids={'ETH': ['ethereum'], 'USDT': []})
+    assert stats['stored_bytes'] == len(encoded)
+    # Прежний формат (обычный JSON) по-прежнему читается
+    assert arkham_service.decode_cache_state('{"a": [1]}') == {'a': [1]}
+    assert arkham_service.cache_state_json_size({'a': ['x']}) == len('{"a": ["x"]}')
+
+
+def test_cache_encoding_stats_belong_to_the_caller():
+    session_stats, other_stats = {}, {}
+    arkham_service.encode_cache_state({'a': ['x'] * 100}, session_stats)
+    arkham_service.encode_cache_state({'b': [str(i) for i in range(1000)]}, other_stats)
+    arkham_service.encode_cache_state({'c': []}) # Запись файла сервера без статистики
+    assert session_stats['encoded_bytes'] < other_stats['encoded_bytes']
+
+
+class CacheMonitor:
+    """Монитор с кешем токенов/адресов, как у общего монитора из get_shared_monitor."""
+
+    def __init__(self):
+        self._service_lock = threading.RLock()
+        self._persisted_cache_generation = 0
+        self._persisted_cache_at = 0.0
+        self.tokens = []
+        self.addresses = []
+
+    def get_known_token_symbols(self):
+        return list(self.tokens)
+
+    def get_known_address_names(self):
+        return list(self.addresses)
+
+    def get_full_cache_state(self):
+        return {'tokens': list(self.tokens), 'addresses': list(self.addresses)}
+
+    def get_transactions(self, limit=50, tokens=(), addresses=(), unnamed=()):
+        self.tokens.extend(t for t in tokens if t not in self.tokens)
+        self.addresses.extend(a for a in addresses if a not in self.addresses)
+        # Строки ответа несут те же сущности; адреса без сущности в кеш не попадают
+        rows = [{'Символ': t} for t in tokens] + [{'Откуда': a} for a in list(addresses) + list(unnamed)]
+        return pd.DataFrame(rows)
+
+
+class CacheRequestView:
+    """Представление запроса: пополняет кеш общего монитора, как копия монитора из _request_view."""
+
+    def __init__(self, monitor, tokens=(), addresses=(), unnamed=()):
+        self.monitor, self.tokens, self.addresses, self.unnamed = monitor, tokens, addresses, unnamed
+
+    def get_transactions(self, limit=50):
+        return self.monitor.get_transactions(limit, self.tokens, self.addresses, self.unnamed)
+
+
+def test_cache_is_persisted_in_the_background(tmp_path, monkeypatch):
+    path = tmp_path / 'cache_state'
+    monkeypatch.setenv('ARKHAM_CACHE_STATE_PATH', str(path))
+    monitor = CacheMonitor()
+    assert not arkham_service.persist_cache_state(monitor) # Новых элементов нет
+    arkham_service._run_request(monitor, CacheRequestView(monitor, tokens=['ETH']), 10)
+    assert arkham_service.persist_cache_state(monitor, force=True)
+    assert arkham_service._get_cache_writer().wait_idle(5)
+    assert arkham_service.decode_cache_state(path.read_text()) == {'tokens': ['ETH'], 'addresses': []}
+    assert monitor._persisted_cache_generation == arkham_service.get_cache_generation(monitor)
+    assert not arkham_service.persist_cache_state(monitor)
+
+
+def test_failed_cache_write_keeps_generation_unsaved(tmp_path, monkeypatch):
+    blocker = tmp_path / 'not_a_dir'
+    blocker.write_text('')
+    monkeypatch.setenv('ARKHAM_CACHE_STATE_PATH', str(blocker / 'cache_state'))
+    monitor = CacheMonitor()
+    arkham_service._run_request(monitor, CacheRequestView(monitor, addresses=['Binance']), 10)
+    assert arkham_service.persist_cache_state(monitor, force=True)
+    assert arkham_service._get_cache_writer().wait_idle(5)
+    assert monitor._persisted_cache_generation == 0 # Файл не записан — поколение не считается сохраненным
+    assert monitor._persisted_cache_at > 0
+    assert arkham_service.persist_cache_state(monitor) # Повтор снова планируется
+    writer = arkham_service._get_cache_writer()
+    assert not writer.wait_idle(0.1) # Без force запись ждет CACHE_PERSIST_MIN_INTERVAL
+    assert monitor._persisted_cache_generation == 0
+    with writer._condition:
+        writer._pending.clear()
+
+
+def test_cache_generation_advances_only_when_requests_add_entities():
+    monitor = CacheMonitor()
+    assert arkham_service.get_cache_delta(monitor, None) == (0, [], [], True)
+    arkham_service._run_request(monitor, CacheRequestView(monitor, tokens=['ETH'], addresses=['Binance']), 10)
+    arkham_service._run_request(monitor, CacheRequestView(monitor, tokens=['ETH']), 10) # Ничего нового
+    arkham_service._run_request(monitor, CacheRequestView(monitor, tokens=['BTC']), 10)
+    assert arkham_service.get_cache_generation(monitor) == 2
+    assert arkham_service.get_cache_delta(monitor, 0) == (2, ['ETH', 'BTC'], ['Binance'], False)
+    assert arkham_service.get_cache_delta(monitor, 1) == (2, ['BTC'], [], False)
+    assert arkham_service.get_cache_delta(monitor, 2) == (2, [], [], False)
+
+    # Чтение поколения не просматривает списки монитора
+    monitor.get_known_token_symbols = monitor.get_known_address_names = lambda: pytest.fail("списки не должны читаться")
+    assert arkham_service.get_cache_generation(monitor) == 2
+    assert arkham_service.get_cache_delta(monitor, 1)[:3] == (2, ['BTC'], [])
+
+
+def test_requests_with_known_names_do_not_read_cache_lists():
+    monitor = CacheMonitor()
+    arkham_service._run_request(monitor, CacheRequestView(monitor, addresses=['Binance'], unnamed=['0xabc']), 10)
+    assert arkham_service.get_cache_delta(monitor, 0) == (1, [], ['Binance'], False)
+
+    # Известные имена и уже проверенный адрес без сущности сверку списков не вызывают
+    monitor.get_known_token_symbols = monitor.get_known_address_names = lambda: pytest.fail("списки не должны читаться")
+    arkham_service._run_request(monitor, CacheRequestView(monitor, unnamed=['0xabc']), 10)
+    arkham_service._run_request(monitor, CacheRequestView(monitor, addresses=['Binance']), 10)
+    assert arkham_service.get_cache_generation(monitor) == 1
+
+
+def test_loading_cache_state_invalidates_deltas():
+    monitor = CacheMonitor()
+    arkham_service._run_request(monitor, CacheRequestView(monitor, tokens=['ETH']), 10)
+
+    def load_full_cache_state(state):
+        monitor.tokens, monitor.addresses = list(state['tokens']), list(state['addresses'])
+
+    monitor.load_full_cache_state = load_full_cache_state
+    assert arkham_service.load_cache_state(monitor, {'tokens': ['ETH', 'SOL'], 'addresses': ['OKX']})
+    assert arkham_service.get_cache_delta(monitor, 1) == (2, ['ETH', 'SOL'], ['OKX'], True)
+    assert not arkham_service.load_cache_state(monitor, {'tokens': [], 'addresses': []}, only_if_empty=True)
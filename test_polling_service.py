@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+pytest.importorskip("arkham.arkham_monitor")
+
+import arkham_service
+import polling_service
+
+
+@pytest.fixture
+def pollers(monkeypatch):
+    monkeypatch.setattr(polling_service, '_pollers', {})
+    monkeypatch.setattr(arkham_service, 'get_shared_monitor', lambda api_key: ('monitor', api_key))
+    yield polling_service._pollers
+    for poller in polling_service._pollers.values():
+        poller.stop()
+
+
+def test_get_poller_is_keyed_by_api_key(pollers):
+    first = polling_service.get_poller('key-a')
+    assert polling_service.get_poller('key-a') is first
+    second = polling_service.get_poller('key-b')
+    assert second is not first
+    assert first.monitor == ('monitor', 'key-a')
+    assert second.monitor == ('monitor', 'key-b')
+    assert polling_service.get_poller('') is None
+
+
+def test_unsubscribe_other_keys(pollers):
+    first = polling_service.get_poller('key-a')
+    second = polling_service.get_poller('key-b')
+    first.subscribe('session', {'lookback': '24h'}, 50, 3600)
+    second.subscribe('session', {'lookback': '24h'}, 50, 3600)
+    polling_service.unsubscribe_other_keys('session', 'key-b')
+    assert not first.is_subscribed('session')
+    assert second.is_subscribed('session')
+
+
+def test_find_poller_does_not_create_pollers(pollers):
+    assert polling_service.find_poller('key-a') is None
+    assert pollers == {}
+    created = polling_service.get_poller('key-a')
+    assert polling_service.find_poller('key-a') is created
+    assert polling_service.find_poller('') is None
@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import alert_history
+import settings_persistence
+
+SECTIONS = [('small', ['a', 'b'], False, 0), ('large', ['history'], True, 5)]
+
+
+class Clock:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(settings_persistence.time, 'time', lambda: self.now)
+
+
+def _save(persistence, state, writes):
+    return persistence.save(state.get, list(state), lambda key, payload: writes.append((key, json.loads(payload))))
+
+
+def test_only_changed_sections_are_written(monkeypatch):
+    Clock(monkeypatch)
+    state = {'a': 1, 'b': {'x'}, 'history': alert_history.AlertHistoryStore()}
+    persistence = settings_persistence.SettingsPersistence(SECTIONS)
+    writes = []
+    assert _save(persistence, state, writes) == ['small', 'large']
+    assert writes[0] == ('small', {'a': 1, 'b': ['x'], 'state_version': 1})
+    persistence.begin_run()
+    assert _save(persistence, state, writes) == []
+    state['a'] = 2
+    persistence.begin_run()
+    assert _save(persistence, state, writes) == ['small']
+
+
+def test_large_sections_are_debounced_and_flushed_later(monkeypatch):
+    clock = Clock(monkeypatch)
+    history = alert_history.AlertHistoryStore()
+    state = {'a': 1, 'history': history}
+    persistence = settings_persistence.SettingsPersistence(SECTIONS)
+    persistence.mark_clean('large', state.get, list(state))
+    history['t1'] = {'status': 'queued', 'last_attempt_time': 1}
+    writes = []
+    assert 'large' not in _save(persistence, state, writes) # Внутри окна — откладывается
+    assert not persistence.flush_due()
+    clock.now += 5
+    assert persistence.flush_due()
+    persistence.begin_run()
+    assert _save(persistence, state, writes) == ['large']
+    assert writes[-1][1]['history'] == {'t1': {'status': 'queued', 'last_attempt_time': 1}}
+    assert not persistence.flush_due()
+
+
+def test_a_section_is_written_once_per_run(monkeypatch):
+    Clock(monkeypatch)
+    state = {'a': 1}
+    persistence = settings_persistence.SettingsPersistence(SECTIONS[:1])
+    writes = []
+    assert _save(persistence, state, writes) == ['small']
+    state['a'] = 2
+    assert _save(persistence, state, writes) == [] # Повторная запись ключа в том же запуске конфликтует
+    assert persistence.flush_due()
+    persistence.begin_run()
+    assert _save(persistence, state, writes) == ['small'] and writes[-1][1]['a'] == 2
@@ -0,0 +1,117 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import telegram_service
+
+
+def test_token_bucket_allows_burst_then_spaces_reservations():
+    bucket = telegram_service.TokenBucket(rate_per_sec=2.0, capacity=2)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.05)
+    assert bucket.delay() == pytest.approx(1.5, abs=0.05)
+
+
+def test_token_bucket_block_for_overrides_rate():
+    bucket = telegram_service.TokenBucket(rate_per_sec=100.0, capacity=10)
+    bucket.block_for(3)
+    assert bucket.delay() == pytest.approx(3, abs=0.05)
+    assert bucket.reserve() == pytest.approx(3, abs=0.05)
+
+
+def test_parse_send_response_handles_rate_limit(monkeypatch):
+    monkeypatch.setattr(telegram_service, '_buckets', {})
+    response = {'ok': False, 'parameters': {'retry_after': 7}}
+    assert telegram_service.parse_send_response('1:t', '42', 429, response) == (False, 7.0)
+    assert telegram_service.get_send_delay('1:t', '42') == pytest.approx(7, abs=0.05)
+    assert telegram_service.parse_send_response('1:t', '43', 429, {}) == (False, telegram_service.TELEGRAM_DEFAULT_RETRY_AFTER)
+    assert telegram_service.parse_send_response('1:t', '42', 400, {'ok': False}) == (False, None)
+    assert telegram_service.parse_send_response('1:t', '42', 200, {'ok': True}) == (True, None)
+
+
+def test_group_chats_get_group_rate(monkeypatch):
+    monkeypatch.setattr(telegram_service, '_buckets', {})
+    assert telegram_service._get_bucket('1:t', '-100').rate == telegram_service.TELEGRAM_GROUP_RATE_PER_SEC
+    assert telegram_service._get_bucket('1:t', '100').rate == telegram_service.TELEGRAM_CHAT_RATE_PER_SEC
+    assert telegram_service._get_bucket('1:t', None).rate == telegram_service.TELEGRAM_GLOBAL_RATE_PER_SEC
+
+
+def test_build_digest_messages_packs_in_order_within_limit():
+    messages = [f"message {i} " + "x" * 50 for i in range(10)]
+    digests = telegram_service.build_digest_messages(messages, limit=200)
+    assert all(len(text) <= 200 for text, _ in digests)
+    assert [i for _, indices in digests for i in indices] == list(range(10))
+    for text, indices in digests:
+        if len(indices) > 1:
+            assert text.startswith(f"📦 <b>Сводка: {len(indices)} транзакций</b>")
+        for i in indices:
+            assert messages[i] in text
+
+
+def test_build_digest_messages_single_and_oversized_messages():
+    assert telegram_service.build_digest_messages([]) == []
+    assert telegram_service.build_digest_messages(['only']) == [('only', [0])]
+    long_message = 'y' * 300
+    digests = telegram_service.build_digest_messages(['a', long_message, 'b'], limit=200)
+    assert (long_message, [1]) in digests # Длинное сообщение отправляется отдельно, как есть
+    assert [i for _, indices in digests for i in indices] == [0, 1, 2]
+
+
+def test_batch_formatter_matches_single_row_formatter():
+    df = pd.DataFrame([
+        {'TxID': 'abc', 'Время': '2024-01-01 00:00:00', 'Сеть': 'ethereum', 'Откуда': 'Binance CEX', 'Куда': 'uniswap dex <x>', 'Символ': 'ETH', 'USD': '1,000,000'},
+        {'TxID': 'def', 'Время': '2024-01-01 00:01:00', 'Сеть': 'bitcoin', 'Откуда': None, 'Куда': 'Binance CEX', 'Символ': 'BTC', 'USD': None},
+        {'TxID': None, 'Время': 'x', 'Сеть': 'tron', 'Откуда': 'a', 'Куда': 'b', 'Символ': 'USDT', 'USD': '1'},
+        {'TxID': 'N/A', 'Время': 'x', 'Сеть': 'tron', 'Откуда': 'a', 'Куда': 'b', 'Символ': 'USDT', 'USD': '1'},
+    ], index=[10, 11, 12, 13])
+    batch = telegram_service.format_telegram_messages(df)
+    assert list(batch.index) == [10, 11, 12, 13]
+    for index, row in df.iterrows():
+        assert batch[index] == telegram_service.format_telegram_message(row)
+    assert batch[12] is None and batch[13] is None
+    assert '<b>CEX</b>' in batch[10] and '<b>DEX</b> &lt;x&gt;' in batch[10]
+
+
+def test_batch_formatter_handles_missing_columns_and_empty_frames():
+    assert telegram_service.format_telegram_messages(pd.DataFrame()).empty
+    batch = telegram_service.format_telegram_messages(pd.DataFrame({'TxID': ['t1']}))
+    assert batch.iloc[0] == telegram_service.format_telegram_message({'TxID': 't1'})
+    assert 'N/A' in batch.iloc[0]
+
+
+def test_env_number_falls_back_on_bad_values(monkeypatch):
+    monkeypatch.setenv('TEST_TELEGRAM_NUMBER', 'not-a-number')
+    assert telegram_service.env_number('TEST_TELEGRAM_NUMBER', 8, int) == 8
+    monkeypatch.setenv('TEST_TELEGRAM_NUMBER', '')
+    assert telegram_service.env_number('TEST_TELEGRAM_NUMBER', 2.5) == 2.5
+    monkeypatch.setenv('TEST_TELEGRAM_NUMBER', '12')
+    assert telegram_service.env_number('TEST_TELEGRAM_NUMBER', 8, int) == 12
+    monkeypatch.delenv('TEST_TELEGRAM_NUMBER')
+    assert telegram_service.env_number('TEST_TELEGRAM_NUMBER', 3.05) == 3.05
+
+
+def test_http_session_retries_only_connection_errors():
+    retry = telegram_service._create_session(4, 3).get_adapter('https://').max_retries
+    assert retry.connect == 3
+    assert retry.read == 0 and retry.status == 0
+    assert not retry.status_forcelist # 5xx не повторяются: сообщение могло быть доставлено
+    assert not retry.is_retry('POST', 502)
+
+
+def test_asyncio_backend_without_aiohttp_fails_loudly(monkeypatch):
+    import telegram_async
+    monkeypatch.setattr(telegram_async, 'aiohttp', None)
+    monkeypatch.setattr(telegram_async, '_backend', None)
+    monkeypatch.setenv('TELEGRAM_DELIVERY_BACKEND', 'threads')
+    telegram_async.check_backend_available()
+    monkeypatch.setenv('TELEGRAM_DELIVERY_BACKEND', 'asyncio')
+    with pytest.raises(RuntimeError, match='aiohttp'):
+        telegram_async.check_backend_available()
+    with pytest.raises(RuntimeError, match='aiohttp'):
+        telegram_async.get_async_backend()
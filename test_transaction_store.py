@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'streamlit_app'))
+
+import transaction_store
+
+
+def _iso(seconds_ago):
+    return pd.Timestamp(time.time() - seconds_ago, unit='s').strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _frame(rows):
+    return pd.DataFrame([
+        {'TxID': tx, 'Время': when, 'Символ': symbol, 'Откуда': 'A', 'Куда': 'B', 'USD': usd}
+        for tx, when, symbol, usd in rows
+    ])
+
+
+def test_narrower_query_is_answered_locally(tmp_path):
+    store = transaction_store.TransactionStore(str(tmp_path / 'tx.sqlite3'))
+    df = _frame([('t1', _iso(60), 'ETH', 5e6), ('t2', _iso(120), 'BTC', 2e6), ('t3', _iso(180), 'ETH', 1e6)])
+    store.record(df, {'min_usd': 1e6}, 50, 3600)
+
+    local = store.query({'min_usd': 2e6, 'token_symbols': ['ETH']}, 50, 3600)
+    assert list(local['TxID']) == ['t1']
+    assert store.query({'min_usd': 5e5}, 50, 3600) is None # Шире покрытия — нужен API
+    assert store.query({'min_usd': 1e6}, 50, 7200) is None
+
+
+def test_stale_coverage_is_not_used(tmp_path, monkeypatch):
+    store = transaction_store.TransactionStore(str(tmp_path / 'tx.sqlite3'))
+    store.record(_frame([('t1', _iso(60), 'ETH', 5e6)]), {'min_usd': 0}, 50, 3600)
+    now = time.time()
+    monkeypatch.setattr(transaction_store.time, 'time', lambda: now + 20)
+    assert store.query({'min_usd': 0}, 50, 3600, max_age=15) is None # Старше TTL кеша ответов
+    assert len(store.query({'min_usd': 0}, 50, 3600, max_age=30)) == 1
+
+
+def test_unchanged_rows_are_not_rewritten(tmp_path):
+    store = transaction_store.TransactionStore(str(tmp_path / 'tx.sqlite3'))
+    df = _frame([('t1', _iso(60), 'ETH', 5e6)])
+    store.record(df, {'min_usd': 0}, 50, 3600)
+    changes = store._conn.total_changes
+    store.record(df, {'min_usd': 0}, 50, 3600)
+    assert store._conn.total_changes == changes + 1 # Только новая запись покрытия
+
+
+def test_coverage_tolerates_a_few_unparsed_rows(tmp_path):
+    store = transaction_store.TransactionStore(str(tmp_path / 'tx.sqlite3'))
+    rows = [(f't{i}', _iso(60 + i), 'ETH', 1e6) for i in range(40)] + [('bad', 'not a time', 'ETH', 1e6)]
+    store.record(_frame(rows), {'min_usd': 0}, 100, 3600)
+    assert len(store.query({'min_usd': 0}, 100, 3600)) == 40
+
+    mostly_bad = [('x1', 'not a time', 'ETH', 1e6), ('x2', _iso(60), 'ETH', None)]
+    other = transaction_store.TransactionStore(str(tmp_path / 'other.sqlite3'))
+    other.record(_frame(mostly_bad), {'min_usd': 0}, 100, 3600)
+    assert other.query({'min_usd': 0}, 100, 3600) is None
+
+
+def test_future_times_disable_coverage(tmp_path):
+    store = transaction_store.TransactionStore(str(tmp_path / 'tx.sqlite3'))
+    store.record(_frame([('t1', _iso(-3 * 3600), 'ETH', 1e6)]), {'min_usd': 0}, 50, 3600)
+    assert store.query({'min_usd': 0}, 50, 3600) is None
+
+
+def test_to_epoch_treats_naive_time_as_utc():
+    epochs = transaction_store.to_epoch(pd.Series(['1970-01-01 00:01:00', '1970-01-01 01:00:00', 'bad']))
+    assert list(epochs) == [60.0, 3600.0, None]